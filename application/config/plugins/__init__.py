@@ -1,13 +1,19 @@
 from datasette import hookimpl
+from datasette.database import Database
+from datasette.plugins import get_plugins
 from datasette.utils.asgi import Response, NotFound
 from datasette_tiles.utils import (
     detect_mtiles_databases,
-    tiles_stack_database_order,
     latlon_to_tile_with_adjust,
     tile_to_latlon,
 )
+import asyncio
 import json
 import math
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
 
 # 256x256 PNG of colour #dddddd, compressed using https://squoosh.app
 PNG_404 = (
@@ -23,6 +29,114 @@ PNG_404 = (
     b"\x03\x05\xddg\xde\x01\xd26\xe7\xdd\x00\x00\x00\x00IEND\xaeB`\x82"
 )
 
+# mbtiles with every dataset's layers joined in priority order, built by the tiles task
+STACK_DATABASE = "tiles-stack"
+
+# Directory the tiles task swaps its built mbtiles into, watched for new and replaced files
+TILES_DIR = Path(os.getenv("TILES_DIR", "/mnt/tiles"))
+TILES_RELOAD_INTERVAL = float(os.getenv("TILES_RELOAD_INTERVAL", "10"))
+# Seconds a replaced database stays open for the requests that were already using it
+TILES_RETIRE_DELAY = 60
+
+_tiles_watcher = None
+# datasette.databases when the mbtiles databases were last detected, and those databases
+_mbtiles_databases = (None, {})
+# Likewise for the databases tiles-stack requests look tiles up in
+_tiles_stack_order = (None, [])
+
+# Bytes of tiles kept in memory, 0 to turn the cache off
+TILE_CACHE_BYTES = int(os.getenv("TILE_CACHE_BYTES", str(128 * 1024 * 1024)))
+# Rough cost of an entry besides its tile, so that cached missing tiles count too
+TILE_CACHE_ENTRY_BYTES = 200
+
+
+class TileCache:
+    """LRU cache of tiles keyed by (database, z, x, y), within a byte budget.
+
+    Missing tiles are cached as None. Databases are keyed by object rather than
+    name, so a database swapped in by a reload never sees the old one's tiles.
+    It is only used from the event loop, so needs no locking.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.tiles = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def entry_bytes(tile):
+        return TILE_CACHE_ENTRY_BYTES + (len(tile) if tile is not None else 0)
+
+    def get(self, key):
+        """Return (found, tile) for key, counting the hit or miss."""
+        if key not in self.tiles:
+            self.misses += 1
+            return False, None
+        self.tiles.move_to_end(key)
+        self.hits += 1
+        return True, self.tiles[key]
+
+    def put(self, key, tile):
+        size = self.entry_bytes(tile)
+        if size > self.max_bytes:
+            return
+        if key in self.tiles:
+            self.bytes -= self.entry_bytes(self.tiles.pop(key))
+        self.tiles[key] = tile
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            _, evicted = self.tiles.popitem(last=False)
+            self.bytes -= self.entry_bytes(evicted)
+            self.evictions += 1
+
+    def drop(self, db):
+        """Remove every tile cached for db."""
+        for key in [key for key in self.tiles if key[0] is db]:
+            self.bytes -= self.entry_bytes(self.tiles.pop(key))
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "tiles": len(self.tiles),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+        }
+
+
+tile_cache = TileCache(TILE_CACHE_BYTES)
+
+
+class TilesDatabase(Database):
+    """Database whose executor threads keep their connections per database rather than per name.
+
+    datasette keeps each thread's connection under the database name, so a database
+    swapped in under the same name would go on reading the file it replaced.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._connections = threading.local()
+
+    async def execute_fn(self, fn):
+        if self.ds.executor is None:
+            return await super().execute_fn(fn)
+
+        def in_thread():
+            conn = getattr(self._connections, "conn", None)
+            if conn is None:
+                conn = self.connect()
+                self.ds._prepare_connection(conn, self.name)
+                self._connections.conn = conn
+            return fn(conn)
+
+        return await asyncio.get_running_loop().run_in_executor(self.ds.executor, in_thread)
+
+
 SELECT_TILE_SQL = """
 select
   tile_data
@@ -39,6 +153,7 @@ where
 def register_routes():
     return [
         (r"/-/tiles$", index),
+        (r"/-/tiles-cache\.json$", tile_cache_stats),
         (r"/-/tiles/(?P<db_name>[^/]+)$", explorer),
         (
             r"/-/tiles/(?P<db_name>[^/]+)/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)\.vector.pbf$",
@@ -57,11 +172,196 @@ def register_routes():
     ]
 
 
+@hookimpl
+def startup(datasette):
+    async def inner():
+        await get_tiles_stack_order(datasette)
+
+    return inner
+
+
+@hookimpl
+def asgi_wrapper(datasette):
+    def wrap_with_tiles_watcher(app):
+        async def add_tiles_watcher(scope, receive, send):
+            ensure_tiles_watcher(datasette)
+            await app(scope, receive, send)
+
+        return add_tiles_watcher
+
+    return wrap_with_tiles_watcher
+
+
+def ensure_tiles_watcher(datasette):
+    """Start watching TILES_DIR on the running event loop, unless already watching it there.
+
+    datasette serve runs startup hooks to completion on a loop that uvicorn does not
+    serve from, where a task would never run, so the watcher is started from the
+    ASGI lifespan and requests instead.
+    """
+    global _tiles_watcher
+    loop = asyncio.get_running_loop()
+    if _tiles_watcher is not None and not _tiles_watcher.done() and _tiles_watcher.get_loop() is loop:
+        return
+    _tiles_watcher = loop.create_task(
+        watch_tiles_dir(datasette, TILES_DIR, TILES_RELOAD_INTERVAL)
+    )
+
+
+def get_tiles_files(tiles_dir):
+    """Return {database name: (inode, mtime)} for the mbtiles files in tiles_dir.
+
+    The tiles task swaps files in with a rename, so a replaced file has a new inode.
+    """
+    files = {}
+    try:
+        entries = list(os.scandir(tiles_dir))
+    except FileNotFoundError:
+        return files
+    for entry in entries:
+        if entry.name.endswith(".mbtiles") and not entry.name.startswith("."):
+            stat = entry.stat()
+            files[entry.name[: -len(".mbtiles")]] = (stat.st_ino, stat.st_mtime_ns)
+    return files
+
+
+def get_loaded_tiles_files(datasette, tiles_dir):
+    """Return get_tiles_files for the databases datasette was started with from tiles_dir."""
+    files = get_tiles_files(tiles_dir)
+    return {
+        name: files[name]
+        for name, db in datasette.databases.items()
+        if name in files
+        and db.path
+        and Path(db.path).resolve() == (Path(tiles_dir) / f"{name}.mbtiles").resolve()
+    }
+
+
+def retire_database(db):
+    """Drop a database that is no longer served from the tile cache, and close it
+    once its in-flight requests are done.
+    """
+    tile_cache.drop(db)
+    close = getattr(db, "close", None)
+    if close is not None:
+        asyncio.get_running_loop().call_later(TILES_RETIRE_DELAY, close)
+
+
+async def reload_tiles_databases(datasette, tiles_dir, loaded):
+    """Bring datasette's databases in line with the mbtiles files in tiles_dir.
+
+    loaded maps each database this plugin manages to the get_tiles_files entry of the
+    file it has open, and is updated in place. New and replaced files are opened and
+    swapped in under their name, and databases whose file has gone are removed.
+    Returns the names of the databases that changed.
+    """
+    loop = asyncio.get_running_loop()
+    files = get_tiles_files(tiles_dir)
+    changed = []
+    for name, key in sorted(files.items()):
+        if loaded.get(name) == key:
+            continue
+        path = str(Path(tiles_dir) / f"{name}.mbtiles")
+        try:
+            # Opening an immutable database hashes the whole file, so keep it off the event loop
+            db = await loop.run_in_executor(
+                None, lambda: TilesDatabase(datasette, path=path, is_mutable=False)
+            )
+        except Exception as e:
+            print(f"ERROR opening {path}: {e}", flush=True)
+            continue
+        # Nothing is awaited between removing and adding, so no request sees it missing
+        old_db = datasette.databases.get(name)
+        if old_db is not None:
+            datasette.remove_database(name)
+        datasette.add_database(db, name=name)
+        if old_db is not None:
+            retire_database(old_db)
+        loaded[name] = key
+        changed.append(name)
+    for name in sorted(set(loaded) - set(files)):
+        old_db = datasette.databases.get(name)
+        if old_db is not None:
+            datasette.remove_database(name)
+            retire_database(old_db)
+        del loaded[name]
+        changed.append(name)
+    return changed
+
+
+async def watch_tiles_dir(datasette, tiles_dir, interval):
+    loaded = get_loaded_tiles_files(datasette, tiles_dir)
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            changed = await reload_tiles_databases(datasette, tiles_dir, loaded)
+        except Exception as e:
+            print(f"ERROR reloading tiles from {tiles_dir}: {e}", flush=True)
+            continue
+        if changed:
+            print(f"Reloaded tiles databases: {changed}", flush=True)
+            await get_tiles_stack_order(datasette)
+
+
+async def get_mbtiles_databases(datasette):
+    """Return {name: Database} for the attached databases that hold mbtiles tiles.
+
+    Detecting them refreshes every schema, so the result is kept until the set of
+    attached databases changes. add_database and remove_database replace
+    datasette.databases rather than changing it in place, so a change shows up as a
+    different dict, including when a reload swaps in a new file under the same name.
+    """
+    global _mbtiles_databases
+    databases, mbtiles_databases = _mbtiles_databases
+    if databases is datasette.databases:
+        return mbtiles_databases
+    databases = datasette.databases
+    names = await detect_mtiles_databases(datasette)
+    mbtiles_databases = {name: databases[name] for name in names if name in databases}
+    _mbtiles_databases = (databases, mbtiles_databases)
+    return mbtiles_databases
+
+
+async def get_tiles_stack_order(datasette):
+    """Return the databases tiles-stack requests try in turn, kept like get_mbtiles_databases.
+
+    The tiles-stack database already holds every database's layers, so when it is
+    attached it is the only one tried. Without a configured order the names are tried
+    in reverse sorted order, rather than reverse attached order, which a reload changes
+    by attaching the new file last.
+    """
+    global _tiles_stack_order
+    databases, order = _tiles_stack_order
+    if databases is datasette.databases:
+        return order
+    databases = datasette.databases
+    if STACK_DATABASE in databases:
+        _tiles_stack_order = (databases, [databases[STACK_DATABASE]])
+        return _tiles_stack_order[1]
+    config = datasette.plugin_config("datasette-tiles") or {}
+    stack_order = config.get("tiles-stack-order")
+    if not stack_order:
+        mbtiles_databases = await get_mbtiles_databases(datasette)
+        stack_order = sorted(mbtiles_databases)
+    database_order = [name for name in reversed(stack_order) if name in databases]
+    # if datasette-basemap is installed, move basemap to the end
+    plugins = [p["name"] for p in get_plugins()]
+    if (
+        not config.get("tiles-stack-order")
+        and "datasette-basemap" in plugins
+        and "basemap" in database_order
+    ):
+        database_order.remove("basemap")
+        database_order.append("basemap")
+    _tiles_stack_order = (databases, [databases[name] for name in database_order])
+    return _tiles_stack_order[1]
+
+
 async def index(datasette):
     return Response.html(
         await datasette.render_template(
             "tiles_index.html",
-            {"mbtiles_databases": await detect_mtiles_databases(datasette)},
+            {"mbtiles_databases": list(await get_mbtiles_databases(datasette))},
         )
     )
 
@@ -72,6 +372,10 @@ async def load_tile(db, request, tms):
     y = int(request.url_vars["y"])
     if not tms:
         y = int(math.pow(2, z) - 1 - y)
+    key = (db, z, x, y)
+    found, tile = tile_cache.get(key)
+    if found:
+        return tile
     result = await db.execute(
         SELECT_TILE_SQL,
         {
@@ -80,9 +384,13 @@ async def load_tile(db, request, tms):
             "y": y,
         },
     )
-    if not result.rows:
-        return None
-    return result.rows[0][0]
+    tile = result.rows[0][0] if result.rows else None
+    tile_cache.put(key, tile)
+    return tile
+
+
+async def tile_cache_stats():
+    return Response.json(tile_cache.stats())
 
 
 async def tile(request, datasette):
@@ -94,11 +402,9 @@ async def tile_tms(request, datasette):
 
 
 async def _tile(request, datasette, tms):
-    db_name = request.url_vars["db_name"]
-    mbtiles_databases = await detect_mtiles_databases(datasette)
-    if db_name not in mbtiles_databases:
+    db = (await get_mbtiles_databases(datasette)).get(request.url_vars["db_name"])
+    if db is None:
         raise NotFound("Not a valid mbtiles database")
-    db = datasette.get_database(db_name)
     tile = await load_tile(db, request, tms)
     if tile is None:
         return Response(body="", content_type="text/plain", status=404)
@@ -108,9 +414,8 @@ async def _tile(request, datasette, tms):
 
 
 async def _tiles_stack(datasette, request, tms):
-    priority_order = await tiles_stack_database_order(datasette)
     # Try each database in turn
-    for database in priority_order:
+    for database in await get_tiles_stack_order(datasette):
         tile = await load_tile(database, request, tms=tms)
         if tile is not None:
             r = Response(body=tile, content_type="application/x-protobuf")
@@ -129,10 +434,9 @@ async def tiles_stack_tms(datasette, request):
 
 async def explorer(datasette, request):
     db_name = request.url_vars["db_name"]
-    mbtiles_databases = await detect_mtiles_databases(datasette)
-    if db_name not in mbtiles_databases:
+    db = (await get_mbtiles_databases(datasette)).get(db_name)
+    if db is None:
         raise NotFound("Not a valid mbtiles database")
-    db = datasette.get_database(db_name)
     metadata = {
         row["name"]: row["value"]
         for row in (await db.execute("select name, value from metadata")).rows
@@ -197,7 +501,7 @@ async def explorer(datasette, request):
 async def tiles_stack_explorer(datasette):
     attribution = ""
     # Find min/max zoom by looking at the stack
-    priority_order = await tiles_stack_database_order(datasette)
+    priority_order = await get_tiles_stack_order(datasette)
     min_zooms = []
     max_zooms = []
     attributions = []
@@ -233,7 +537,7 @@ async def tiles_stack_explorer(datasette):
 @hookimpl
 def database_actions(datasette, database):
     async def inner():
-        mbtiles_databases = await detect_mtiles_databases(datasette)
+        mbtiles_databases = await get_mbtiles_databases(datasette)
         if database in mbtiles_databases:
             return [
                 {
@@ -250,7 +554,7 @@ def table_actions(datasette, database, table):
     async def inner():
         if table != "tiles":
             return None
-        mbtiles_databases = await detect_mtiles_databases(datasette)
+        mbtiles_databases = await get_mbtiles_databases(datasette)
         if database in mbtiles_databases:
             return [
                 {
@@ -0,0 +1,132 @@
+import json
+import math
+import random
+import sqlite3
+from pathlib import Path
+
+import click
+
+CREATE_ENTITY_TABLE_SQL = """
+    CREATE TABLE entity
+    (
+        dataset             TEXT,
+        end_date            TEXT,
+        entity              INTEGER PRIMARY KEY,
+        entry_date          TEXT,
+        geojson             JSON,
+        geometry            TEXT,
+        json                JSON,
+        name                TEXT,
+        organisation_entity TEXT,
+        point               TEXT,
+        prefix              TEXT,
+        reference           TEXT,
+        start_date          TEXT,
+        typology            TEXT
+    )
+"""
+
+CREATE_OLD_ENTITY_TABLE_SQL = """
+    CREATE TABLE old_entity (end_date TEXT,
+        entity INTEGER,
+        entry_date TEXT,
+        notes TEXT,
+        old_entity TEXT PRIMARY KEY,
+        start_date TEXT,
+        status TEXT, FOREIGN KEY (entity) REFERENCES entity (entity))
+"""
+
+# Roughly the extent of England, where the real datasets live
+MIN_LONGITUDE, MAX_LONGITUDE = -5.7, 1.8
+MIN_LATITUDE, MAX_LATITUDE = 49.9, 55.8
+
+
+def random_polygon(rng, x, y, vertices):
+    "Return a WKT multipolygon of a star-shaped ring around x, y with the given number of vertices"
+    radius = rng.uniform(0.0005, 0.01)
+    points = []
+    for i in range(vertices):
+        angle = 2 * math.pi * i / vertices
+        r = radius * rng.uniform(0.6, 1.0)
+        points.append(f"{x + r * math.cos(angle):.15f} {y + r * math.sin(angle):.15f}")
+    points.append(points[0])
+    return f"MULTIPOLYGON ((({','.join(points)})))"
+
+
+def generate_entity_rows(rng, datasets, rows_per_dataset, point_ratio, polygon_vertices):
+    entity = 1000000
+    for d in range(datasets):
+        dataset = f"synthetic-dataset-{d}"
+        for i in range(rows_per_dataset):
+            entity += 1
+            x = rng.uniform(MIN_LONGITUDE, MAX_LONGITUDE)
+            y = rng.uniform(MIN_LATITUDE, MAX_LATITUDE)
+            geometry = (
+                "" if rng.random() < point_ratio else random_polygon(rng, x, y, polygon_vertices)
+            )
+            yield (
+                dataset,
+                "",
+                entity,
+                "2024-01-01",
+                "",
+                geometry,
+                json.dumps({"notes": f"synthetic entity {i}"}),
+                f"{dataset} {i}",
+                str(rng.randint(1, 500)),
+                f"POINT ({x:.15f} {y:.15f})",
+                dataset,
+                str(i),
+                "2024-01-01",
+                "geography",
+            )
+
+
+def generate_entity_database(
+    path,
+    datasets=3,
+    rows_per_dataset=10000,
+    point_ratio=0.5,
+    old_entity_ratio=0.01,
+    polygon_vertices=50,
+    seed=0,
+):
+    """Create an entity SQLite file with the schema the builder reads, filled with random geographies.
+
+    Each dataset gets rows_per_dataset entities, point_ratio of which only have a point
+    and the rest a polygon. old_entity_ratio of all entities are marked as replaced.
+    """
+    rng = random.Random(seed)
+    path = Path(path)
+    path.unlink(missing_ok=True)
+    with sqlite3.connect(path) as conn:
+        conn.execute(CREATE_ENTITY_TABLE_SQL)
+        conn.execute(CREATE_OLD_ENTITY_TABLE_SQL)
+        conn.executemany(
+            "INSERT INTO entity VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            generate_entity_rows(rng, datasets, rows_per_dataset, point_ratio, polygon_vertices),
+        )
+        entities = [row[0] for row in conn.execute("SELECT entity FROM entity")]
+        old_entities = rng.sample(entities, int(len(entities) * old_entity_ratio))
+        conn.executemany(
+            "INSERT INTO old_entity (old_entity, entity, status) VALUES (?, ?, '301')",
+            ((str(old), rng.choice(entities)) for old in old_entities),
+        )
+    conn.close()
+    return path
+
+
+@click.command()
+@click.option("--output", type=click.Path(dir_okay=False), required=True, help="Path of the SQLite file to create")
+@click.option("--datasets", type=click.IntRange(min=1), default=3, show_default=True)
+@click.option("--rows-per-dataset", type=click.IntRange(min=1), default=10000, show_default=True)
+@click.option("--point-ratio", type=click.FloatRange(0, 1), default=0.5, show_default=True)
+@click.option("--old-entity-ratio", type=click.FloatRange(0, 1), default=0.01, show_default=True)
+@click.option("--polygon-vertices", type=click.IntRange(min=3), default=50, show_default=True)
+@click.option("--seed", type=int, default=0, show_default=True)
+def main(output, **kwargs):
+    generate_entity_database(output, **kwargs)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+import datetime
+import json
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+
+import click
+
+from benchmarks.generate_entity_database import generate_entity_database
+from task.build_tiles import (
+    build_dataset_tiles,
+    create_geojson_file,
+    create_geojson_from_wkt,
+    get_dataset_features,
+    get_geography_datasets,
+    write_dataset_features,
+)
+
+
+def timed(function, *args, **kwargs):
+    started = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - started
+
+
+def get_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(work_dir, generator_options, jobs=1):
+    """Time each build stage against a freshly generated entity database."""
+    entity_path = Path(work_dir) / "entity.sqlite3"
+    _, generate_seconds = timed(generate_entity_database, entity_path, **generator_options)
+    datasets = get_geography_datasets(entity_path)
+
+    _, wkt_seconds = timed(create_geojson_from_wkt, entity_path, jobs=jobs)
+    stages = {"create_geojson_from_wkt": {"seconds": wkt_seconds, "jobs": jobs}}
+
+    tippecanoe_installed = shutil.which("tippecanoe") is not None
+    dataset_results = {}
+    for dataset in datasets:
+        features, features_seconds = timed(get_dataset_features, entity_path, dataset)
+        _, file_seconds = timed(create_geojson_file, features, work_dir, dataset)
+        _, stream_seconds = timed(write_dataset_features, entity_path, work_dir, dataset)
+        tiles_seconds = None
+        if tippecanoe_installed:
+            _, tiles_seconds = timed(build_dataset_tiles, work_dir, dataset)
+        dataset_results[dataset] = {
+            "get_dataset_features": {"seconds": features_seconds},
+            "create_geojson_file": {
+                "seconds": file_seconds,
+                "bytes": (Path(work_dir) / f"{dataset}.geojson").stat().st_size,
+            },
+            "write_dataset_features": {"seconds": stream_seconds},
+            "build_dataset_tiles": {"seconds": tiles_seconds},
+        }
+
+    for stage in [
+        "get_dataset_features",
+        "create_geojson_file",
+        "write_dataset_features",
+        "build_dataset_tiles",
+    ]:
+        seconds = [r[stage]["seconds"] for r in dataset_results.values()]
+        stages[stage] = {
+            "seconds": None if None in seconds else sum(seconds),
+        }
+
+    return {
+        "commit": get_commit(),
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "generator": generator_options,
+        "generate_seconds": generate_seconds,
+        "entity_bytes": entity_path.stat().st_size,
+        "tippecanoe_installed": tippecanoe_installed,
+        "stages": stages,
+        "datasets": dataset_results,
+    }
+
+
+@click.command()
+@click.option(
+    "--output-dir",
+    type=click.Path(file_okay=False),
+    default=Path("benchmarks/results"),
+    show_default=True,
+    help="Directory the JSON results are written to, one file per run",
+)
+@click.option("--datasets", type=click.IntRange(min=1), default=3, show_default=True)
+@click.option("--rows-per-dataset", type=click.IntRange(min=1), default=10000, show_default=True)
+@click.option("--point-ratio", type=click.FloatRange(0, 1), default=0.5, show_default=True)
+@click.option("--old-entity-ratio", type=click.FloatRange(0, 1), default=0.01, show_default=True)
+@click.option("--polygon-vertices", type=click.IntRange(min=3), default=50, show_default=True)
+@click.option("--seed", type=int, default=0, show_default=True)
+@click.option(
+    "--jobs",
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+    help="Processes used to parse WKT",
+)
+def main(output_dir, jobs, **generator_options):
+    with tempfile.TemporaryDirectory() as work_dir:
+        results = run_benchmarks(work_dir, generator_options, jobs)
+
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    timestamp = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+    results_path = Path(output_dir) / f"{timestamp}-{results['commit'] or 'unknown'}.json"
+    with open(results_path, "w") as file:
+        json.dump(results, file, indent=2)
+    print(json.dumps(results["stages"], indent=2))
+    print(f"results written to {results_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,468 @@
+import datetime
+import fcntl
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+
+import click
+
+S3_OBJECT_ARN_REGEX = re.compile(r"^arn:aws:s3:::([0-9A-Za-z-]*)/(.*)$")
+IGNORED_DATABASES = {"entity", "digital-land"}
+BUILD_TILES_PATH = Path(__file__).parent / "build_tiles.py"
+PROCESSING_DIR = "processing"
+FAILED_DIR = "failed"
+# How long a build waits for another build of the same database to release its lock
+LOCK_TIMEOUT = 4 * 60 * 60
+LOCK_POLL_INTERVAL = 5
+# The snapshot is the sidecar the next incremental build diffs against
+SWAPPED_SUFFIXES = [".mbtiles", ".pmtiles", ".geojson", ".snapshot.sqlite3"]
+# Name of the joined tiles of every dataset that build_tiles.py writes with --stack-dir
+STACK_NAME = "tiles-stack"
+# Environment flags of the task, their defaults and the build_tiles.py options they enable
+BUILD_FLAGS = [
+    ("HASH_CHECK_ENABLED", "true", ["--hash-check-enabled"]),
+    ("HASH_GENERATION_ENABLED", "true", ["--hash-generation-enabled"]),
+    ("HASH_STAT_CHECK_ENABLED", "false", ["--hash-stat-check-enabled"]),
+    ("KEEP_GEOJSON", "false", ["--keep-geojson"]),
+    ("READ_ONLY_EXPORT", "false", ["--read-only"]),
+    ("RESUME_BUILD", "false", ["--resume"]),
+]
+
+
+def log(event_id, message):
+    print(f"{event_id}: {message}", flush=True)
+
+
+def parse_s3_object_arn(arn):
+    """Return the bucket and key of an S3 object ARN, raising ValueError for anything else."""
+    match = S3_OBJECT_ARN_REGEX.match(arn or "")
+    if match is None:
+        raise ValueError(f"invalid S3 object ARN: {arn}")
+    return match.group(1), match.group(2)
+
+
+def get_event_database(event):
+    """Return the name of the database an event is for, from its S3 key or local path."""
+    if "path" in event:
+        return Path(event["path"]).stem
+    _, key = parse_s3_object_arn(event.get("s3_object_arn"))
+    return Path(key).stem
+
+
+def enqueue_event(queue_dir, event):
+    """Write an event into the queue directory, named so that events sort in arrival order."""
+    queue_dir = Path(queue_dir)
+    queue_dir.mkdir(parents=True, exist_ok=True)
+    name = f"{time.time_ns()}-{uuid.uuid4().hex}.json"
+    temporary_path = queue_dir / f".{name}.tmp"
+    with open(temporary_path, "w") as file:
+        json.dump(event, file)
+    os.replace(temporary_path, queue_dir / name)
+    return queue_dir / name
+
+
+def read_queued_events(queue_dir):
+    """Return {database: [(event_path, event), ...]} for the queued events, oldest first.
+
+    Events that cannot be read or do not name a database are moved to the failed directory.
+    """
+    events = {}
+    for path in sorted(Path(queue_dir).glob("*.json")):
+        try:
+            with open(path) as file:
+                event = json.load(file)
+            database = get_event_database(event)
+        except FileNotFoundError:
+            continue
+        except (OSError, ValueError) as exc:
+            print(f"ERROR reading queued event {path.name}: {exc}", flush=True)
+            move_event(path, Path(queue_dir) / FAILED_DIR)
+            continue
+        events.setdefault(database, []).append((path, event))
+    return events
+
+
+def move_event(event_path, directory):
+    """Move an event file into directory, returning its new path or None if it has gone."""
+    directory.mkdir(parents=True, exist_ok=True)
+    try:
+        os.replace(event_path, directory / event_path.name)
+    except FileNotFoundError:
+        return None
+    return directory / event_path.name
+
+
+def claim_database_events(queue_dir, queued):
+    """Claim the latest of a database's queued events, dropping the ones it supersedes.
+
+    Every event for a database leads to the same build of its latest data, so only
+    one build is needed however many events arrived. Claiming moves the event into
+    the processing directory, which fails if another process claimed it first.
+    Returns the claimed event's new path and the event, or None.
+    """
+    *superseded, (latest_path, event) = queued
+    claimed = move_event(latest_path, Path(queue_dir) / PROCESSING_DIR)
+    if claimed is None:
+        return None
+    for path, old_event in superseded:
+        log(old_event.get("event_id"), f"superseded by {event.get('event_id')}")
+        Path(path).unlink(missing_ok=True)
+    return claimed, event
+
+
+def acquire_lock(lock_path, timeout=LOCK_TIMEOUT, poll_interval=LOCK_POLL_INTERVAL):
+    """Take an exclusive lock on lock_path, waiting up to timeout seconds for it.
+
+    The lock is held by the returned open file and released when it is closed or its
+    process dies, so it never goes stale. Returns None if the lock was not acquired.
+    """
+    lock_file = open(lock_path, "a+")
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            if time.monotonic() >= deadline:
+                lock_file.close()
+                return None
+            time.sleep(poll_interval)
+            continue
+        lock_file.seek(0)
+        lock_file.truncate()
+        lock_file.write(f"{os.getpid()} {int(time.time())}\n")
+        lock_file.flush()
+        return lock_file
+
+
+def get_source_stat(event):
+    """Return the size and modification time in nanoseconds of the event's database at its source."""
+    if "path" in event:
+        stat = os.stat(event["path"])
+        return {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+    bucket, key = parse_s3_object_arn(event["s3_object_arn"])
+    head = json.loads(
+        subprocess.run(
+            ["aws", "s3api", "head-object", "--bucket", bucket, "--key", key],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+    )
+    last_modified = datetime.datetime.fromisoformat(head["LastModified"].replace("Z", "+00:00"))
+    return {"size": head["ContentLength"], "mtime": int(last_modified.timestamp()) * 1_000_000_000}
+
+
+def download_database(event, entity_path, keep_unchanged=False):
+    """Fetch the event's database to entity_path, via a temporary file moved into place.
+
+    The file is given the source's modification time, so that an unchanged source
+    keeps the size and mtime build_tiles.py's hash stat check compares. A file still
+    as downloaded from the same source is not downloaded again, and with
+    keep_unchanged neither is one an unfinished build converted to GeoJSON, so that
+    a resumed build can skip that stage. Returns whether the file was downloaded.
+    """
+    entity_path = Path(entity_path)
+    source_path = Path(f"{entity_path}.source.json")
+    source_stat = get_source_stat(event)
+    if entity_path.is_file():
+        stat = entity_path.stat()
+        if {"size": stat.st_size, "mtime": stat.st_mtime_ns} == source_stat:
+            return False
+        if keep_unchanged and source_path.is_file() and json.loads(source_path.read_text()) == source_stat:
+            return False
+
+    temporary_path = Path(f"{entity_path}.download")
+    if "path" in event:
+        shutil.copyfile(event["path"], temporary_path)
+    else:
+        bucket, key = parse_s3_object_arn(event["s3_object_arn"])
+        subprocess.run(
+            ["aws", "s3api", "get-object", "--bucket", bucket, "--key", key, str(temporary_path)],
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+    os.utime(temporary_path, ns=(source_stat["mtime"], source_stat["mtime"]))
+    os.replace(temporary_path, entity_path)
+    source_path.write_text(json.dumps(source_stat))
+    return True
+
+
+def get_build_args(entity_path, output_dir, tiles_dir, env):
+    """Return the build_tiles.py options for a build, from the task's environment flags."""
+    args = [
+        "--entity-path",
+        str(entity_path),
+        "--output-dir",
+        str(output_dir),
+        "--hash-dir",
+        str(Path(tiles_dir) / "dataset" / "hashes"),
+        "--jobs",
+        env.get("BUILD_JOBS") or "1",
+        "--tile-format",
+        env.get("TILE_FORMAT") or "mbtiles",
+        "--hash-algorithm",
+        env.get("HASH_ALGORITHM") or "md5",
+    ]
+    for name, default, flag_args in BUILD_FLAGS:
+        if env.get(name, default) == "true":
+            args += flag_args
+    if env.get("INCREMENTAL_BUILD", "false") == "true":
+        args += ["--incremental-from", str(tiles_dir)]
+    return args
+
+
+def build_stack(entity_path, tiles_dir, env, build_command):
+    """Join the served mbtiles into the tiles stack and swap it in, holding the stack lock.
+
+    Builds of other databases may be swapping in tiles at the same time, so the join
+    only starts once this build's tiles are served, and the lock is held until its
+    result is swapped in. The last stack swapped in then joins every database's
+    latest tiles. Returns whether the stack was swapped in.
+    """
+    event_id = env.get("EVENT_ID")
+    output_dir = tiles_dir / "temporary" / STACK_NAME
+    log(event_id, f"waiting for lock-{STACK_NAME}")
+    lock_file = acquire_lock(tiles_dir / f"lock-{STACK_NAME}")
+    if lock_file is None:
+        log(event_id, f"lock-{STACK_NAME} is still held, giving up")
+        return False
+    try:
+        shutil.rmtree(output_dir, ignore_errors=True)
+        output_dir.mkdir(parents=True)
+        args = [
+            "--entity-path",
+            str(entity_path),
+            "--output-dir",
+            str(output_dir),
+            "--tile-format",
+            env.get("TILE_FORMAT") or "mbtiles",
+            "--stack-dir",
+            str(tiles_dir),
+            "--stack-only",
+        ]
+        result = subprocess.run(build_command + args, env=env, cwd=entity_path.parent)
+        if result.returncode != 0:
+            log(event_id, f"{STACK_NAME} build failed")
+            return False
+        swap_outputs(output_dir, tiles_dir, [STACK_NAME])
+        log(event_id, f"{STACK_NAME} swapped out")
+        return True
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+        lock_file.close()
+
+
+def read_build_report(metrics_path):
+    """Return the metrics report build_tiles.py wrote, or None if there is none."""
+    try:
+        with open(metrics_path) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def get_built_outputs(report):
+    """Return the output names of a build that were actually built, from its metrics report.
+
+    Datasets skipped as unchanged or that failed are left out, so that their
+    served tiles stay in place.
+    """
+    names = [dataset for dataset, metrics in report.get("datasets", {}).items() if metrics.get("success")]
+    if (report.get("stack") or {}).get("success"):
+        names.append(STACK_NAME)
+    return names
+
+
+def swap_outputs(output_dir, tiles_dir, names):
+    """Move the outputs of the built names into the tiles directory, each with an atomic rename.
+
+    A built name's served files that this build did not produce, such as GeoJSON no
+    longer kept or the snapshot of a build that was not incremental, are removed.
+    The updated file is rewritten so the server notices.
+    """
+    for name in names:
+        for suffix in SWAPPED_SUFFIXES:
+            path = Path(output_dir) / f"{name}{suffix}"
+            if path.is_file():
+                os.replace(path, Path(tiles_dir) / path.name)
+            else:
+                (Path(tiles_dir) / path.name).unlink(missing_ok=True)
+    temporary_path = Path(tiles_dir) / ".updated.tmp"
+    temporary_path.write_text(f"{int(time.time())}\n")
+    os.replace(temporary_path, Path(tiles_dir) / "updated")
+
+
+def build_database(event, tiles_dir, work_dir, env=None, build_command=None):
+    """Download, build and swap in the tiles for an event's database while holding its lock.
+
+    With STACK_BUILD the tiles stack is then rebuilt from the served tiles. Returns the
+    build status: built, partial, unchanged or failed, or locked when another build
+    held the database's lock for too long. A build whose stack could not be rebuilt
+    is partial.
+    """
+    env = dict(os.environ if env is None else env)
+    event_id = event.get("event_id")
+    env["EVENT_ID"] = str(event_id)
+    database = get_event_database(event)
+    build_command = build_command or [sys.executable, str(BUILD_TILES_PATH)]
+    tiles_dir = Path(tiles_dir).resolve()
+    work_dir = Path(work_dir).resolve()
+    output_dir = tiles_dir / "temporary" / database
+    entity_path = work_dir / f"{database}.sqlite3"
+    resume = env.get("RESUME_BUILD", "false") == "true"
+
+    log(event_id, f"waiting for lock-{database}")
+    lock_file = acquire_lock(tiles_dir / f"lock-{database}")
+    if lock_file is None:
+        log(event_id, f"lock-{database} is still held, giving up")
+        return "locked"
+    try:
+        if not resume:
+            shutil.rmtree(output_dir, ignore_errors=True)
+        output_dir.mkdir(parents=True, exist_ok=True)
+
+        log(event_id, f"downloading {database}")
+        if not download_database(event, entity_path, keep_unchanged=resume):
+            log(event_id, f"{database} unchanged since it was downloaded, keeping it")
+
+        log(event_id, "building tiles")
+        metrics_path = tiles_dir / "dataset" / "hashes" / f"{database}.metrics.json"
+        metrics_path.unlink(missing_ok=True)
+        args = get_build_args(entity_path, output_dir, tiles_dir, env)
+        result = subprocess.run(build_command + args, env=env, cwd=work_dir)
+        report = read_build_report(metrics_path) or {}
+        status = report.get("status")
+        # build_tiles.py exits 1 when there is nothing to build, as build.sh expected
+        if status is None or (result.returncode != 0 and status != "unchanged"):
+            status = "failed"
+        log(event_id, f"build {status}")
+
+        if status in ("built", "partial"):
+            swap_outputs(output_dir, tiles_dir, get_built_outputs(report))
+            log(event_id, "tile files swapped out")
+            if env.get("STACK_BUILD", "false") == "true" and not build_stack(
+                entity_path, tiles_dir, env, build_command
+            ):
+                status = "partial"
+        if status != "failed":
+            shutil.rmtree(output_dir, ignore_errors=True)
+        return status
+    finally:
+        lock_file.close()
+
+
+def process_queue(
+    queue_dir,
+    tiles_dir,
+    work_dir,
+    max_builds=1,
+    watch=False,
+    poll_interval=10,
+    env=None,
+    build_command=None,
+):
+    """Build the databases of queued events, up to max_builds of them at once.
+
+    Events are claimed one database at a time, and a database is never built twice
+    at once by this process, so events that arrive during its build are coalesced
+    into one more build afterwards. Failed events are moved to the failed directory.
+    Returns when the queue is empty, or keeps polling it when watch is set.
+    """
+    queue_dir = Path(queue_dir)
+    # future: (database, claimed event path)
+    running = {}
+    results = {}
+    with ThreadPoolExecutor(max_workers=max_builds) as executor:
+        while True:
+            for database, queued in read_queued_events(queue_dir).items():
+                if len(running) >= max_builds:
+                    break
+                if database in (d for d, _ in running.values()):
+                    continue
+                if database in IGNORED_DATABASES:
+                    for path, event in queued:
+                        log(event.get("event_id"), f"wrong database {database}, skipping")
+                        path.unlink(missing_ok=True)
+                    continue
+                claimed = claim_database_events(queue_dir, queued)
+                if claimed is None:
+                    continue
+                event_path, event = claimed
+                future = executor.submit(
+                    build_database, event, tiles_dir, work_dir, env, build_command
+                )
+                running[future] = (database, event_path)
+
+            if not running:
+                if not watch:
+                    return results
+                time.sleep(poll_interval)
+                continue
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                database, event_path = running.pop(future)
+                try:
+                    status = future.result()
+                except Exception as exc:
+                    print(f"ERROR building {database}: {exc}", flush=True)
+                    status = "failed"
+                results[database] = status
+                if status == "failed":
+                    move_event(event_path, queue_dir / FAILED_DIR)
+                elif status == "locked":
+                    move_event(event_path, queue_dir)
+                else:
+                    event_path.unlink(missing_ok=True)
+
+
+@click.command()
+@click.option(
+    "--queue-dir",
+    type=click.Path(file_okay=False),
+    default="/mnt/tiles/queue",
+    show_default=True,
+    help="Directory of queued events, one JSON file each with an event_id and an s3_object_arn or local path",
+)
+@click.option("--tiles-dir", type=click.Path(file_okay=False), default="/mnt/tiles", show_default=True)
+@click.option(
+    "--work-dir",
+    type=click.Path(file_okay=False),
+    default=".",
+    show_default=True,
+    help="Directory the databases are downloaded to",
+)
+@click.option(
+    "--max-builds",
+    type=click.IntRange(min=1),
+    default=lambda: int(os.getenv("MAX_BUILDS", "1")),
+    show_default="MAX_BUILDS or 1",
+    help="Databases built at the same time",
+)
+@click.option("--watch", is_flag=True, default=False, help="Keep polling the queue once it is empty")
+@click.option("--poll-interval", type=click.IntRange(min=1), default=10, show_default=True)
+def main(queue_dir, tiles_dir, work_dir, max_builds, watch, poll_interval):
+    """Queue the task's S3 event, if it has one, then build every queued database."""
+    if os.getenv("S3_OBJECT_ARN"):
+        event = {"event_id": os.getenv("EVENT_ID"), "s3_object_arn": os.getenv("S3_OBJECT_ARN")}
+        try:
+            get_event_database(event)
+        except ValueError as exc:
+            log(event["event_id"], f"{exc}, skipping")
+            sys.exit(1)
+        enqueue_event(queue_dir, event)
+    results = process_queue(queue_dir, tiles_dir, work_dir, max_builds, watch, poll_interval)
+    print(f"build results: {results}", flush=True)
+    if "failed" in results.values():
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
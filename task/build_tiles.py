@@ -1,230 +1,1945 @@
+import gzip
 import json
 import os
-import geojson
-import shapely.wkt
-from select import select
+import numpy as np
+import operator
+import shapely
+import resource
+import signal
 import sqlite3
+import shutil
+import struct
 import subprocess
+import tempfile
+import threading
 from pathlib import Path
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from collections import namedtuple
 from contextlib import contextmanager
 import datetime
+import time
+import functools
 import hashlib
+import itertools
 import click
+import xxhash
 
 LOG_INIT = f"{os.getenv('EVENT_ID')}:"
+WRITE_BUFFER_SIZE = 1024 * 1024
+METRICS_SCHEMA_VERSION = 1
+CHECKPOINT_SCHEMA_VERSION = 1
+# Hidden so that build_queue.py moving the built tiles into place leaves it behind
+CHECKPOINT_NAME = ".checkpoint.json"
+HASH_CHUNK_SIZE = 8 * 1024 * 1024
+HASH_ALGORITHMS = ["md5", "sha256", "blake2b", "xxh3_128"]
+MIN_ZOOM = 4
+MAX_ZOOM = 15
+MAX_LATITUDE = 85.0511287798
+# tippecanoe's default buffer of 5 pixels around each 256 pixel tile
+TILE_BUFFER = 5 / 256
+SNAPSHOT_SUFFIX = ".snapshot.sqlite3"
+# Above these an incremental build falls back to rebuilding the whole dataset
+INCREMENTAL_MAX_CHANGE_RATIO = 0.05
+INCREMENTAL_MAX_TILES = 100000
+DEFAULT_TIPPECANOE_PROFILES_PATH = Path(__file__).parent / "tippecanoe_profiles.json"
+# Rough ratio of tippecanoe peak memory to the size of the GeoJSON it is given
+TIPPECANOE_MEMORY_FACTOR = 3
+SQLITE_MMAP_SIZE = 2 * 1024 * 1024 * 1024
+CGROUP_DIR = Path("/sys/fs/cgroup")
+# (limit, usage) files of the cgroup v2 and v1 memory controllers
+CGROUP_MEMORY_FILES = [
+    ("memory.max", "memory.current"),
+    ("memory/memory.limit_in_bytes", "memory/memory.usage_in_bytes"),
+]
+SQLITE_CACHE_SIZE = 256 * 1024 * 1024
 
 
-@contextmanager
-def pipe():
-    r, w = os.pipe()
-    yield r, w
-    os.close(r)
-    os.close(w)
+RunResult = namedtuple("RunResult", ["returncode", "wall_time", "cpu_time", "max_rss"])
+
+
+def feed_stdin(proc, lines, pre_log, errors):
+    """Write lines to the process's stdin, then close it.
+
+    If producing the lines fails, the process group is killed before its input is
+    closed, so that it never finishes on truncated input, and the error is appended
+    to errors.
+    """
+    try:
+        for line in lines:
+            proc.stdin.write(line)
+            proc.stdin.write("\n")
+    except BrokenPipeError:
+        print(f"{pre_log} process closed its input early", flush=True)
+    except Exception as exc:
+        print(f"{pre_log} ERROR producing input, killing: {exc}", flush=True)
+        errors.append(exc)
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+    finally:
+        try:
+            proc.stdin.close()
+        except BrokenPipeError:
+            pass
+
+
+def kill_process_group(proc, pre_log, timeout):
+    print(f"{pre_log} timed out after {timeout}s, killing", flush=True)
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def run(command, pre_log, input_lines=None, timeout=None):
+    """Run a shell command, printing its output line by line as it arrives.
+
+    The command runs in its own process group so that a timeout kills the whole
+    pipeline. Returns the exit code with the wall time, CPU time and peak RSS
+    (in kilobytes) of the command, taken from its rusage when it is reaped. The
+    exit code is never 0 if input_lines raised an error.
+    """
+    started = time.perf_counter()
+    proc = subprocess.Popen(
+        command,
+        shell=True,
+        stdin=subprocess.PIPE if input_lines is not None else None,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        bufsize=WRITE_BUFFER_SIZE,
+        encoding="utf-8",
+        errors="replace",
+        start_new_session=True,
+    )
+    feeder = None
+    feed_errors = []
+    if input_lines is not None:
+        feeder = threading.Thread(
+            target=feed_stdin, args=(proc, input_lines, pre_log, feed_errors), daemon=True
+        )
+        feeder.start()
+    timer = None
+    if timeout:
+        timer = threading.Timer(timeout, kill_process_group, (proc, pre_log, timeout))
+        timer.daemon = True
+        timer.start()
+
+    try:
+        for line in proc.stdout:
+            if line.strip() != "":
+                print(f"{pre_log} {line}", end="", flush=True)
+        proc.stdout.close()
+        _, status, rusage = os.wait4(proc.pid, 0)
+    finally:
+        if timer is not None:
+            timer.cancel()
+    if feeder is not None:
+        feeder.join()
+
+    proc.returncode = (
+        -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+    )
+    if feed_errors and proc.returncode == 0:
+        proc.returncode = 1
+    return RunResult(
+        returncode=proc.returncode,
+        wall_time=time.perf_counter() - started,
+        cpu_time=rusage.ru_utime + rusage.ru_stime,
+        max_rss=rusage.ru_maxrss,
+    )
+
+
+def get_geography_datasets(entity_model_path):
+    if not Path(entity_model_path).is_file():
+        return None
+
+    conn = connect_read_only(entity_model_path)
+    try:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT
+                DISTINCT dataset
+            FROM
+                entity
+            WHERE
+                (geometry != '') OR (point != '')
+            """
+        )
+        geography_datasets = [x[0] for x in cur]
+    finally:
+        conn.close()
+    return geography_datasets
+
+
+GEOJSON_COORDINATE_PRECISION = 6
+WKT_BATCH_SIZE = 10000
+# Geometries per batch also written uncompacted, to estimate what compaction saves
+COMPACTION_SAMPLE_SIZE = 100
+
+
+def compact_geometries(geometries, precision):
+    """Repair invalid geometries and snap coordinates to a grid of the given decimal precision.
+
+    Snapping also drops consecutive vertices that become duplicates. Geometries
+    that collapse to nothing are returned as None.
+    """
+    invalid = ~shapely.is_valid(geometries) & ~shapely.is_missing(geometries)
+    if invalid.any():
+        geometries[invalid] = shapely.make_valid(geometries[invalid])
+    geometries = shapely.set_precision(geometries, 10.0**-precision)
+    geometries[shapely.is_empty(geometries)] = None
+    return geometries
+
+
+def round_coordinates(geometries, precision):
+    """Round the coordinates of geometries to precision decimal places, keeping any Z values."""
+    has_z = shapely.has_z(geometries)
+    for include_z in (False, True):
+        selected = has_z == include_z
+        if selected.any():
+            geometries[selected] = shapely.transform(
+                geometries[selected], lambda coords: np.round(coords, precision), include_z=include_z
+            )
+    return geometries
+
+
+def to_geojson_geometries(geometries, precision):
+    """Write geometries as GeoJSON geometry strings, with empty ones as None.
+
+    shapely.to_geojson leaves out Z values before GEOS 3.12, so geometries with
+    them are written from their __geo_interface__ instead.
+    """
+    geometries[shapely.is_empty(geometries)] = None
+    geometries = round_coordinates(geometries, precision)
+    geojsons = shapely.to_geojson(geometries)
+    for index in np.flatnonzero(shapely.has_z(geometries)):
+        geojsons[index] = json.dumps(geometries[index].__geo_interface__, separators=(",", ":"))
+    return geojsons
+
+
+def new_compaction_sizes():
+    return {"uncompacted": 0, "compacted": 0}
+
+
+def wkt_to_geojson_features(wkts, compact_precision=None, compaction_sizes=None):
+    """Convert a sequence of WKT strings into GeoJSON Feature strings in one vectorized pass.
+
+    Coordinates are rounded to the same precision the geojson library used to apply,
+    or compacted to compact_precision decimal places when it is given.
+    Entries that are empty or cannot be parsed are returned as None. When compacting,
+    the bytes of GeoJSON geometry written with and without compaction for the first
+    COMPACTION_SAMPLE_SIZE geometries are added to compaction_sizes if it is given.
+    """
+    geometries = shapely.from_wkt(np.array(wkts, dtype=object), on_invalid="warn")
+    if compact_precision is None:
+        geojsons = to_geojson_geometries(geometries, GEOJSON_COORDINATE_PRECISION)
+    else:
+        if compaction_sizes is not None:
+            compaction_sizes["uncompacted"] += sum(
+                len(geojson)
+                for geojson in to_geojson_geometries(
+                    geometries[:COMPACTION_SAMPLE_SIZE].copy(), GEOJSON_COORDINATE_PRECISION
+                )
+                if geojson is not None
+            )
+        geojsons = to_geojson_geometries(compact_geometries(geometries, compact_precision), compact_precision)
+        if compaction_sizes is not None:
+            compaction_sizes["compacted"] += sum(
+                len(geojson) for geojson in geojsons[:COMPACTION_SAMPLE_SIZE] if geojson is not None
+            )
+    return [
+        None if geometry is None else '{"type": "Feature", "geometry": ' + geometry + "}"
+        for geometry in geojsons
+    ]
+
+
+def report_compaction(label, compaction_sizes):
+    uncompacted = compaction_sizes["uncompacted"]
+    compacted = compaction_sizes["compacted"]
+    print(
+        f"{LOG_INIT} {label} compaction cut a sample of {uncompacted} bytes of GeoJSON geometry to "
+        f"{compacted} bytes ({compacted / max(uncompacted, 1):.0%})",
+        flush=True,
+    )
+
+
+def get_rowid_ranges(conn, size):
+    """Split the entity table into inclusive rowid ranges of up to size rows each.
+
+    Streams the rowids rather than loading them, only keeping each range's first
+    and the previous one.
+    """
+    ranges = []
+    first = last = None
+    for index, (rowid,) in enumerate(conn.execute("SELECT rowid FROM entity ORDER BY rowid")):
+        if index % size == 0:
+            if first is not None:
+                ranges.append((first, last))
+            first = rowid
+        last = rowid
+    if first is not None:
+        ranges.append((first, last))
+    return ranges
+
+
+def convert_wkt_range(entity_model_path, first, last, datasets=None, compact_precision=None):
+    """Convert the WKT of the geography entities with rowids from first to last.
+
+    Reads through its own connection, so that it can run in another process while
+    the table is being written. Returns the (feature, rowid) updates to apply, the
+    entity ids that had no usable geometry, and the compaction sizes of the range.
+    """
+    conn = connect_read_only(entity_model_path, immutable=False)
+    try:
+        query = """
+            SELECT      rowid,
+                        entity,
+                        point,
+                        geometry
+            FROM        entity
+            WHERE       rowid BETWEEN ? AND ?
+            AND         (geometry != '' OR point != '')
+            """
+        params = (first, last)
+        if datasets is not None:
+            query += f"AND dataset IN ({','.join('?' for _ in datasets)})"
+            params += tuple(datasets)
+        rows = conn.execute(query, params).fetchall()
+    finally:
+        conn.close()
+
+    wkts = [row[3] or row[2] or None for row in rows]
+    compaction_sizes = new_compaction_sizes()
+    features = wkt_to_geojson_features(wkts, compact_precision, compaction_sizes)
+    updates = []
+    missing = []
+    for row, feature in zip(rows, features):
+        if feature is None:
+            missing.append(row[1])
+        else:
+            updates.append((feature, row[0]))
+    return updates, missing, compaction_sizes
+
+
+def iter_wkt_conversions(entity_model_path, ranges, datasets=None, compact_precision=None, jobs=1):
+    """Yield the result of convert_wkt_range for each rowid range as it completes.
+
+    With more than one job the ranges are converted in a process pool, with at most
+    two ranges per job in flight so finished results never pile up waiting.
+    """
+    if jobs <= 1:
+        for first, last in ranges:
+            yield convert_wkt_range(entity_model_path, first, last, datasets, compact_precision)
+        return
+
+    pending = iter(ranges)
+    running = set()
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        while True:
+            for first, last in itertools.islice(pending, 2 * jobs - len(running)):
+                running.add(
+                    executor.submit(
+                        convert_wkt_range,
+                        entity_model_path,
+                        first,
+                        last,
+                        datasets,
+                        compact_precision,
+                    )
+                )
+            if not running:
+                return
+            done, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+
+def create_geojson_from_wkt(entity_model_path, datasets=None, compact_precision=None, jobs=1):
+    """Fill the geojson column of every geography entity from its WKT.
+
+    The table is split into rowid ranges of WKT_BATCH_SIZE rows which are parsed by
+    up to jobs processes, while this process is the only writer. Each range is
+    written with one executemany, all inside a single transaction committed at the
+    end, so a failed conversion leaves the table as it was. Returns whether the
+    conversion ran without SQLite errors.
+    """
+    no_errors = False
+    current_time = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+    print(
+        f"{current_time}: {LOG_INIT} started creating geojson for {entity_model_path}",
+        flush=True,
+    )
+    conn = connect_writable(entity_model_path)
+    started = time.perf_counter()
+    row_count = 0
+    compaction_sizes = new_compaction_sizes()
+
+    try:
+        ranges = get_rowid_ranges(conn, WKT_BATCH_SIZE)
+        for updates, missing, range_compaction_sizes in iter_wkt_conversions(
+            entity_model_path, ranges, datasets, compact_precision, jobs
+        ):
+            for entity_id in missing:
+                print(
+                    f"{LOG_INIT} ERROR in create_geojson_from_wkt - No data for entity_id: {entity_id})"
+                )
+            conn.executemany(
+                """
+                UPDATE  entity
+                SET     geojson = ?
+                WHERE   rowid = ?
+                """,
+                updates,
+            )
+            row_count += len(updates) + len(missing)
+            for key, size in range_compaction_sizes.items():
+                compaction_sizes[key] += size
+        conn.commit()
+        no_errors = True
+
+    except sqlite3.Error as exc:
+        print(
+            f"{LOG_INIT} ERROR in create_geojson_from_wkt for {entity_model_path}: {exc}"
+        )
+    finally:
+        close_writable(conn)
+        elapsed = time.perf_counter() - started
+        rate = row_count / elapsed if elapsed > 0 else 0
+        print(
+            f"{LOG_INIT} finished processing create_geojson_from_wkt for {entity_model_path}: "
+            f"{row_count} rows in {elapsed:.2f}s ({rate:.0f} rows/s) with {jobs} jobs",
+            flush=True,
+        )
+        if compact_precision is not None:
+            report_compaction(f"[{entity_model_path}]", compaction_sizes)
+        return no_errors
+
+
+FEATURE_PROPERTIES = [
+    "'tippecanoe'",
+    "json_object('layer', entity.dataset)",
+    "'entity'",
+    "entity.entity",
+    "'properties'",
+    "json_patch(" "json_object(" "'name'",
+    "entity.name",
+    "'dataset'",
+    "entity.dataset",
+    "'organisation-entity'",
+    "entity.organisation_entity",
+    "'entity'",
+    "entity.entity",
+    "'entry-date'",
+    "entity.entry_date",
+    "'start-date'",
+    "entity.start_date",
+    "'end-date'",
+    "entity.end_date",
+    "'prefix'",
+    "entity.prefix",
+    "'reference'",
+    "entity.reference" ")",
+    "IFNULL(entity.json, '{}')" ")",
+]
+
+
+def iter_dataset_features(entity_model_path, dataset=None, entities=None):
+    """Yield each tippecanoe feature of a dataset as a JSON string, one row at a time.
+
+    When entities is given only the features of those entity ids are yielded.
+    """
+    conn = connect_read_only(entity_model_path)
+    query = """
+        SELECT
+            json_patch(entity.geojson,
+            json_object({properties}))
+        FROM
+            entity
+        WHERE NOT EXISTS (
+            SELECT * FROM old_entity
+                WHERE entity.entity = old_entity.old_entity
+        )
+        AND entity.geojson != ''
+        """.format(
+        properties=",".join(FEATURE_PROPERTIES)
+    )
+
+    params = []
+    if dataset:
+        query += "AND entity.dataset == ? "
+        params.append(dataset)
+    if entities is not None:
+        query += "AND entity.entity IN (SELECT value FROM json_each(?)) "
+        params.append(json.dumps(list(entities)))
+
+    cur = conn.cursor()
+    try:
+        cur.execute(query, params)
+
+        for row in cur:
+            yield row[0]
+    finally:
+        cur.close()
+        conn.close()
+
+
+def tune_connection(conn):
+    conn.execute(f"PRAGMA mmap_size = {SQLITE_MMAP_SIZE}")
+    conn.execute(f"PRAGMA cache_size = -{SQLITE_CACHE_SIZE // 1024}")
+    return conn
+
+
+def connect_read_only(path, immutable=True):
+    """Open a SQLite file as immutable so nothing is locked, journalled or written.
+
+    Reads are served from a large memory map and page cache. The file must not
+    change while the connection is open, unless immutable is False, which reads
+    consistent snapshots of a file being written through connect_writable.
+    """
+    uri = f"{Path(path).resolve().as_uri()}?mode=ro"
+    if immutable:
+        uri += "&immutable=1"
+    return tune_connection(sqlite3.connect(uri, uri=True))
+
+
+def connect_writable(path):
+    """Open a SQLite file the task owns for writing, trading durability for speed.
+
+    Everything written is a disposable copy or output that a failed run rebuilds,
+    so the WAL journal is never synced. Close the connection with close_writable.
+    """
+    conn = tune_connection(sqlite3.connect(path))
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = OFF")
+    return conn
+
+
+def close_writable(conn):
+    """Close a connection from connect_writable, rolling back anything uncommitted.
+
+    The journal is switched back from WAL first, which checkpoints it, so the file
+    is left self-contained for the immutable connections that read it next.
+    """
+    try:
+        conn.rollback()
+        conn.execute("PRAGMA journal_mode = DELETE")
+    finally:
+        conn.close()
+
+
+def ensure_dataset_index(entity_model_path):
+    """Index the entity table by dataset unless an index already leads with it.
+
+    Worth it for databases with several datasets, where each dataset's queries
+    would otherwise scan the whole table.
+    """
+    conn = connect_writable(entity_model_path)
+    try:
+        for index in conn.execute("PRAGMA index_list(entity)").fetchall():
+            columns = conn.execute(f"PRAGMA index_info('{index[1]}')").fetchall()
+            if columns and columns[0][2] == "dataset":
+                return
+        print(f"{LOG_INIT} creating an index on entity(dataset)", flush=True)
+        conn.execute("CREATE INDEX entity_dataset_index ON entity(dataset)")
+        conn.commit()
+    finally:
+        close_writable(conn)
+
+
+def iter_dataset_features_from_wkt(
+    entity_model_path, dataset=None, entities=None, compact_precision=None
+):
+    """Yield each tippecanoe feature of a dataset, converting its WKT as it is read.
+
+    This is the read-only counterpart of create_geojson_from_wkt followed by
+    iter_dataset_features: the database is opened immutable and the geojson
+    column is never written or read.
+    """
+    conn = connect_read_only(entity_model_path)
+    query = """
+        SELECT
+            entity.entity,
+            COALESCE(NULLIF(entity.geometry, ''), NULLIF(entity.point, '')),
+            json_patch('{{}}', json_object({properties}))
+        FROM
+            entity
+        WHERE NOT EXISTS (
+            SELECT * FROM old_entity
+                WHERE entity.entity = old_entity.old_entity
+        )
+        AND (entity.geometry != '' OR entity.point != '')
+        """.format(
+        properties=",".join(FEATURE_PROPERTIES)
+    )
+
+    params = []
+    if dataset:
+        query += "AND entity.dataset == ? "
+        params.append(dataset)
+    if entities is not None:
+        query += "AND entity.entity IN (SELECT value FROM json_each(?)) "
+        params.append(json.dumps(list(entities)))
+
+    compaction_sizes = new_compaction_sizes()
+    cur = conn.cursor()
+    try:
+        cur.execute(query, params)
+
+        while True:
+            rows = cur.fetchmany(WKT_BATCH_SIZE)
+            if not rows:
+                break
+            features = wkt_to_geojson_features([row[1] for row in rows], compact_precision, compaction_sizes)
+            for row, feature in zip(rows, features):
+                if feature is None:
+                    print(
+                        f"{LOG_INIT} ERROR in iter_dataset_features_from_wkt - No data for entity_id: {row[0]})"
+                    )
+                    continue
+                yield feature[:-1] + ", " + row[2][1:]
+        if compact_precision is not None:
+            report_compaction(f"[{dataset}]", compaction_sizes)
+    finally:
+        cur.close()
+        conn.close()
+
+
+def get_feature_iterator(
+    entity_model_path, dataset, read_only=False, entities=None, compact_precision=None
+):
+    if read_only:
+        return iter_dataset_features_from_wkt(
+            entity_model_path, dataset, entities, compact_precision
+        )
+    return iter_dataset_features(entity_model_path, dataset, entities)
+
+
+def get_dataset_features(entity_model_path, dataset=None):
+    results = ",".join(iter_dataset_features(entity_model_path, dataset))
+    results = results.rstrip(",")
+
+    return results
+
+
+def create_geojson_file(features, output_path, dataset):
+    current_time = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+    print(f"{current_time}: started creating geojson file")
+    geojson = '{"type":"FeatureCollection","features":[' + features + "]}"
+    with open(f"{output_path}/{dataset}.geojson", "w") as f:
+        f.write(geojson)
+    print(f"{LOG_INIT} [{dataset}] created geojson", flush=True)
+
+
+def write_dataset_features(
+    entity_model_path, output_path, dataset, read_only=False, compact_precision=None
+):
+    """Stream a dataset's features to {dataset}.geojson as newline-delimited GeoJSON.
+
+    Features are written as they come off the cursor through a fixed-size buffer,
+    so memory use does not grow with the size of the dataset.
+    """
+    current_time = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+    print(f"{current_time}: started streaming geojson file")
+    feature_count = 0
+    with open(
+        f"{output_path}/{dataset}.geojson", "w", buffering=WRITE_BUFFER_SIZE
+    ) as f:
+        for feature in get_feature_iterator(
+            entity_model_path, dataset, read_only, compact_precision=compact_precision
+        ):
+            f.write(feature)
+            f.write("\n")
+            feature_count += 1
+    print(
+        f"{LOG_INIT} [{dataset}] created geojson with {feature_count} features",
+        flush=True,
+    )
+    return feature_count
+
+
+def iter_all_features(entity_model_path, read_only=False, compact_precision=None):
+    """Yield (dataset, entity, feature) for every geography entity in a single table scan.
+
+    Unlike iter_dataset_features, entities replaced in old_entity are not filtered out.
+    """
+    conn = connect_read_only(entity_model_path)
+    if read_only:
+        query = """
+            SELECT
+                entity.dataset,
+                entity.entity,
+                COALESCE(NULLIF(entity.geometry, ''), NULLIF(entity.point, '')),
+                json_patch('{{}}', json_object({properties}))
+            FROM
+                entity
+            WHERE entity.geometry != '' OR entity.point != ''
+            """
+    else:
+        query = """
+            SELECT
+                entity.dataset,
+                entity.entity,
+                NULL,
+                json_patch(entity.geojson, json_object({properties}))
+            FROM
+                entity
+            WHERE entity.geojson != ''
+            """
+
+    compaction_sizes = new_compaction_sizes()
+    cur = conn.cursor()
+    try:
+        cur.execute(query.format(properties=",".join(FEATURE_PROPERTIES)))
+        while True:
+            rows = cur.fetchmany(WKT_BATCH_SIZE)
+            if not rows:
+                break
+            if not read_only:
+                for row in rows:
+                    yield row[0], row[1], row[3]
+                continue
+            features = wkt_to_geojson_features([row[2] for row in rows], compact_precision, compaction_sizes)
+            for row, feature in zip(rows, features):
+                if feature is None:
+                    print(
+                        f"{LOG_INIT} ERROR in iter_all_features - No data for entity_id: {row[1]})"
+                    )
+                    continue
+                yield row[0], row[1], feature[:-1] + ", " + row[3][1:]
+        if read_only and compact_precision is not None:
+            report_compaction("[all datasets]", compaction_sizes)
+    finally:
+        cur.close()
+        conn.close()
+
+
+def get_old_entities(entity_model_path):
+    conn = connect_read_only(entity_model_path)
+    try:
+        old_entities = set()
+        for (old_entity,) in conn.execute("SELECT old_entity FROM old_entity"):
+            try:
+                old_entities.add(int(old_entity))
+            except (TypeError, ValueError):
+                continue
+        return old_entities
+    finally:
+        conn.close()
+
+
+def export_all_dataset_features(
+    entity_model_path, output_path, datasets, read_only=False, compact_precision=None
+):
+    """Write {dataset}.geojson for every dataset from one scan of the entity table.
+
+    Each feature is routed to its dataset's newline-delimited file as it is read,
+    and replaced entities are excluded using the old_entity ids loaded up front,
+    so the cost grows with the number of rows rather than rows times datasets.
+    """
+    current_time = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+    print(f"{current_time}: started exporting geojson files for {len(datasets)} datasets")
+    old_entities = get_old_entities(entity_model_path)
+    feature_counts = {d: 0 for d in datasets}
+    files = {}
+    try:
+        for d in datasets:
+            files[d] = open(f"{output_path}/{d}.geojson", "w", buffering=WRITE_BUFFER_SIZE)
+        for dataset, entity, feature in iter_all_features(
+            entity_model_path, read_only, compact_precision
+        ):
+            f = files.get(dataset)
+            if f is None or entity in old_entities:
+                continue
+            f.write(feature)
+            f.write("\n")
+            feature_counts[dataset] += 1
+    finally:
+        for f in files.values():
+            f.close()
+    for d in datasets:
+        print(
+            f"{LOG_INIT} [{d}] created geojson with {feature_counts[d]} features",
+            flush=True,
+        )
+    return feature_counts
+
+
+def tippecanoe_zoom_args(min_zoom=MIN_ZOOM, max_zoom=MAX_ZOOM):
+    return [f"-z{max_zoom}", f"-Z{min_zoom}", "-r1", "--no-feature-limit", "--no-tile-size-limit"]
+
+
+DEFAULT_TIPPECANOE_PROFILE = {"args": tippecanoe_zoom_args(), "patchable": True}
+PROFILE_RULE_CONDITIONS = {
+    "min_features": ("features", operator.ge),
+    "max_features": ("features", operator.le),
+    "min_point_ratio": ("point_ratio", operator.ge),
+    "max_point_ratio": ("point_ratio", operator.le),
+    "min_extent": ("extent", operator.ge),
+    "max_extent": ("extent", operator.le),
+}
+
+
+def tippecanoe_command(dataset, output_file, input_file=None, args=None):
+    if args is None:
+        args = DEFAULT_TIPPECANOE_PROFILE["args"]
+    command = (
+        f"tippecanoe --no-progress-indicator {' '.join(args)} "
+        f"--layer={dataset} --output={output_file} "
+    )
+    if input_file is not None:
+        command += f"{input_file} "
+    return command
+
+
+def load_tippecanoe_profiles(profiles_path):
+    """Load the tippecanoe profile config, falling back to the default profile alone.
+
+    The config maps profile names to tippecanoe arguments, lists rules choosing a
+    profile from a dataset's stats (first match wins) and pins datasets to profiles.
+    """
+    config = {}
+    if profiles_path is not None and Path(profiles_path).is_file():
+        with open(profiles_path) as file:
+            config = json.load(file)
+    config.setdefault("profiles", {}).setdefault("default", DEFAULT_TIPPECANOE_PROFILE)
+    config.setdefault("rules", [])
+    config.setdefault("datasets", {})
+
+    referenced = [rule["profile"] for rule in config["rules"]] + list(
+        config["datasets"].values()
+    )
+    unknown = [name for name in referenced if name not in config["profiles"]]
+    if unknown:
+        raise ValueError(f"unknown tippecanoe profiles {','.join(unknown)} in {profiles_path}")
+    for rule in config["rules"]:
+        unsupported = [
+            key for key in rule if key != "profile" and key not in PROFILE_RULE_CONDITIONS
+        ]
+        if unsupported:
+            raise ValueError(
+                f"unsupported profile rule conditions {','.join(unsupported)} in {profiles_path}"
+            )
+    return config
+
+
+def profiles_use_extent(profiles):
+    return any(
+        PROFILE_RULE_CONDITIONS[key][0] == "extent"
+        for rule in profiles["rules"]
+        for key in rule
+        if key in PROFILE_RULE_CONDITIONS
+    )
+
+
+def get_dataset_stats(entity_model_path, dataset, extent=True):
+    """Return the feature count, share of point features and extent in square degrees of a dataset.
+
+    The count and point share come from a single SQL aggregate. Finding the extent
+    parses every geometry, so it is left as None unless extent is set.
+    """
+    conn = connect_read_only(entity_model_path)
+    where = """
+        WHERE NOT EXISTS (
+            SELECT * FROM old_entity
+                WHERE entity.entity = old_entity.old_entity
+        )
+        AND (entity.geometry != '' OR entity.point != '')
+        AND entity.dataset == ?
+        """
+    bounds = None
+    cur = conn.cursor()
+    try:
+        features, points = cur.execute(
+            f"""
+            SELECT
+                COUNT(*),
+                TOTAL(entity.geometry = '' OR entity.geometry IS NULL)
+            FROM
+                entity
+            {where}
+            """,
+            (dataset,),
+        ).fetchone()
+        if extent:
+            cur.execute(
+                f"""
+                SELECT
+                    COALESCE(NULLIF(entity.point, ''), NULLIF(entity.geometry, ''))
+                FROM
+                    entity
+                {where}
+                """,
+                (dataset,),
+            )
+            while True:
+                rows = cur.fetchmany(WKT_BATCH_SIZE)
+                if not rows:
+                    break
+                batch_bounds = shapely.total_bounds(
+                    shapely.from_wkt(
+                        np.array([row[0] for row in rows], dtype=object), on_invalid="ignore"
+                    )
+                )
+                if np.isnan(batch_bounds[0]):
+                    continue
+                if bounds is None:
+                    bounds = batch_bounds
+                else:
+                    bounds = np.concatenate(
+                        [np.minimum(bounds[:2], batch_bounds[:2]), np.maximum(bounds[2:], batch_bounds[2:])]
+                    )
+    finally:
+        cur.close()
+        conn.close()
+
+    stats = {
+        "features": features,
+        "point_ratio": points / features if features else 0,
+        "extent": None,
+    }
+    if extent:
+        stats["extent"] = (
+            float((bounds[2] - bounds[0]) * (bounds[3] - bounds[1])) if bounds is not None else 0
+        )
+    return stats
+
+
+def select_tippecanoe_profile(profiles, dataset, stats):
+    """Return the name and settings of the profile for a dataset.
+
+    A dataset pinned in the config always gets its profile, otherwise the first
+    rule whose conditions all hold for the dataset's stats is used.
+    """
+    name = profiles["datasets"].get(dataset)
+    if name is None:
+        for rule in profiles["rules"]:
+            if all(
+                compare(stats[stat], rule[key])
+                for key, (stat, compare) in PROFILE_RULE_CONDITIONS.items()
+                if key in rule
+            ):
+                name = rule["profile"]
+                break
+    name = name or "default"
+    return name, profiles["profiles"][name]
+
+
+def build_dataset_tiles(output_path, dataset, features=None, timeout=None, args=None):
+    """Run tippecanoe for a dataset.
+
+    When features is None tippecanoe reads {dataset}.geojson from output_path,
+    otherwise the given feature strings are streamed to its stdin as they are produced.
+    tippecanoe is killed if it runs for longer than timeout seconds. args replaces the
+    default tippecanoe options, as chosen by a profile. Returns tippecanoe's RunResult.
+    """
+    current_time = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+    print(f"{current_time}: Started building tiles - build_dataset_tiles")
+    build_tiles_cmd = tippecanoe_command(
+        dataset,
+        f"{output_path}/{dataset}.mbtiles",
+        f"{output_path}/{dataset}.geojson" if features is None else None,
+        args,
+    )
+    result = run(
+        build_tiles_cmd, f"{LOG_INIT} [{dataset}]", input_lines=features, timeout=timeout
+    )
+    print(
+        f"{LOG_INIT} [{dataset}] tippecanoe wall time: {result.wall_time:.1f}s, "
+        f"cpu time: {result.cpu_time:.1f}s, peak rss: {result.max_rss // 1024}MB",
+        flush=True,
+    )
+    if result.returncode != 0:
+        print(f"{LOG_INIT} [{dataset}] failed to create tiles", flush=True)
+        return result
+    current_time = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+    print(f"{current_time}: {LOG_INIT} [{dataset}] created tiles", flush=True)
+    return result
+
+
+def get_entity_snapshot(entity_model_path, dataset):
+    """Return {entity: (hash, minx, miny, maxx, maxy)} for every exported entity of a dataset.
+
+    The hash covers the entity's geometry and properties, the bounds are those of its geometry.
+    """
+    conn = connect_read_only(entity_model_path)
+    query = """
+        SELECT
+            entity.entity,
+            COALESCE(NULLIF(entity.geometry, ''), NULLIF(entity.point, '')),
+            json_object({properties})
+        FROM
+            entity
+        WHERE NOT EXISTS (
+            SELECT * FROM old_entity
+                WHERE entity.entity = old_entity.old_entity
+        )
+        AND (entity.geometry != '' OR entity.point != '')
+        AND entity.dataset == ?
+        """.format(
+        properties=",".join(FEATURE_PROPERTIES)
+    )
+    snapshot = {}
+    cur = conn.cursor()
+    try:
+        cur.execute(query, (dataset,))
+        while True:
+            rows = cur.fetchmany(WKT_BATCH_SIZE)
+            if not rows:
+                break
+            geometries = shapely.from_wkt(
+                np.array([row[1] for row in rows], dtype=object), on_invalid="ignore"
+            )
+            for row, bounds in zip(rows, shapely.bounds(geometries)):
+                if np.isnan(bounds[0]):
+                    continue
+                digest = hashlib.blake2b(
+                    (row[1] + row[2]).encode("utf-8"), digest_size=16
+                ).hexdigest()
+                snapshot[row[0]] = (digest, *(float(b) for b in bounds))
+    finally:
+        cur.close()
+        conn.close()
+    return snapshot
+
+
+def write_entity_snapshot(snapshot_path, snapshot, options_key=None):
+    temporary_path = Path(f"{snapshot_path}.tmp")
+    temporary_path.unlink(missing_ok=True)
+    conn = connect_writable(temporary_path)
+    try:
+        conn.execute(
+            """
+            CREATE TABLE snapshot (
+                entity INTEGER PRIMARY KEY,
+                hash TEXT,
+                minx REAL,
+                miny REAL,
+                maxx REAL,
+                maxy REAL
+            )
+            """
+        )
+        conn.executemany(
+            "INSERT INTO snapshot VALUES (?, ?, ?, ?, ?, ?)",
+            ((entity, *values) for entity, values in snapshot.items()),
+        )
+        conn.execute("CREATE TABLE metadata (name TEXT PRIMARY KEY, value TEXT)")
+        conn.execute("INSERT INTO metadata VALUES ('options', ?)", (options_key,))
+        conn.commit()
+    finally:
+        close_writable(conn)
+    os.replace(temporary_path, snapshot_path)
+
+
+def read_entity_snapshot(snapshot_path):
+    conn = connect_read_only(snapshot_path)
+    try:
+        return {
+            row[0]: tuple(row[1:])
+            for row in conn.execute(
+                "SELECT entity, hash, minx, miny, maxx, maxy FROM snapshot"
+            )
+        }
+    finally:
+        conn.close()
+
+
+def read_snapshot_options(snapshot_path):
+    """Return the build options key a snapshot's tiles were built with, or None if it has none."""
+    conn = connect_read_only(snapshot_path)
+    try:
+        row = conn.execute("SELECT value FROM metadata WHERE name = 'options'").fetchone()
+        return row[0] if row else None
+    except sqlite3.Error:
+        return None
+    finally:
+        conn.close()
+
+
+def get_changed_bounds(previous, current):
+    """Return the old and new bounds of every entity added, removed or changed between snapshots."""
+    changed = []
+    for entity, values in current.items():
+        previous_values = previous.get(entity)
+        if previous_values is None or previous_values[0] != values[0]:
+            changed.append(values[1:])
+            if previous_values is not None:
+                changed.append(previous_values[1:])
+    for entity, values in previous.items():
+        if entity not in current:
+            changed.append(values[1:])
+    return changed
+
+
+def get_tile_ranges(bounds, zoom):
+    """Return the XYZ tile ranges x0, y0, x1, y1 (inclusive) covered by each lon/lat bounding box.
+
+    Each box is padded by tippecanoe's default tile buffer so that tiles which
+    only hold a buffered copy of a geometry are included too.
+    """
+    bounds = np.asarray(bounds, dtype=float).reshape(-1, 4)
+    n = 2**zoom
+
+    def tile_y(lat):
+        lat = np.radians(np.clip(lat, -MAX_LATITUDE, MAX_LATITUDE))
+        return (1 - np.log(np.tan(lat) + 1 / np.cos(lat)) / np.pi) / 2 * n
+
+    x0 = (bounds[:, 0] + 180) / 360 * n - TILE_BUFFER
+    x1 = (bounds[:, 2] + 180) / 360 * n + TILE_BUFFER
+    y0 = tile_y(bounds[:, 3]) - TILE_BUFFER
+    y1 = tile_y(bounds[:, 1]) + TILE_BUFFER
+    return tuple(
+        np.clip(np.floor(v), 0, n - 1).astype(np.int64) for v in (x0, y0, x1, y1)
+    )
+
+
+def get_affected_tiles(changed_bounds, min_zoom=MIN_ZOOM, max_zoom=MAX_ZOOM, max_tiles=None):
+    """Return {zoom: {(x, y), ...}} of XYZ tiles touched by the changed bounds.
+
+    Returns None when more than max_tiles tiles would be touched.
+    """
+    affected = {}
+    total = 0
+    for zoom in range(min_zoom, max_zoom + 1):
+        tiles = set()
+        for x0, y0, x1, y1 in zip(*get_tile_ranges(changed_bounds, zoom)):
+            total += (x1 - x0 + 1) * (y1 - y0 + 1)
+            if max_tiles is not None and total > max_tiles:
+                return None
+            tiles.update(
+                (x, y) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)
+            )
+        affected[zoom] = tiles
+    return affected
+
+
+def select_entities_touching_tiles(entity_ids, entity_bounds, zoom, tiles):
+    """Return the entity ids whose buffered bounds overlap any of the given tiles at a zoom."""
+    xs = np.array([tile[0] for tile in tiles])
+    ys = np.array([tile[1] for tile in tiles])
+    origin_x, origin_y = xs.min(), ys.min()
+    width, height = xs.max() - origin_x + 1, ys.max() - origin_y + 1
+
+    # Summed-area table of the affected tiles, so each entity's tile range is tested in O(1)
+    grid = np.zeros((height + 1, width + 1), dtype=np.int64)
+    grid[ys - origin_y + 1, xs - origin_x + 1] = 1
+    summed = grid.cumsum(axis=0).cumsum(axis=1)
+
+    x0, y0, x1, y1 = get_tile_ranges(entity_bounds, zoom)
+    cx0 = np.clip(x0 - origin_x, 0, width)
+    cx1 = np.clip(x1 - origin_x + 1, 0, width)
+    cy0 = np.clip(y0 - origin_y, 0, height)
+    cy1 = np.clip(y1 - origin_y + 1, 0, height)
+    counts = summed[cy1, cx1] - summed[cy0, cx1] - summed[cy1, cx0] + summed[cy0, cx0]
+    return entity_ids[counts > 0]
+
+
+def patch_mbtiles(target_path, tiles, source_path=None):
+    """Replace the given XYZ tiles of an mbtiles file with those from source_path.
+
+    Tiles missing from source_path, or all of them when it is None, are removed.
+    """
+    conn = connect_writable(target_path)
+    try:
+        conn.execute(
+            "CREATE TEMP TABLE affected (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER)"
+        )
+        conn.executemany(
+            "INSERT INTO temp.affected VALUES (?, ?, ?)",
+            (
+                (zoom, x, 2**zoom - 1 - y)
+                for zoom, zoom_tiles in tiles.items()
+                for x, y in zoom_tiles
+            ),
+        )
+        conn.execute(
+            """
+            DELETE FROM tiles
+            WHERE (zoom_level, tile_column, tile_row) IN (SELECT * FROM temp.affected)
+            """
+        )
+        if source_path is not None:
+            conn.execute("ATTACH DATABASE ? AS patch", (str(source_path),))
+            conn.execute(
+                """
+                INSERT INTO tiles (zoom_level, tile_column, tile_row, tile_data)
+                SELECT      patch.tiles.zoom_level,
+                            patch.tiles.tile_column,
+                            patch.tiles.tile_row,
+                            patch.tiles.tile_data
+                FROM        patch.tiles
+                JOIN        temp.affected
+                USING       (zoom_level, tile_column, tile_row)
+                """
+            )
+        conn.commit()
+    finally:
+        close_writable(conn)
+
+
+def read_mbtiles_metadata(conn):
+    return dict(conn.execute("SELECT name, value FROM metadata"))
+
+
+def write_mbtiles_metadata(conn, updates):
+    conn.executemany("DELETE FROM metadata WHERE name = ?", ((name,) for name in updates))
+    conn.executemany("INSERT INTO metadata (name, value) VALUES (?, ?)", updates.items())
+
+
+def merge_vector_layer_fields(target_path, source_path):
+    """Add the fields of source_path's vector layers to those in target_path's metadata.
+
+    A patch run can bring properties the previous build never saw, which the
+    vector_layers would otherwise leave out. The tilestats are left describing the
+    previous full build.
+    """
+    source = connect_read_only(source_path)
+    try:
+        source_json = read_mbtiles_metadata(source).get("json")
+    finally:
+        source.close()
+    conn = connect_writable(target_path)
+    try:
+        target_json = read_mbtiles_metadata(conn).get("json")
+        if not source_json or not target_json:
+            return
+        layers_json = json.loads(target_json)
+        layers = layers_json.setdefault("vector_layers", [])
+        layers_by_id = {layer["id"]: layer for layer in layers}
+        for layer in json.loads(source_json).get("vector_layers", []):
+            if layer["id"] not in layers_by_id:
+                layers.append(layer)
+                continue
+            fields = layers_by_id[layer["id"]].setdefault("fields", {})
+            for name, field_type in layer.get("fields", {}).items():
+                fields.setdefault(name, field_type)
+        write_mbtiles_metadata(conn, {"json": json.dumps(layers_json)})
+        conn.commit()
+    finally:
+        close_writable(conn)
+
+
+def set_mbtiles_bounds(target_path, bounds):
+    """Set the bounds of an mbtiles to (minx, miny, maxx, maxy), re-centring its center."""
+    conn = connect_writable(target_path)
+    try:
+        center = read_mbtiles_metadata(conn).get("center", "").split(",")
+        zoom = f",{center[2]}" if len(center) == 3 else ""
+        write_mbtiles_metadata(
+            conn,
+            {
+                "bounds": ",".join(f"{b:.6f}" for b in bounds),
+                "center": f"{(bounds[0] + bounds[2]) / 2:.6f},{(bounds[1] + bounds[3]) / 2:.6f}{zoom}",
+            },
+        )
+        conn.commit()
+    finally:
+        close_writable(conn)
+
+
+def has_tiles_table(mbtiles_path):
+    conn = connect_read_only(mbtiles_path)
+    try:
+        row = conn.execute(
+            "SELECT type FROM sqlite_master WHERE name = 'tiles'"
+        ).fetchone()
+        return row is not None and row[0] == "table"
+    finally:
+        conn.close()
+
+
+def build_dataset_tiles_incrementally(
+    entity_path,
+    output_path,
+    dataset,
+    previous_path,
+    snapshot,
+    read_only=False,
+    timeout=None,
+    compact_precision=None,
+    options_key=None,
+):
+    """Patch the previous build's tiles with tiles regenerated around changed entities.
+
+    Returns the RunResults of the tippecanoe runs once {dataset}.mbtiles in output_path
+    has been patched, or None when a full build is needed instead: there is no previous
+    build or snapshot, it was built with other options than options_key, the change is
+    too large for patching to pay off or patching failed.
+    """
+    previous_mbtiles = Path(previous_path) / f"{dataset}.mbtiles"
+    previous_snapshot = Path(previous_path) / f"{dataset}{SNAPSHOT_SUFFIX}"
+    if not previous_mbtiles.is_file() or not previous_snapshot.is_file():
+        print(f"{LOG_INIT} [{dataset}] no previous build to patch", flush=True)
+        return None
+    if not has_tiles_table(previous_mbtiles):
+        print(f"{LOG_INIT} [{dataset}] previous mbtiles has no tiles table to patch", flush=True)
+        return None
+    if read_snapshot_options(previous_snapshot) != options_key:
+        print(f"{LOG_INIT} [{dataset}] previous build was made with other options", flush=True)
+        return None
+
+    changed_bounds = get_changed_bounds(read_entity_snapshot(previous_snapshot), snapshot)
+    if len(changed_bounds) > INCREMENTAL_MAX_CHANGE_RATIO * max(len(snapshot), 1):
+        print(f"{LOG_INIT} [{dataset}] too many changed entities to patch", flush=True)
+        return None
+    affected = (
+        get_affected_tiles(changed_bounds, max_tiles=INCREMENTAL_MAX_TILES)
+        if changed_bounds
+        else {}
+    )
+    if affected is None:
+        print(f"{LOG_INIT} [{dataset}] too many affected tiles to patch", flush=True)
+        return None
+
+    output_mbtiles = Path(output_path) / f"{dataset}.mbtiles"
+    if output_mbtiles.resolve() != previous_mbtiles.resolve():
+        shutil.copyfile(previous_mbtiles, output_mbtiles)
+    print(
+        f"{LOG_INIT} [{dataset}] patching {sum(len(t) for t in affected.values())} tiles "
+        f"for {len(changed_bounds)} changed geometries",
+        flush=True,
+    )
+
+    entity_ids = np.array(list(snapshot.keys()), dtype=np.int64)
+    entity_bounds = np.array([values[1:] for values in snapshot.values()], dtype=float)
+    selections = {
+        zoom: select_entities_touching_tiles(entity_ids, entity_bounds, zoom, tiles)
+        if tiles and len(entity_ids)
+        else entity_ids[:0]
+        for zoom, tiles in affected.items()
+    }
+
+    # Zoom levels needing the same features are regenerated by a single tippecanoe run
+    zoom_bands = []
+    for zoom in sorted(selections):
+        if zoom_bands and len(selections[zoom]) == len(selections[zoom_bands[-1][0]]):
+            zoom_bands[-1].append(zoom)
+        else:
+            zoom_bands.append([zoom])
+
+    results = []
+    for zooms in zoom_bands:
+        band_tiles = {zoom: affected[zoom] for zoom in zooms}
+        entities = selections[zooms[0]]
+        if len(entities) == 0:
+            patch_mbtiles(output_mbtiles, band_tiles)
+            continue
+        with tempfile.TemporaryDirectory(dir=output_path) as temporary_dir:
+            band_mbtiles = Path(temporary_dir) / f"{dataset}.mbtiles"
+            result = run(
+                tippecanoe_command(
+                    dataset, band_mbtiles, args=tippecanoe_zoom_args(zooms[0], zooms[-1])
+                ),
+                f"{LOG_INIT} [{dataset}]",
+                input_lines=get_feature_iterator(
+                    entity_path, dataset, read_only, entities.tolist(), compact_precision
+                ),
+                timeout=timeout,
+            )
+            results.append(result)
+            if result.returncode != 0:
+                print(f"{LOG_INIT} [{dataset}] failed to create patch tiles", flush=True)
+                output_mbtiles.unlink(missing_ok=True)
+                return None
+            patch_mbtiles(output_mbtiles, band_tiles, band_mbtiles)
+            merge_vector_layer_fields(output_mbtiles, band_mbtiles)
+
+    if len(entity_bounds):
+        set_mbtiles_bounds(
+            output_mbtiles,
+            (
+                entity_bounds[:, 0].min(),
+                entity_bounds[:, 1].min(),
+                entity_bounds[:, 2].max(),
+                entity_bounds[:, 3].max(),
+            ),
+        )
+    current_time = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+    print(f"{current_time}: {LOG_INIT} [{dataset}] patched tiles", flush=True)
+    return results
+
+
+def build_tiles(
+    entity_path,
+    output_path,
+    dataset,
+    keep_geojson=False,
+    timeout=None,
+    read_only=False,
+    previous_path=None,
+    exported=False,
+    compact_precision=None,
+    profiles=None,
+    tile_format="mbtiles",
+):
+    """Build a dataset's tiles, patching the previous build's tiles when previous_path is given.
+
+    Incremental builds also write a {dataset}.snapshot.sqlite3 sidecar next to the
+    tiles that the next incremental build diffs against. They are only possible
+    for datasets using a patchable profile. With keep_geojson the tiles are built
+    from {dataset}.geojson, which is written first unless exported. With a
+    tile_format of pmtiles or both the mbtiles output is converted into
+    {dataset}.pmtiles, and only kept for both.
+    Returns the dataset's build metrics, including whether it succeeded.
+    """
+    started = time.perf_counter()
+    metrics = {
+        "dataset": dataset,
+        "success": False,
+        "mode": "full",
+        "profile": None,
+        "seconds": None,
+        "features": None,
+        "geojson_bytes": None,
+        "tippecanoe": None,
+        "mbtiles_bytes": None,
+        "pmtiles_bytes": None,
+        "tiles_per_zoom": None,
+    }
+    print(f"{LOG_INIT} [{dataset}] started processing", flush=True)
+    profile = DEFAULT_TIPPECANOE_PROFILE
+    if profiles is not None:
+        stats = get_dataset_stats(entity_path, dataset, extent=profiles_use_extent(profiles))
+        profile_name, profile = select_tippecanoe_profile(profiles, dataset, stats)
+        metrics["profile"] = profile_name
+        print(
+            f"{LOG_INIT} [{dataset}] using tippecanoe profile {profile_name} for "
+            f"{stats['features']} features, {stats['point_ratio']:.0%} points",
+            flush=True,
+        )
+    if previous_path is not None and not profile.get("patchable", False):
+        print(f"{LOG_INIT} [{dataset}] profile cannot be patched, building in full", flush=True)
+        previous_path = None
+
+    # The dataset's own profile rather than all of them, so that patching only
+    # falls back to a full build when this dataset's options change
+    options_key = get_build_options_key(keep_geojson, compact_precision, profile, tile_format)
+    snapshot = None
+    results = None
+    if previous_path is not None:
+        snapshot = get_entity_snapshot(entity_path, dataset)
+        results = build_dataset_tiles_incrementally(
+            entity_path,
+            output_path,
+            dataset,
+            previous_path,
+            snapshot,
+            read_only,
+            timeout,
+            compact_precision,
+            options_key,
+        )
+        if results is not None:
+            metrics["mode"] = "patched"
 
+    if results is None:
+        counts = {"features": 0, "bytes": 0}
+        if keep_geojson:
+            if not exported:
+                counts["features"] = write_dataset_features(
+                    entity_path, output_path, dataset, read_only, compact_precision
+                )
+            else:
+                counts["features"] = None
+            counts["bytes"] = os.stat(f"{output_path}/{dataset}.geojson").st_size
+            result = build_dataset_tiles(
+                output_path, dataset, timeout=timeout, args=profile["args"]
+            )
+        else:
+            result = build_dataset_tiles(
+                output_path,
+                dataset,
+                count_features(
+                    get_feature_iterator(
+                        entity_path, dataset, read_only, compact_precision=compact_precision
+                    ),
+                    counts,
+                ),
+                timeout,
+                profile["args"],
+            )
+        results = [result]
+        metrics["features"] = counts["features"]
+        metrics["geojson_bytes"] = counts["bytes"]
 
-def run(command, pre_log):
-    with pipe() as (r, w):
-        with subprocess.Popen(command, shell=True, stdout=w, stderr=w) as proc:
-            while proc.poll() is None:
-                output = ""
-                while len(select([r], [], [], 0)[0]) > 0:
-                    buf = os.read(r, 1024)
-                    output += buf.decode("utf-8")
+    metrics["success"] = all(result.returncode == 0 for result in results)
+    metrics["tippecanoe"] = {
+        "runs": len(results),
+        "seconds": sum(result.wall_time for result in results),
+        "cpu_seconds": sum(result.cpu_time for result in results),
+        "peak_rss_kb": max((result.max_rss for result in results), default=0),
+    }
+    mbtiles_path = Path(output_path) / f"{dataset}.mbtiles"
+    if metrics["success"]:
+        if snapshot is not None:
+            write_entity_snapshot(Path(output_path) / f"{dataset}{SNAPSHOT_SUFFIX}", snapshot, options_key)
+        if mbtiles_path.is_file():
+            metrics["mbtiles_bytes"] = mbtiles_path.stat().st_size
+            metrics["tiles_per_zoom"] = get_tile_counts(mbtiles_path)
+            if tile_format in ("pmtiles", "both"):
+                pmtiles_path = Path(output_path) / f"{dataset}.pmtiles"
+                print(f"{LOG_INIT} [{dataset}] converting to {pmtiles_path}", flush=True)
+                convert_mbtiles_to_pmtiles(mbtiles_path, pmtiles_path)
+                metrics["pmtiles_bytes"] = pmtiles_path.stat().st_size
+                if tile_format == "pmtiles":
+                    mbtiles_path.unlink()
+    metrics["seconds"] = time.perf_counter() - started
+    return metrics
 
-                if output != "" and str.strip(output) != "":
-                    print(f"{pre_log} {output}", end="", flush=True)
 
-            return proc
+def count_features(features, counts):
+    """Pass features through while adding their number and size in bytes to counts."""
+    for feature in features:
+        counts["features"] += 1
+        counts["bytes"] += len(feature.encode("utf-8")) + 1
+        yield feature
 
 
-def get_geography_datasets(entity_model_path):
-    if not Path(entity_model_path).is_file():
+def get_tile_counts(mbtiles_path):
+    if not Path(mbtiles_path).exists():
         return None
+    conn = connect_read_only(mbtiles_path)
+    try:
+        return {
+            str(zoom): count
+            for zoom, count in conn.execute(
+                "SELECT zoom_level, COUNT(*) FROM tiles GROUP BY zoom_level ORDER BY zoom_level"
+            )
+        }
+    except sqlite3.Error:
+        return None
+    finally:
+        conn.close()
 
-    conn = sqlite3.connect(entity_model_path)
-    cur = conn.cursor()
-    cur.execute(
-        """
-        SELECT
-            DISTINCT dataset
-        FROM
-            entity
-        WHERE
-            (geometry != '') OR (point != '')
-        """
-    )
-    geography_datasets = [x[0] for x in cur]
-    return geography_datasets
 
+# PMTiles v3, see https://github.com/protomaps/PMTiles/blob/main/spec/v3/spec.md
+PMTILES_HEADER_SIZE = 127
+PMTILES_ROOT_DIRECTORY_SIZE = 16384 - PMTILES_HEADER_SIZE
+PMTILES_LEAF_DIRECTORY_ENTRIES = 4096
+PMTILES_COMPRESSION = {None: 1, "gzip": 2}
+PMTILES_TILE_TYPES = {"pbf": 1, "png": 2, "jpg": 3, "jpeg": 3, "webp": 4}
 
-def create_geojson_from_wkt(entity_model_path):
-    no_errors = False
-    current_time = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-    print(
-        f"{current_time}: {LOG_INIT} started creating geojson for {entity_model_path}",
-        flush=True,
-    )
-    conn = sqlite3.connect(entity_model_path)
+PMTilesEntry = namedtuple("PMTilesEntry", ["tile_id", "offset", "length", "run_length"])
+
+
+def zxy_to_tile_id(zoom, x, y):
+    """Position of an XYZ tile along the PMTiles Hilbert curve over all zoom levels."""
+    tile_id = ((1 << (2 * zoom)) - 1) // 3
+    size = 1 << zoom
+    step = size >> 1
+    while step > 0:
+        rx = 1 if x & step else 0
+        ry = 1 if y & step else 0
+        tile_id += step * step * ((3 * rx) ^ ry)
+        if ry == 0:
+            if rx == 1:
+                x = size - 1 - x
+                y = size - 1 - y
+            x, y = y, x
+        step >>= 1
+    return tile_id
+
+
+def write_varint(buffer, value):
+    while value >= 0x80:
+        buffer.append((value & 0x7F) | 0x80)
+        value >>= 7
+    buffer.append(value)
+
+
+def serialize_pmtiles_directory(entries):
+    """Encode directory entries column by column as varints, then gzip them."""
+    buffer = bytearray()
+    write_varint(buffer, len(entries))
+    last_id = 0
+    for entry in entries:
+        write_varint(buffer, entry.tile_id - last_id)
+        last_id = entry.tile_id
+    for entry in entries:
+        write_varint(buffer, entry.run_length)
+    for entry in entries:
+        write_varint(buffer, entry.length)
+    for i, entry in enumerate(entries):
+        previous = entries[i - 1] if i > 0 else None
+        if previous is not None and entry.offset == previous.offset + previous.length:
+            write_varint(buffer, 0)
+        else:
+            write_varint(buffer, entry.offset + 1)
+    return gzip.compress(bytes(buffer), mtime=0)
 
+
+def build_pmtiles_directories(entries):
+    """Return the root directory and leaf directories for the entries.
+
+    The root directory has to fit in the first 16KiB of the archive with the header,
+    so larger archives get leaf directories of progressively more entries each.
+    """
+    root = serialize_pmtiles_directory(entries)
+    if len(root) <= PMTILES_ROOT_DIRECTORY_SIZE:
+        return root, b""
+    leaf_size = PMTILES_LEAF_DIRECTORY_ENTRIES
+    while True:
+        root_entries = []
+        leaves = bytearray()
+        for start in range(0, len(entries), leaf_size):
+            leaf = serialize_pmtiles_directory(entries[start:start + leaf_size])
+            root_entries.append(
+                PMTilesEntry(entries[start].tile_id, len(leaves), len(leaf), 0)
+            )
+            leaves.extend(leaf)
+        root = serialize_pmtiles_directory(root_entries)
+        if len(root) <= PMTILES_ROOT_DIRECTORY_SIZE:
+            return root, bytes(leaves)
+        leaf_size *= 2
+
+
+def get_mbtiles_metadata(conn):
+    """Read the mbtiles metadata table, merging the JSON encoded `json` entry into it."""
+    metadata = dict(conn.execute("SELECT name, value FROM metadata"))
+    metadata.update(json.loads(metadata.pop("json", None) or "{}"))
+    return metadata
+
+
+def convert_mbtiles_to_pmtiles(mbtiles_path, pmtiles_path):
+    """Convert an mbtiles file into a clustered PMTiles archive.
+
+    Tiles are written in tile id order so the archive is clustered, identical
+    tiles are stored once and consecutive identical tiles share a directory entry.
+    The tile ids are indexed in a temporary table, so that the tiles are streamed
+    in that order by one query rather than sorted and read one by one in Python.
+    The archive is written next to pmtiles_path and moved into place when complete.
+    """
+    conn = connect_read_only(mbtiles_path)
     try:
-        cur = conn.cursor()
-        update_cursor = conn.cursor()
-        cur.execute(
+        metadata = get_mbtiles_metadata(conn)
+        conn.create_function(
+            "tile_id",
+            3,
+            lambda zoom, x, row: zxy_to_tile_id(zoom, x, (1 << zoom) - 1 - row),
+            deterministic=True,
+        )
+        conn.execute(
             """
-            SELECT      entity,
-                        point,
-                        geometry
-            FROM        entity
-            WHERE       geometry != ''
-            OR          point != ''
-            ORDER BY    entity
+            CREATE TEMP TABLE tile_ids (
+                tile_id     INTEGER PRIMARY KEY,
+                zoom_level  INTEGER,
+                tile_column INTEGER,
+                tile_row    INTEGER
+            )
             """
         )
-
-        batch_size = 10000
-
-        while True:
-            rows = cur.fetchmany(batch_size)
-            if not rows:
-                no_errors = True
-                break
-            for row in rows:
-                entity_id = row[0] or None
-                point = row[1] or None
-                shape = row[2] or None
-
-                if shape:
-                    geometry = shapely.wkt.loads(shape)
-                elif point:
-                    geometry = shapely.wkt.loads(point)
+        conn.execute(
+            """
+            INSERT INTO tile_ids
+            SELECT      tile_id(zoom_level, tile_column, tile_row),
+                        zoom_level,
+                        tile_column,
+                        tile_row
+            FROM        tiles
+            """
+        )
+        tiles = conn.execute(
+            """
+            SELECT      tile_ids.tile_id,
+                        tile_ids.zoom_level,
+                        tiles.tile_data
+            FROM        tile_ids
+            JOIN        tiles
+            ON          tiles.zoom_level = tile_ids.zoom_level
+            AND         tiles.tile_column = tile_ids.tile_column
+            AND         tiles.tile_row = tile_ids.tile_row
+            ORDER BY    tile_ids.tile_id
+            """
+        )
+        entries = []
+        contents = {}
+        tile_compression = None
+        tiles_count = 0
+        min_zoom = max_zoom = None
+        with tempfile.TemporaryFile(dir=Path(pmtiles_path).parent) as tile_data:
+            for tile_id, zoom, data in tiles:
+                tiles_count += 1
+                min_zoom = zoom if min_zoom is None else min(min_zoom, zoom)
+                max_zoom = zoom if max_zoom is None else max(max_zoom, zoom)
+                if data[:2] == b"\x1f\x8b":
+                    tile_compression = "gzip"
+                digest = hashlib.sha256(data).digest()
+                if digest not in contents:
+                    contents[digest] = tile_data.tell()
+                    tile_data.write(data)
+                offset = contents[digest]
+                last = entries[-1] if entries else None
+                if (
+                    last is not None
+                    and last.offset == offset
+                    and last.tile_id + last.run_length == tile_id
+                ):
+                    entries[-1] = last._replace(run_length=last.run_length + 1)
                 else:
-                    print(
-                        f"{LOG_INIT} ERROR in create_geojson_from_wkt - No data for entity_id: {entity_id})"
-                    )
-                    continue
+                    entries.append(PMTilesEntry(tile_id, offset, len(data), 1))
+            tile_data_length = tile_data.tell()
 
-                geo_json = geojson.Feature(geometry=geometry)
-                del geo_json["properties"]
-                update_cursor.execute(
-                    """
-                    UPDATE  entity
-                    SET     geojson = ?
-                    WHERE   entity = ?
-                    """,
-                    (json.dumps(geo_json), entity_id),
+            root, leaves = build_pmtiles_directories(entries)
+            metadata_bytes = gzip.compress(json.dumps(metadata).encode("utf-8"), mtime=0)
+            metadata_offset = PMTILES_HEADER_SIZE + len(root)
+            leaves_offset = metadata_offset + len(metadata_bytes)
+            tile_data_offset = leaves_offset + len(leaves)
+            min_lon, min_lat, max_lon, max_lat = (
+                float(value)
+                for value in metadata.get("bounds", f"-180,-{MAX_LATITUDE},180,{MAX_LATITUDE}").split(",")
+            )
+            if min_zoom is None:
+                min_zoom = max_zoom = 0
+            center = metadata.get("center", "").split(",")
+            if len(center) == 3:
+                center_lon, center_lat, center_zoom = float(center[0]), float(center[1]), int(center[2])
+            else:
+                center_lon, center_lat, center_zoom = (
+                    (min_lon + max_lon) / 2, (min_lat + max_lat) / 2, min_zoom
                 )
+            header = b"PMTiles" + struct.pack(
+                "<BQQQQQQQQQQQBBBBBBiiiiBii",
+                3,
+                PMTILES_HEADER_SIZE,
+                len(root),
+                metadata_offset,
+                len(metadata_bytes),
+                leaves_offset,
+                len(leaves),
+                tile_data_offset,
+                tile_data_length,
+                tiles_count,
+                len(entries),
+                len(contents),
+                1,
+                PMTILES_COMPRESSION["gzip"],
+                PMTILES_COMPRESSION[tile_compression],
+                PMTILES_TILE_TYPES.get(metadata.get("format"), 0),
+                min_zoom,
+                max_zoom,
+                round(min_lon * 10_000_000),
+                round(min_lat * 10_000_000),
+                round(max_lon * 10_000_000),
+                round(max_lat * 10_000_000),
+                center_zoom,
+                round(center_lon * 10_000_000),
+                round(center_lat * 10_000_000),
+            )
+            partial_path = f"{pmtiles_path}.partial"
+            with open(partial_path, "wb") as file:
+                file.write(header)
+                file.write(root)
+                file.write(metadata_bytes)
+                file.write(leaves)
+                tile_data.seek(0)
+                shutil.copyfileobj(tile_data, file, WRITE_BUFFER_SIZE)
+            os.replace(partial_path, pmtiles_path)
+    finally:
+        conn.close()
+    return tiles_count
 
-            no_errors = True
-        conn.commit()
 
-    except sqlite3.Error as exc:
-        print(
-            f"{LOG_INIT} ERROR in create_geojson_from_wkt for {entity_model_path}: {exc}"
+def get_dataset_memory_estimates(entity_model_path):
+    """Estimate the peak memory in bytes needed to build each dataset's tiles."""
+    conn = connect_read_only(entity_model_path)
+    try:
+        cur = conn.execute(
+            """
+            SELECT      dataset,
+                        SUM(MAX(
+                            IFNULL(LENGTH(geojson), 0),
+                            IFNULL(LENGTH(geometry), 0) + IFNULL(LENGTH(point), 0)
+                        ))
+            FROM        entity
+            WHERE       geometry != ''
+            OR          point != ''
+            GROUP BY    dataset
+            """
         )
+        return {
+            dataset: (size or 0) * TIPPECANOE_MEMORY_FACTOR for dataset, size in cur
+        }
     finally:
-        cur.close()
-        update_cursor.close()
         conn.close()
-        print(
-            f"{LOG_INIT} finished processing create_geojson_from_wkt for {entity_model_path}",
-            flush=True,
-        )
-        return no_errors
 
 
-def get_dataset_features(entity_model_path, dataset=None):
-    conn = sqlite3.connect(entity_model_path)
-    json_properties = [
-        "'tippecanoe'",
-        "json_object('layer', entity.dataset)",
-        "'entity'",
-        "entity.entity",
-        "'properties'",
-        "json_patch(" "json_object(" "'name'",
-        "entity.name",
-        "'dataset'",
-        "entity.dataset",
-        "'organisation-entity'",
-        "entity.organisation_entity",
-        "'entity'",
-        "entity.entity",
-        "'entry-date'",
-        "entity.entry_date",
-        "'start-date'",
-        "entity.start_date",
-        "'end-date'",
-        "entity.end_date",
-        "'prefix'",
-        "entity.prefix",
-        "'reference'",
-        "entity.reference" ")",
-        "IFNULL(entity.json, '{}')" ")",
-    ]
-    query = """
-        SELECT
-            json_patch(entity.geojson,
-            json_object({properties}))
-        FROM
-            entity
-        WHERE NOT EXISTS (
-            SELECT * FROM old_entity
-                WHERE entity.entity = old_entity.old_entity
+def read_cgroup_bytes(path):
+    try:
+        value = Path(path).read_text().strip()
+    except OSError:
+        return None
+    return int(value) if value.isdigit() else None
+
+
+def get_available_memory(cgroup_dir=CGROUP_DIR):
+    """Return the bytes of memory free for the build.
+
+    Inside a container the OOM killer enforces the cgroup's limit rather than the
+    host's free memory, so when a limit is set (cgroup v2 memory.max, or v1
+    memory.limit_in_bytes) the headroom left under it is used if it is smaller.
+    """
+    available = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_AVPHYS_PAGES")
+    for limit_name, usage_name in CGROUP_MEMORY_FILES:
+        limit = read_cgroup_bytes(Path(cgroup_dir) / limit_name)
+        if limit is None:
+            continue
+        usage = read_cgroup_bytes(Path(cgroup_dir) / usage_name) or 0
+        return max(min(available, limit - usage), 0)
+    return available
+
+
+def build_all_tiles(
+    entity_path,
+    output_path,
+    datasets,
+    keep_geojson=False,
+    jobs=1,
+    memory_budget=None,
+    timeout=None,
+    read_only=False,
+    previous_path=None,
+    compact_precision=None,
+    profiles=None,
+    tile_format="mbtiles",
+    on_complete=None,
+):
+    """Build tiles for each dataset, running up to `jobs` datasets at once.
+
+    Datasets are started largest first and a dataset is only started alongside others
+    while the estimated memory of everything running stays within memory_budget bytes.
+    A single dataset is always allowed to run on its own whatever its estimate.
+    With keep_geojson every dataset's GeoJSON is first exported in a single pass
+    over the entity table. on_complete, when given, is called with each dataset's
+    name and metrics as soon as it finishes. Returns the build metrics of each
+    dataset by name.
+    """
+    exported = False
+    feature_counts = {}
+    if keep_geojson and len(datasets) > 1:
+        feature_counts = export_all_dataset_features(
+            entity_path, output_path, datasets, read_only, compact_precision
         )
-        AND entity.geojson != ''
-        """.format(
-        properties=",".join(json_properties)
+        exported = True
+    build_kwargs = {
+        "keep_geojson": keep_geojson,
+        "timeout": timeout,
+        "read_only": read_only,
+        "previous_path": previous_path,
+        "exported": exported,
+        "compact_precision": compact_precision,
+        "profiles": profiles,
+        "tile_format": tile_format,
+    }
+
+    if jobs <= 1 or len(datasets) <= 1:
+        metrics = {}
+        for d in datasets:
+            metrics[d] = build_tiles(entity_path, output_path, d, **build_kwargs)
+            if on_complete is not None:
+                on_complete(d, metrics[d])
+        for d, count in feature_counts.items():
+            metrics[d]["features"] = count
+        return metrics
+
+    if memory_budget is None:
+        memory_budget = get_available_memory()
+    estimates = get_dataset_memory_estimates(entity_path)
+    pending = sorted(datasets, key=lambda d: estimates.get(d, 0), reverse=True)
+    running = {}
+    metrics = {}
+    print(
+        f"{LOG_INIT} building {len(datasets)} datasets with {jobs} jobs "
+        f"and a memory budget of {memory_budget // (1024 * 1024)}MB",
+        flush=True,
     )
 
-    cur = conn.cursor()
-    if dataset:
-        query += "AND entity.dataset == ?"
-        cur.execute(query, (dataset,))
-    else:
-        cur.execute(query)
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        while pending or running:
+            for d in list(pending):
+                if len(running) >= jobs:
+                    break
+                in_use = sum(estimates.get(r, 0) for r in running.values())
+                if running and in_use + estimates.get(d, 0) > memory_budget:
+                    continue
+                pending.remove(d)
+                future = executor.submit(
+                    build_tiles, entity_path, output_path, d, **build_kwargs
+                )
+                running[future] = d
 
-    results = ",".join(x[0] for x in cur)
-    results = results.rstrip(",")
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                d = running.pop(future)
+                exc = future.exception()
+                if exc is not None:
+                    print(f"{LOG_INIT} [{d}] ERROR building tiles: {exc}", flush=True)
+                    metrics[d] = {"dataset": d, "success": False, "error": str(exc)}
+                else:
+                    metrics[d] = future.result()
+                if on_complete is not None:
+                    on_complete(d, metrics[d])
 
-    return results
+    for d, count in feature_counts.items():
+        metrics[d]["features"] = count
+    return metrics
 
 
-def create_geojson_file(features, output_path, dataset):
-    current_time = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-    print(f"{current_time}: started creating geojson file")
-    geojson = '{"type":"FeatureCollection","features":[' + features + "]}"
-    with open(f"{output_path}/{dataset}.geojson", "w") as f:
-        f.write(geojson)
-    print(f"{LOG_INIT} [{dataset}] created geojson", flush=True)
+STACK_MBTILES_NAME = "tiles-stack.mbtiles"
 
 
-def build_dataset_tiles(output_path, dataset):
-    current_time = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-    print(f"{current_time}: Started building tiles - build_dataset_tiles")
-    build_tiles_cmd = (
-        f"tippecanoe --no-progress-indicator -z15 -Z4 -r1 --no-feature-limit "
-        f"--no-tile-size-limit --layer={dataset} --output={output_path}/{dataset}.mbtiles "
-        f"{output_path}/{dataset}.geojson "
+def get_stack_sources(stack_dir, output_path, datasets):
+    """Return the mbtiles to join into the tile stack, highest priority first.
+
+    The datasets' tiles built into output_path replace those of the same name in stack_dir.
+    The priority is the tiles stack's default: database names in reverse sorted order.
+    """
+    sources = {path.name: path for path in Path(stack_dir).glob("*.mbtiles")}
+    for dataset in datasets:
+        path = Path(output_path) / f"{dataset}.mbtiles"
+        if path.is_file():
+            sources[path.name] = path
+    sources.pop(STACK_MBTILES_NAME, None)
+    return [sources[name] for name in sorted(sources, reverse=True)]
+
+
+def build_stack_tiles(output_path, sources, timeout=None):
+    """Join the sources into a single mbtiles with one layer per dataset.
+
+    Layers keep the order of the sources so that each tile lists them in priority
+    order. Returns tile-join's RunResult, removing any partial output on failure.
+    """
+    stack_path = Path(output_path) / STACK_MBTILES_NAME
+    command = (
+        f"tile-join --force --no-tile-size-limit --output={stack_path} "
+        f"{' '.join(str(source) for source in sources)}"
     )
-    proc = run(build_tiles_cmd, f"{LOG_INIT} [{dataset}]")
-    if proc.returncode != 0:
-        print(f"{LOG_INIT} [{dataset}] failed to create tiles", flush=True)
-    else:
-        current_time = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-        print(f"{current_time}: {LOG_INIT} [{dataset}] created tiles", flush=True)
+    result = run(command, f"{LOG_INIT} [stack]", timeout=timeout)
+    if result.returncode != 0:
+        print(f"{LOG_INIT} [stack] failed to join tiles", flush=True)
+        stack_path.unlink(missing_ok=True)
+    return result
 
 
-def build_tiles(entity_path, output_path, dataset):
-    features = get_dataset_features(entity_path, dataset)
-    print(f"{LOG_INIT} [{dataset}] started processing", flush=True)
-    create_geojson_file(features, output_path, dataset)
-    build_dataset_tiles(output_path, dataset)
+def get_hasher(algorithm):
+    if algorithm == "xxh3_128":
+        return xxhash.xxh3_128()
+    return hashlib.new(algorithm)
 
 
-def get_current_sqlite_hash(sqlite_path):
+def get_current_sqlite_hash(sqlite_path, algorithm="md5"):
     print(f"{LOG_INIT} Attempting to get_current_sqlite_hash for sqlite_path={sqlite_path}", flush=True)
+    hasher = get_hasher(algorithm)
     with open(sqlite_path, "rb") as f:
-        sqlite_data = f.read()
-    return hashlib.md5(sqlite_data).hexdigest()
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def get_file_stat(path):
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime": stat.st_mtime_ns}
 
 
 def get_stored_hash(hash_path):
@@ -234,12 +1949,232 @@ def get_stored_hash(hash_path):
     return None
 
 
-def update_current_sqlite_hash(hash_path, new_hash):
+def get_stored_file_stat(hash_path):
+    if hash_path.exists():
+        with open(hash_path) as file:
+            return json.load(file).get("stat")
+    return None
+
+
+def get_stored_build_options(hash_path):
+    if hash_path.exists():
+        with open(hash_path) as file:
+            return json.load(file).get("options")
+    return None
+
+
+def update_current_sqlite_hash(hash_path, new_hash, file_stat=None, options_key=None):
     with open(hash_path, "w") as file:
         hash_dict = {"hash": new_hash}
+        if file_stat is not None:
+            hash_dict["stat"] = file_stat
+        if options_key is not None:
+            hash_dict["options"] = options_key
         file.write(json.dumps(hash_dict))
 
 
+class DatasetFingerprint:
+    """SQLite aggregate combining per-row digests into an order-independent fingerprint."""
+
+    def __init__(self):
+        self.total = 0
+        self.count = 0
+
+    def step(self, *values):
+        digest = hashlib.blake2b(
+            json.dumps(values).encode("utf-8"), digest_size=16
+        ).digest()
+        self.total = (self.total + int.from_bytes(digest, "big")) % (1 << 128)
+        self.count += 1
+
+    def finalize(self):
+        return f"{self.count}:{self.total:032x}"
+
+
+def get_dataset_fingerprints(entity_model_path):
+    """Fingerprint the exported content of every geography dataset.
+
+    The fingerprint covers the entity ids, geometries and properties of every entity
+    that would be exported, so it changes whenever the dataset's tiles would.
+    """
+    conn = connect_read_only(entity_model_path)
+    conn.create_aggregate("dataset_fingerprint", -1, DatasetFingerprint)
+    try:
+        cur = conn.execute(
+            """
+            SELECT      dataset,
+                        dataset_fingerprint(
+                            entity,
+                            geometry,
+                            point,
+                            name,
+                            organisation_entity,
+                            entry_date,
+                            start_date,
+                            end_date,
+                            prefix,
+                            reference,
+                            json
+                        )
+            FROM        entity
+            WHERE       (geometry != '' OR point != '')
+            AND NOT EXISTS (
+                SELECT * FROM old_entity
+                    WHERE entity.entity = old_entity.old_entity
+            )
+            GROUP BY    dataset
+            """
+        )
+        return dict(cur.fetchall())
+    finally:
+        conn.close()
+
+
+def get_stored_dataset_fingerprints(fingerprint_path, options_key=None):
+    """Read the stored dataset fingerprints, or none if they were built with other options."""
+    if fingerprint_path.exists():
+        with open(fingerprint_path) as file:
+            stored = json.load(file)
+        if stored.get("options") == options_key:
+            return stored.get("datasets", {})
+    return {}
+
+
+def update_dataset_fingerprints(fingerprint_path, fingerprints, options_key=None):
+    with open(fingerprint_path, "w") as file:
+        stored = {"datasets": fingerprints}
+        if options_key is not None:
+            stored["options"] = options_key
+        file.write(json.dumps(stored))
+
+
+def get_build_options_key(keep_geojson, compact_precision, profiles, tile_format):
+    """Hash the options that change what a dataset's build writes."""
+    options = {
+        "keep_geojson": keep_geojson,
+        "compact_precision": compact_precision,
+        "profiles": profiles,
+        "tile_format": tile_format,
+    }
+    return hashlib.sha256(json.dumps(options, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def new_checkpoint(options_key):
+    return {
+        "schema_version": CHECKPOINT_SCHEMA_VERSION,
+        "options": options_key,
+        "stages": {},
+        "datasets": {},
+    }
+
+
+def read_checkpoint(checkpoint_path, options_key):
+    """Read a checkpoint manifest, starting a new one if it is missing or was made with other options."""
+    try:
+        with open(checkpoint_path) as file:
+            checkpoint = json.load(file)
+    except (OSError, ValueError):
+        return new_checkpoint(options_key)
+    if (
+        checkpoint.get("schema_version") != CHECKPOINT_SCHEMA_VERSION
+        or checkpoint.get("options") != options_key
+    ):
+        print(f"{LOG_INIT} checkpoint was made with other options, starting again", flush=True)
+        return new_checkpoint(options_key)
+    return checkpoint
+
+
+def write_checkpoint(checkpoint_path, checkpoint):
+    temporary_path = Path(f"{checkpoint_path}.tmp")
+    with open(temporary_path, "w") as file:
+        json.dump(checkpoint, file, indent=2)
+    os.replace(temporary_path, checkpoint_path)
+
+
+def get_dataset_outputs(output_path, dataset, keep_geojson, tile_format):
+    outputs = []
+    if tile_format in ("mbtiles", "both"):
+        outputs.append(Path(output_path) / f"{dataset}.mbtiles")
+    if tile_format in ("pmtiles", "both"):
+        outputs.append(Path(output_path) / f"{dataset}.pmtiles")
+    if keep_geojson:
+        outputs.append(Path(output_path) / f"{dataset}.geojson")
+    return outputs
+
+
+def get_resumable_datasets(checkpoint, datasets, fingerprints, output_path, keep_geojson, tile_format):
+    """Return the checkpointed metrics of datasets already built from their current content.
+
+    A dataset is only resumed when its fingerprint matches the one it was built
+    from and all of its outputs are still in output_path.
+    """
+    resumable = {}
+    for d in datasets:
+        entry = checkpoint["datasets"].get(d)
+        if (
+            entry is not None
+            and fingerprints.get(d) is not None
+            and entry["fingerprint"] == fingerprints[d]
+            and all(
+                path.is_file()
+                for path in get_dataset_outputs(output_path, d, keep_geojson, tile_format)
+            )
+        ):
+            resumable[d] = dict(entry["metrics"], resumed=True)
+    return resumable
+
+
+def checkpoint_dataset(checkpoint_path, checkpoint, fingerprints, dataset, metrics):
+    if metrics["success"]:
+        checkpoint["datasets"][dataset] = {
+            "fingerprint": fingerprints.get(dataset),
+            "metrics": metrics,
+        }
+        write_checkpoint(checkpoint_path, checkpoint)
+
+
+def new_build_metrics(entity_path):
+    return {
+        "schema_version": METRICS_SCHEMA_VERSION,
+        "event_id": os.getenv("EVENT_ID"),
+        "entity_path": str(entity_path),
+        "started": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "status": None,
+        "seconds": None,
+        "peak_rss_kb": None,
+        "stages": {},
+        "datasets": {},
+        # Skipped because their fingerprint is unchanged, so their existing tiles stand
+        "unchanged_datasets": [],
+        "_started": time.perf_counter(),
+    }
+
+
+@contextmanager
+def timed_stage(metrics, stage):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics["stages"][stage] = {"seconds": time.perf_counter() - started}
+
+
+def write_build_metrics(metrics_path, metrics, status):
+    """Write the build metrics as JSON, stamped with the build's status, duration and peak RSS.
+
+    peak_rss_kb is the largest of this process and the child processes it has waited for.
+    """
+    report = {key: value for key, value in metrics.items() if not key.startswith("_")}
+    report["status"] = status
+    report["seconds"] = time.perf_counter() - metrics["_started"]
+    report["peak_rss_kb"] = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    with open(metrics_path, "w") as file:
+        json.dump(report, file, indent=2)
+
+
 @click.command()
 @click.option(
     "--entity-path",
@@ -277,14 +2212,178 @@ def update_current_sqlite_hash(hash_path, new_hash):
             "Flag whether a hash should be generated. Disabling the check can be useful in the scenario "
             "that hash generation is causing any problem.")
 )
-def main(entity_path, output_dir, hash_dir, hash_check_enabled=False, hash_generation_enabled=False):
+@click.option(
+    "--keep-geojson",
+    is_flag=True,
+    show_default=True,
+    default=False,
+    help=(
+            "Write each dataset to {dataset}.geojson in the output directory and build tiles from that file. "
+            "By default features are streamed straight into tippecanoe and no GeoJSON file is written.")
+)
+@click.option(
+    "--jobs",
+    type=click.IntRange(min=1),
+    show_default=True,
+    default=1,
+    help="Number of datasets to build at the same time",
+)
+@click.option(
+    "--memory-budget",
+    type=click.IntRange(min=1),
+    default=None,
+    help=(
+            "Memory in MB that datasets built at the same time may use between them. "
+            "Defaults to the memory available when the build starts.")
+)
+@click.option(
+    "--hash-algorithm",
+    type=click.Choice(HASH_ALGORITHMS),
+    show_default=True,
+    default="md5",
+    help="Algorithm used to hash the SQLite file.",
+)
+@click.option(
+    "--hash-stat-check-enabled",
+    is_flag=True,
+    show_default=True,
+    default=False,
+    help=(
+            "Flag whether to skip the build without hashing when the SQLite file has the same size and "
+            "modification time as when the stored hash was generated.")
+)
+@click.option(
+    "--tippecanoe-timeout",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Seconds after which a dataset's tippecanoe run is killed and the dataset marked as failed",
+)
+@click.option(
+    "--read-only",
+    is_flag=True,
+    show_default=True,
+    default=False,
+    help=(
+            "Open the entity database read-only and convert WKT to GeoJSON while exporting features, "
+            "instead of first writing a geojson value back into every entity row.")
+)
+@click.option(
+    "--incremental-from",
+    type=click.Path(file_okay=False),
+    default=None,
+    help=(
+            "Directory holding the previous build's mbtiles and snapshot files. When a dataset has only a few "
+            "changed entities, its tiles around them are regenerated and patched into a copy of the previous mbtiles.")
+)
+@click.option(
+    "--compact-precision",
+    type=click.IntRange(min=0, max=15),
+    default=None,
+    help=(
+            "Compact geometries before export: repair invalid geometries, snap coordinates to this many decimal "
+            "places and drop the duplicate vertices that leaves. 7 is enough for z15 tiles.")
+)
+@click.option(
+    "--tippecanoe-profiles",
+    type=click.Path(dir_okay=False),
+    default=DEFAULT_TIPPECANOE_PROFILES_PATH,
+    show_default=True,
+    help=(
+            "JSON config of tippecanoe profiles, the rules that choose one from each dataset's point share, "
+            "feature count and extent, and per-dataset overrides.")
+)
+@click.option(
+    "--tile-format",
+    type=click.Choice(["mbtiles", "pmtiles", "both"]),
+    default="mbtiles",
+    show_default=True,
+    help=(
+            "Tile output for each dataset. PMTiles archives are converted from the mbtiles, which is "
+            "removed afterwards unless both are kept. Incremental builds need the previous mbtiles.")
+)
+@click.option(
+    "--stack-dir",
+    type=click.Path(file_okay=False),
+    default=None,
+    help=(
+            "Directory of the served mbtiles. After the datasets are built, they and the newly built "
+            f"tiles are joined into {STACK_MBTILES_NAME} with one layer per dataset, for the tiles stack.")
+)
+@click.option(
+    "--stack-only",
+    is_flag=True,
+    show_default=True,
+    default=False,
+    help=(
+            f"Only join the mbtiles in --stack-dir into {STACK_MBTILES_NAME} in the output directory, "
+            "without building any dataset. Exits 1 if the join fails.")
+)
+@click.option(
+    "--resume",
+    is_flag=True,
+    show_default=True,
+    default=False,
+    help=(
+            f"Skip work recorded in {CHECKPOINT_NAME} in the output dir by an earlier run that did not finish: "
+            "datasets whose content is unchanged and whose outputs are still there, and the geojson stage "
+            "when the entity database is the one it converted.")
+)
+def main(
+    entity_path,
+    output_dir,
+    hash_dir,
+    hash_check_enabled=False,
+    hash_generation_enabled=False,
+    keep_geojson=False,
+    jobs=1,
+    memory_budget=None,
+    hash_algorithm="md5",
+    hash_stat_check_enabled=False,
+    tippecanoe_timeout=None,
+    read_only=False,
+    incremental_from=None,
+    compact_precision=None,
+    tippecanoe_profiles=None,
+    tile_format="mbtiles",
+    stack_dir=None,
+    stack_only=False,
+    resume=False,
+):
     print(f"{LOG_INIT} hash_check_enabled: {hash_check_enabled}", flush=True)
     print(f"{LOG_INIT} hash_generation_enabled: {hash_generation_enabled}", flush=True)
+    print(f"{LOG_INIT} keep_geojson: {keep_geojson}", flush=True)
+    print(f"{LOG_INIT} jobs: {jobs}", flush=True)
+    print(f"{LOG_INIT} read_only: {read_only}", flush=True)
+    print(f"{LOG_INIT} incremental_from: {incremental_from}", flush=True)
+    print(f"{LOG_INIT} compact_precision: {compact_precision}", flush=True)
+    print(f"{LOG_INIT} tippecanoe_profiles: {tippecanoe_profiles}", flush=True)
+    print(f"{LOG_INIT} tile_format: {tile_format}", flush=True)
+    print(f"{LOG_INIT} stack_dir: {stack_dir}", flush=True)
+    print(f"{LOG_INIT} stack_only: {stack_only}", flush=True)
+    print(f"{LOG_INIT} resume: {resume}", flush=True)
+    if stack_dir is not None and tile_format == "pmtiles":
+        raise click.UsageError("--stack-dir joins mbtiles so needs a --tile-format of mbtiles or both")
+    if stack_only:
+        if stack_dir is None:
+            raise click.UsageError("--stack-only needs a --stack-dir")
+        sources = get_stack_sources(stack_dir, output_dir, [])
+        print(f"{LOG_INIT} joining {len(sources)} mbtiles into {STACK_MBTILES_NAME}", flush=True)
+        result = build_stack_tiles(output_dir, sources, tippecanoe_timeout)
+        if result.returncode != 0:
+            exit(1)
+        if tile_format == "both":
+            stack_path = Path(output_dir) / STACK_MBTILES_NAME
+            convert_mbtiles_to_pmtiles(stack_path, stack_path.with_suffix(".pmtiles"))
+        return
+    profiles = load_tippecanoe_profiles(tippecanoe_profiles)
 
     Path(hash_dir).mkdir(parents=True, exist_ok=True)
+    metrics_path = Path(hash_dir) / f"{Path(entity_path).stem}.metrics.json"
+    metrics = new_build_metrics(entity_path)
     datasets = get_geography_datasets(entity_path)
     if datasets is None:
         print(f"{LOG_INIT}: No datasets found: {entity_path}", flush=True)
+        write_build_metrics(metrics_path, metrics, "failed")
         exit(1)
 
     print(f"{LOG_INIT} found datasets: {datasets}", flush=True)
@@ -294,23 +2393,140 @@ def main(entity_path, output_dir, hash_dir, hash_check_enabled=False, hash_gener
     stored_hash = get_stored_hash(hash_path)
     print(f"stored_hash: {stored_hash}", flush=True)
 
-    current_hash = get_current_sqlite_hash(entity_path) if hash_generation_enabled else None
+    # Tiles built with other options are stale even if the SQLite file is unchanged
+    options_key = get_build_options_key(keep_geojson, compact_precision, profiles, tile_format)
+    options_unchanged = get_stored_build_options(hash_path) == options_key
+    current_stat = get_file_stat(entity_path)
+    if (
+        hash_check_enabled
+        and hash_stat_check_enabled
+        and options_unchanged
+        and current_stat == get_stored_file_stat(hash_path)
+    ):
+        print(f"{LOG_INIT} SQLite file size and mtime unchanged. Skipping tile update.", flush=True)
+        write_build_metrics(metrics_path, metrics, "unchanged")
+        exit(1)
+
+    with timed_stage(metrics, "hash"):
+        current_hash = get_current_sqlite_hash(entity_path, hash_algorithm) if hash_generation_enabled else None
     print(f"current_hash: {current_hash}", flush=True)
 
-    if hash_check_enabled and current_hash == stored_hash:
+    if hash_check_enabled and options_unchanged and current_hash == stored_hash:
         print(f"{LOG_INIT} No changes detected. Skipping tile update.", flush=True)
+        write_build_metrics(metrics_path, metrics, "unchanged")
         exit(1)
 
-    print("Calling create_geojson_from_wkt", flush=True)
-    result = create_geojson_from_wkt(entity_path)
-    print("Called create_geojson_from_wkt", flush=True)
-    if not result:
-        print(f"{LOG_INIT} ERROR processing create_geojson_from_wkt", flush=True)
-        exit(1)
-    for d in datasets:
-        build_tiles(entity_path, output_dir, d)
+    fingerprint_path = Path(hash_dir) / f"{Path(entity_path).stem}.datasets.json"
+    stored_fingerprints = get_stored_dataset_fingerprints(fingerprint_path, options_key)
+    with timed_stage(metrics, "fingerprint"):
+        current_fingerprints = get_dataset_fingerprints(entity_path)
+
+    if hash_check_enabled:
+        unchanged = [
+            d
+            for d in datasets
+            if d in stored_fingerprints
+            and current_fingerprints.get(d) == stored_fingerprints[d]
+        ]
+        if unchanged:
+            print(f"{LOG_INIT} unchanged datasets, keeping existing tiles: {unchanged}", flush=True)
+        metrics["unchanged_datasets"] = unchanged
+        datasets = [d for d in datasets if d not in unchanged]
+        if not datasets:
+            if hash_generation_enabled:
+                update_current_sqlite_hash(hash_path, current_hash, current_stat, options_key)
+            print(f"{LOG_INIT} No changes detected. Skipping tile update.", flush=True)
+            write_build_metrics(metrics_path, metrics, "unchanged")
+            exit(1)
+
+    checkpoint_path = Path(output_dir) / CHECKPOINT_NAME
+    checkpoint = read_checkpoint(checkpoint_path, options_key) if resume else new_checkpoint(options_key)
+    resumed = (
+        get_resumable_datasets(
+            checkpoint, datasets, current_fingerprints, output_dir, keep_geojson, tile_format
+        )
+        if resume
+        else {}
+    )
+    if resumed:
+        print(f"{LOG_INIT} resuming, keeping datasets already built: {sorted(resumed)}", flush=True)
+    remaining = [d for d in datasets if d not in resumed]
+
+    geojson_stage = checkpoint["stages"].get("create_geojson_from_wkt")
+    if not read_only and remaining:
+        if (
+            resume
+            and geojson_stage is not None
+            and geojson_stage["file_stat"] == get_file_stat(entity_path)
+            and set(remaining) <= set(geojson_stage["datasets"])
+        ):
+            print(f"{LOG_INIT} resuming, geojson already created", flush=True)
+        else:
+            print("Calling create_geojson_from_wkt", flush=True)
+            with timed_stage(metrics, "create_geojson_from_wkt"):
+                result = create_geojson_from_wkt(entity_path, remaining, compact_precision, jobs)
+            print("Called create_geojson_from_wkt", flush=True)
+            if not result:
+                print(f"{LOG_INIT} ERROR processing create_geojson_from_wkt", flush=True)
+                write_build_metrics(metrics_path, metrics, "failed")
+                exit(1)
+            if len(datasets) > 1:
+                with timed_stage(metrics, "index"):
+                    ensure_dataset_index(entity_path)
+            checkpoint["stages"]["create_geojson_from_wkt"] = {
+                "datasets": remaining,
+                "file_stat": get_file_stat(entity_path),
+            }
+            write_checkpoint(checkpoint_path, checkpoint)
+    with timed_stage(metrics, "build_tiles"):
+        metrics["datasets"] = dict(resumed)
+        metrics["datasets"].update(build_all_tiles(
+            entity_path,
+            output_dir,
+            remaining,
+            keep_geojson,
+            jobs,
+            memory_budget * 1024 * 1024 if memory_budget else None,
+            tippecanoe_timeout,
+            read_only,
+            incremental_from,
+            compact_precision,
+            profiles,
+            tile_format,
+            functools.partial(checkpoint_dataset, checkpoint_path, checkpoint, current_fingerprints),
+        ))
+    built = [d for d, m in metrics["datasets"].items() if m["success"]]
+    if stack_dir is not None and built:
+        with timed_stage(metrics, "stack"):
+            sources = get_stack_sources(stack_dir, output_dir, built)
+            print(f"{LOG_INIT} joining {len(sources)} mbtiles into {STACK_MBTILES_NAME}", flush=True)
+            result = build_stack_tiles(output_dir, sources, tippecanoe_timeout)
+            stack_path = Path(output_dir) / STACK_MBTILES_NAME
+            metrics["stack"] = {
+                "success": result.returncode == 0,
+                "sources": [source.stem for source in sources],
+                "seconds": result.wall_time,
+                "mbtiles_bytes": stack_path.stat().st_size if stack_path.is_file() else None,
+            }
+            if result.returncode == 0 and tile_format == "both":
+                convert_mbtiles_to_pmtiles(stack_path, stack_path.with_suffix(".pmtiles"))
+    write_build_metrics(
+        metrics_path, metrics, "built" if len(built) == len(datasets) else "partial"
+    )
     if hash_generation_enabled:
-        update_current_sqlite_hash(hash_path, current_hash)
+        if len(built) == len(datasets):
+            update_current_sqlite_hash(hash_path, current_hash, current_stat, options_key)
+        fingerprints = {
+            d: current_fingerprints[d]
+            if d in built
+            else stored_fingerprints.get(d)
+            for d in current_fingerprints
+        }
+        update_dataset_fingerprints(
+            fingerprint_path,
+            {d: fp for d, fp in fingerprints.items() if fp is not None},
+            options_key,
+        )
     print(f"{LOG_INIT} Tiles built successfully.", flush=True)
 
 
@@ -0,0 +1,303 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from task.build_queue import (
+    FAILED_DIR,
+    acquire_lock,
+    claim_database_events,
+    download_database,
+    enqueue_event,
+    get_build_args,
+    get_source_stat,
+    get_event_database,
+    parse_s3_object_arn,
+    process_queue,
+    read_queued_events,
+)
+
+# Builds what the entity database, a JSON spec here, says: the status and exit code to
+# report and whether each of its datasets succeeded. Incremental builds write a snapshot,
+# and mark their tiles patched when the previous build left one
+FAKE_BUILDER = """
+import json
+import sys
+import time
+from pathlib import Path
+
+args = dict(zip(sys.argv[1::2], sys.argv[2::2]))
+entity_path = Path(args["--entity-path"])
+output_dir = Path(args["--output-dir"])
+if "--stack-only" in sys.argv:
+    time.sleep(0.2)
+    sources = sorted(Path(args["--stack-dir"]).glob("*.mbtiles"), reverse=True)
+    stack = ",".join(path.read_text() for path in sources if path.stem != "tiles-stack")
+    (output_dir / "tiles-stack.mbtiles").write_text(stack)
+    sys.exit(0)
+previous_dir = args.get("--incremental-from")
+spec = json.loads(entity_path.read_text())
+time.sleep(0.2)
+for dataset, success in spec["datasets"].items():
+    if success:
+        tiles = entity_path.stem
+        if previous_dir is not None:
+            if (Path(previous_dir) / f"{dataset}.snapshot.sqlite3").is_file():
+                tiles += " patched"
+            (output_dir / f"{dataset}.snapshot.sqlite3").write_text(entity_path.stem)
+        (output_dir / f"{dataset}.mbtiles").write_text(tiles)
+Path(args["--hash-dir"]).mkdir(parents=True, exist_ok=True)
+report = {
+    "status": spec["status"],
+    "datasets": {dataset: {"success": success} for dataset, success in spec["datasets"].items()},
+}
+(Path(args["--hash-dir"]) / f"{entity_path.stem}.metrics.json").write_text(json.dumps(report))
+sys.exit(spec["exit"])
+"""
+
+
+def write_source(queue_paths, name, status="built", exit_code=0, datasets=None):
+    path = queue_paths["sources"] / f"{name}.sqlite3"
+    spec = {"status": status, "exit": exit_code, "datasets": {name: True} if datasets is None else datasets}
+    path.write_text(json.dumps(spec))
+    return str(path)
+
+
+@pytest.fixture
+def queue_paths(tmp_path):
+    builder_path = tmp_path / "builder.py"
+    builder_path.write_text(FAKE_BUILDER)
+    paths = {name: tmp_path / name for name in ["queue", "tiles", "work", "sources"]}
+    for path in paths.values():
+        path.mkdir()
+    paths["build_command"] = [sys.executable, str(builder_path)]
+    return paths
+
+
+def test_parse_s3_object_arn():
+    assert parse_s3_object_arn(
+        "arn:aws:s3:::production-collection-data/conservation-area-collection/dataset/conservation-area.sqlite3"
+    ) == ("production-collection-data", "conservation-area-collection/dataset/conservation-area.sqlite3")
+    with pytest.raises(ValueError):
+        parse_s3_object_arn("s3://production-collection-data/conservation-area.sqlite3")
+
+
+def test_get_event_database():
+    assert get_event_database({"s3_object_arn": "arn:aws:s3:::bucket/collection/dataset/tree.sqlite3"}) == "tree"
+    assert get_event_database({"path": "/data/tree-preservation-zone.sqlite3"}) == "tree-preservation-zone"
+
+
+def test_claim_database_events_keeps_the_latest(tmp_path):
+    for event_id in ["1", "2", "3"]:
+        enqueue_event(tmp_path, {"event_id": event_id, "path": "/data/tree.sqlite3"})
+    enqueue_event(tmp_path, {"event_id": "4", "path": "/data/park.sqlite3"})
+
+    queued = read_queued_events(tmp_path)
+    assert sorted(queued) == ["park", "tree"]
+    assert [event["event_id"] for _, event in queued["tree"]] == ["1", "2", "3"]
+
+    event_path, event = claim_database_events(tmp_path, queued["tree"])
+    assert event["event_id"] == "3"
+    assert event_path.parent.name == "processing"
+    assert list(read_queued_events(tmp_path)) == ["park"]
+    # Already claimed, so a second claim of the same events fails
+    assert claim_database_events(tmp_path, queued["tree"]) is None
+
+
+def test_read_queued_events_moves_unreadable_events_aside(tmp_path):
+    (tmp_path / "1-bad.json").write_text("{not json")
+    enqueue_event(tmp_path, {"event_id": "2", "s3_object_arn": "not an arn"})
+
+    assert read_queued_events(tmp_path) == {}
+    assert len(list((tmp_path / FAILED_DIR).glob("*.json"))) == 2
+
+
+def test_acquire_lock_times_out_while_held(tmp_path):
+    lock_file = acquire_lock(tmp_path / "lock-tree")
+    assert acquire_lock(tmp_path / "lock-tree", timeout=0.2, poll_interval=0.05) is None
+    lock_file.close()
+    assert acquire_lock(tmp_path / "lock-tree", timeout=0) is not None
+
+
+def test_get_build_args_maps_environment_flags(tmp_path):
+    args = get_build_args(
+        "tree.sqlite3",
+        tmp_path / "temporary" / "tree",
+        tmp_path,
+        {
+            "HASH_CHECK_ENABLED": "false",
+            "HASH_STAT_CHECK_ENABLED": "true",
+            "HASH_ALGORITHM": "blake2b",
+            "KEEP_GEOJSON": "true",
+            "STACK_BUILD": "true",
+            "BUILD_JOBS": "4",
+        },
+    )
+    assert "--hash-check-enabled" not in args
+    assert "--hash-stat-check-enabled" in args
+    assert args[args.index("--hash-algorithm") + 1] == "blake2b"
+    assert "--hash-generation-enabled" in args
+    assert "--keep-geojson" in args
+    # The queue rebuilds the stack itself once the database's tiles are swapped in
+    assert "--stack-dir" not in args
+    assert args[args.index("--jobs") + 1] == "4"
+    assert args[args.index("--tile-format") + 1] == "mbtiles"
+
+
+def test_download_database_keeps_the_source_mtime_and_skips_unchanged_sources(tmp_path):
+    source_path = tmp_path / "source" / "tree.sqlite3"
+    source_path.parent.mkdir()
+    source_path.write_text("v1")
+    os.utime(source_path, ns=(1_000_000_000_000_000_000, 1_000_000_000_000_000_000))
+    entity_path = tmp_path / "tree.sqlite3"
+    event = {"path": str(source_path)}
+
+    assert download_database(event, entity_path)
+    assert entity_path.stat().st_mtime_ns == source_path.stat().st_mtime_ns
+    assert not download_database(event, entity_path)
+
+    # A build that converted it to GeoJSON changed it, so only a resumed build keeps it
+    entity_path.write_text("v1 converted")
+    assert not download_database(event, entity_path, keep_unchanged=True)
+    assert entity_path.read_text() == "v1 converted"
+    assert download_database(event, entity_path)
+    assert entity_path.read_text() == "v1"
+
+    entity_path.write_text("v1 converted")
+    source_path.write_text("v2")
+    assert download_database(event, entity_path, keep_unchanged=True)
+    assert entity_path.read_text() == "v2"
+
+
+def test_get_source_stat_reads_s3_last_modified(monkeypatch):
+    def head_object(command, **kwargs):
+        assert command[:3] == ["aws", "s3api", "head-object"]
+        head = {"ContentLength": 1024, "LastModified": "2024-05-01T10:00:00+00:00"}
+        return subprocess.CompletedProcess(command, 0, stdout=json.dumps(head))
+
+    monkeypatch.setattr(subprocess, "run", head_object)
+
+    assert get_source_stat({"s3_object_arn": "arn:aws:s3:::bucket/collection/dataset/tree.sqlite3"}) == {
+        "size": 1024,
+        "mtime": 1714557600 * 1_000_000_000,
+    }
+
+
+def test_process_queue_builds_and_swaps_each_database_once(queue_paths):
+    sources = {
+        "tree": write_source(queue_paths, "tree"),
+        "park": write_source(queue_paths, "park"),
+        "broken": write_source(queue_paths, "broken", "failed", 1),
+    }
+    for event_id, name in enumerate(["tree", "park", "tree", "broken", "tree"]):
+        enqueue_event(queue_paths["queue"], {"event_id": str(event_id), "path": sources[name]})
+    enqueue_event(queue_paths["queue"], {"event_id": "entity", "path": "/data/entity.sqlite3"})
+    (queue_paths["tiles"] / "park.pmtiles").write_text("old")
+
+    results = process_queue(
+        queue_paths["queue"],
+        queue_paths["tiles"],
+        queue_paths["work"],
+        max_builds=2,
+        env={},
+        build_command=queue_paths["build_command"],
+    )
+
+    assert results == {"tree": "built", "park": "built", "broken": "failed"}
+    assert (queue_paths["tiles"] / "tree.mbtiles").read_text() == "tree"
+    assert (queue_paths["tiles"] / "park.mbtiles").read_text() == "park"
+    assert not (queue_paths["tiles"] / "park.pmtiles").exists()
+    assert not (queue_paths["tiles"] / "broken.mbtiles").exists()
+    assert (queue_paths["tiles"] / "updated").exists()
+    assert not (queue_paths["tiles"] / "temporary" / "tree").exists()
+    assert list(queue_paths["queue"].glob("*.json")) == []
+    assert list((queue_paths["queue"] / "processing").iterdir()) == []
+    failed = list((queue_paths["queue"] / FAILED_DIR).iterdir())
+    assert [json.loads(path.read_text())["event_id"] for path in failed] == ["3"]
+
+
+def test_process_queue_keeps_tiles_of_unchanged_and_failed_datasets(queue_paths):
+    tiles = queue_paths["tiles"]
+    for name in ["same", "collection", "collection-document", "collection-area"]:
+        (tiles / f"{name}.mbtiles").write_text("old")
+    enqueue_event(
+        queue_paths["queue"],
+        {"event_id": "1", "path": write_source(queue_paths, "same", "unchanged", 1, {})},
+    )
+    enqueue_event(
+        queue_paths["queue"],
+        {
+            "event_id": "2",
+            "path": write_source(
+                queue_paths,
+                "collection",
+                "partial",
+                0,
+                # collection-area was skipped as unchanged, so the build does not mention it
+                {"collection": False, "collection-document": True},
+            ),
+        },
+    )
+
+    results = process_queue(
+        queue_paths["queue"],
+        tiles,
+        queue_paths["work"],
+        env={},
+        build_command=queue_paths["build_command"],
+    )
+
+    assert results == {"same": "unchanged", "collection": "partial"}
+    assert (tiles / "same.mbtiles").read_text() == "old"
+    assert (tiles / "collection.mbtiles").read_text() == "old"
+    assert (tiles / "collection-document.mbtiles").read_text() == "collection"
+    assert (tiles / "collection-area.mbtiles").read_text() == "old"
+    assert not (tiles / "temporary" / "same").exists()
+    assert not (queue_paths["queue"] / FAILED_DIR).exists()
+
+
+def test_process_queue_keeps_snapshots_for_the_next_incremental_build(queue_paths):
+    tiles = queue_paths["tiles"]
+    source = write_source(queue_paths, "tree")
+
+    def build(env):
+        enqueue_event(queue_paths["queue"], {"event_id": "1", "path": source})
+        return process_queue(
+            queue_paths["queue"], tiles, queue_paths["work"], env=env, build_command=queue_paths["build_command"]
+        )
+
+    assert build({"INCREMENTAL_BUILD": "true"}) == {"tree": "built"}
+    assert (tiles / "tree.mbtiles").read_text() == "tree"
+    assert (tiles / "tree.snapshot.sqlite3").is_file()
+
+    assert build({"INCREMENTAL_BUILD": "true"}) == {"tree": "built"}
+    assert (tiles / "tree.mbtiles").read_text() == "tree patched"
+
+    # A full build leaves no snapshot, so a stale one would be diffed against the wrong tiles
+    assert build({}) == {"tree": "built"}
+    assert (tiles / "tree.mbtiles").read_text() == "tree"
+    assert not (tiles / "tree.snapshot.sqlite3").exists()
+
+
+def test_process_queue_rebuilds_the_stack_from_every_swapped_database(queue_paths):
+    tiles = queue_paths["tiles"]
+    (tiles / "tiles-stack.mbtiles").write_text("old")
+    (tiles / "park.mbtiles").write_text("old park")
+    for name in ["tree", "park"]:
+        enqueue_event(queue_paths["queue"], {"event_id": name, "path": write_source(queue_paths, name)})
+
+    results = process_queue(
+        queue_paths["queue"],
+        tiles,
+        queue_paths["work"],
+        max_builds=2,
+        env={"STACK_BUILD": "true"},
+        build_command=queue_paths["build_command"],
+    )
+
+    assert results == {"tree": "built", "park": "built"}
+    # Whichever build joined the stack last, it joined both databases' new tiles
+    assert (tiles / "tiles-stack.mbtiles").read_text() == "tree,park"
+    assert not (tiles / "temporary" / "tiles-stack").exists()
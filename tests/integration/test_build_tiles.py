@@ -1,12 +1,56 @@
+import gzip
 import json
+import os
+import numpy as np
 import pandas as pd
 import pytest
+import shutil
 import sqlite3
+import struct
+import sys
+from click.testing import CliRunner
 
+import task.build_tiles
 from task.build_tiles import (
     get_geography_datasets,
+    get_resumable_datasets,
+    get_rowid_ranges,
+    get_stack_sources,
+    main,
+    new_compaction_sizes,
+    merge_vector_layer_fields,
+    convert_mbtiles_to_pmtiles,
     create_geojson_from_wkt,
+    ensure_dataset_index,
+    export_all_dataset_features,
+    get_affected_tiles,
+    get_available_memory,
+    get_changed_bounds,
     get_dataset_features,
+    get_dataset_fingerprints,
+    get_dataset_memory_estimates,
+    get_dataset_stats,
+    get_tile_counts,
+    iter_dataset_features,
+    iter_dataset_features_from_wkt,
+    load_tippecanoe_profiles,
+    new_build_metrics,
+    new_checkpoint,
+    patch_mbtiles,
+    profiles_use_extent,
+    read_checkpoint,
+    run,
+    select_entities_touching_tiles,
+    select_tippecanoe_profile,
+    set_mbtiles_bounds,
+    timed_stage,
+    wkt_to_geojson_features,
+    write_build_metrics,
+    write_checkpoint,
+    write_dataset_features,
+    zxy_to_tile_id,
+    build_dataset_tiles_incrementally,
+    write_entity_snapshot,
 )
 
 
@@ -207,3 +251,950 @@ def test_get_dataset_features_returns_value_for_good_data(entity_sqlite_path):
 
     result = get_dataset_features(entity_sqlite_path, "central-activities-zone")
     assert result != ""
+
+
+def test_wkt_to_geojson_features_rounds_coordinates_and_skips_missing():
+    result = wkt_to_geojson_features(
+        ["POINT(-3.9055591234 50.5821371234)", None, "NOT WKT"]
+    )
+
+    assert json.loads(result[0]) == {
+        "type": "Feature",
+        "geometry": {"type": "Point", "coordinates": [-3.905559, 50.582137]},
+    }
+    assert result[1] is None
+    assert result[2] is None
+
+
+def test_wkt_to_geojson_features_keeps_z_and_skips_empty_geometries():
+    result = wkt_to_geojson_features(
+        ["POINT Z(-3.9055591234 50.5821371234 12.3456789)", "POINT(1 2)", "POLYGON EMPTY"]
+    )
+
+    assert json.loads(result[0])["geometry"]["coordinates"] == [-3.905559, 50.582137, 12.345679]
+    assert json.loads(result[1])["geometry"]["coordinates"] == [1.0, 2.0]
+    assert result[2] is None
+
+
+def test_write_dataset_features_writes_one_feature_per_line(entity_sqlite_path, tmp_path):
+    test_data = pd.DataFrame.from_dict(
+        {
+            "dataset": ["national-park", "national-park", "central-activities-zone"],
+            "entity": [520001, 520002, 520003],
+            "geojson": [
+                '{"geometry": {"coordinates": [-3.905559, 50.582137], "type": "Point"}, "type": "Feature"}',
+                '{"geometry": {"coordinates": [-3.652891, 51.142985], "type": "Point"}, "type": "Feature"}',
+                '{"geometry": {"coordinates": [-3.652891, 51.142985], "type": "Point"}, "type": "Feature"}',
+            ],
+            "geometry": ["", "", ""],
+            "point": ["", "", ""],
+            "reference": ["1", "2", "3"],
+        }
+    )
+
+    with sqlite3.connect(entity_sqlite_path) as conn:
+        test_data.to_sql("entity", conn, if_exists="append", index=False)
+    conn.close()
+
+    result = write_dataset_features(entity_sqlite_path, tmp_path, "national-park")
+    assert result == 2
+
+    with open(tmp_path / "national-park.geojson") as f:
+        features = [json.loads(line) for line in f]
+    assert [feature["tippecanoe"]["layer"] for feature in features] == [
+        "national-park",
+        "national-park",
+    ]
+    assert [feature["properties"]["entity"] for feature in features] == [520001, 520002]
+
+
+def test_run_streams_input_lines_to_stdin(tmp_path):
+    output_file = tmp_path / "stdin.txt"
+
+    proc = run(f"cat > {output_file}", "[test]", input_lines=iter(["a", "b", "c"]))
+
+    assert proc.returncode == 0
+    assert output_file.read_text() == "a\nb\nc\n"
+
+
+def test_run_fails_when_input_lines_raise(tmp_path):
+    output_file = tmp_path / "stdin.txt"
+
+    def lines():
+        yield "a"
+        raise sqlite3.OperationalError("disk I/O error")
+
+    result = run(f"cat > {output_file}", "[test]", input_lines=lines())
+
+    assert result.returncode != 0
+
+
+def test_get_dataset_memory_estimates_scales_with_feature_size(entity_sqlite_path):
+    test_data = pd.DataFrame.from_dict(
+        {
+            "dataset": ["national-park", "national-park", "central-activities-zone"],
+            "entity": [520001, 520002, 520003],
+            "geojson": ["x" * 100, "x" * 200, ""],
+            "geometry": ["", "", ""],
+            "point": ["POINT(1 2)", "POINT(1 2)", "POINT(-3.905559 50.582137)"],
+            "reference": ["1", "2", "3"],
+        }
+    )
+
+    with sqlite3.connect(entity_sqlite_path) as conn:
+        test_data.to_sql("entity", conn, if_exists="append", index=False)
+    conn.close()
+
+    result = get_dataset_memory_estimates(entity_sqlite_path)
+    assert set(result.keys()) == {"national-park", "central-activities-zone"}
+    assert result["national-park"] >= 300
+    assert result["central-activities-zone"] >= len("POINT(-3.905559 50.582137)")
+
+
+def test_get_dataset_fingerprints_only_changes_for_modified_dataset(entity_sqlite_path):
+    test_data = pd.DataFrame.from_dict(
+        {
+            "dataset": ["national-park", "central-activities-zone"],
+            "entity": [520001, 520002],
+            "geojson": ["", ""],
+            "geometry": ["", ""],
+            "point": ["POINT(-3.905559 50.582137)", "POINT(-3.652891 51.142985)"],
+            "reference": ["1", "2"],
+        }
+    )
+
+    with sqlite3.connect(entity_sqlite_path) as conn:
+        test_data.to_sql("entity", conn, if_exists="append", index=False)
+    conn.close()
+
+    before = get_dataset_fingerprints(entity_sqlite_path)
+
+    with sqlite3.connect(entity_sqlite_path) as conn:
+        conn.execute("UPDATE entity SET name = 'renamed' WHERE entity = 520001")
+    conn.close()
+
+    after = get_dataset_fingerprints(entity_sqlite_path)
+    assert set(after.keys()) == {"national-park", "central-activities-zone"}
+    assert after["national-park"] != before["national-park"]
+    assert after["central-activities-zone"] == before["central-activities-zone"]
+
+
+def test_run_reports_exit_code_and_resource_usage():
+    result = run("echo hello && exit 3", "[test]")
+
+    assert result.returncode == 3
+    assert result.wall_time >= 0
+    assert result.cpu_time >= 0
+    assert result.max_rss > 0
+
+
+def test_run_kills_command_after_timeout():
+    result = run("sleep 10", "[test]", timeout=1)
+
+    assert result.returncode < 0
+    assert result.wall_time < 10
+
+
+def test_iter_dataset_features_from_wkt_matches_written_geojson(entity_sqlite_path):
+    test_data = pd.DataFrame.from_dict(
+        {
+            "dataset": ["central-activities-zone", "central-activities-zone"],
+            "entity": [520001, 520002],
+            "name": ["test1", "test2"],
+            "json": ['{"notes": "a"}', None],
+            "geojson": ["", ""],
+            "geometry": [
+                "MULTIPOLYGON (((1.085705 51.280868,1.085752 51.280805,1.086082 51.280894,1.085705 51.280868)))",
+                "",
+            ],
+            "point": ["POINT(1.085891 51.280879)", "POINT(-3.905559 50.582137)"],
+            "reference": ["1", "2"],
+        }
+    )
+
+    with sqlite3.connect(entity_sqlite_path) as conn:
+        test_data.to_sql("entity", conn, if_exists="append", index=False)
+    conn.close()
+
+    read_only_features = [
+        json.loads(feature)
+        for feature in iter_dataset_features_from_wkt(
+            entity_sqlite_path, "central-activities-zone"
+        )
+    ]
+
+    create_geojson_from_wkt(entity_sqlite_path)
+    written_features = [
+        json.loads(feature)
+        for feature in iter_dataset_features(
+            entity_sqlite_path, "central-activities-zone"
+        )
+    ]
+
+    assert read_only_features == written_features
+    assert read_only_features[0]["properties"]["notes"] == "a"
+
+
+def test_get_changed_bounds_includes_old_and_new_bounds():
+    previous = {1: ("a", 0, 0, 1, 1), 2: ("b", 5, 5, 6, 6), 3: ("c", 9, 9, 9, 9)}
+    current = {1: ("a", 0, 0, 1, 1), 2: ("b2", 7, 7, 8, 8), 4: ("d", 3, 3, 3, 3)}
+
+    result = get_changed_bounds(previous, current)
+
+    assert sorted(result) == [(3, 3, 3, 3), (5, 5, 6, 6), (7, 7, 8, 8), (9, 9, 9, 9)]
+
+
+def test_get_affected_tiles_for_a_point():
+    result = get_affected_tiles([(-0.1276, 51.5072, -0.1276, 51.5072)], 4, 15)
+
+    assert set(result.keys()) == set(range(4, 16))
+    # London sits just inside the buffer of the tile to its east at z4
+    assert result[4] == {(7, 5), (8, 5)}
+    assert result[15] == {(16372, 10896)}
+
+
+def test_get_affected_tiles_gives_up_above_max_tiles():
+    result = get_affected_tiles([(-5.0, 50.0, 1.5, 55.0)], 4, 15, max_tiles=1000)
+
+    assert result is None
+
+
+def test_select_entities_touching_tiles():
+    entity_ids = np.array([1, 2, 3])
+    entity_bounds = np.array(
+        [
+            (-0.1276, 51.5072, -0.1276, 51.5072),
+            (-3.1883, 55.9533, -3.1883, 55.9533),
+            (-1.0, 51.0, 1.0, 52.0),
+        ]
+    )
+    tiles = get_affected_tiles([(-0.1276, 51.5072, -0.1276, 51.5072)], 12, 12)[12]
+
+    result = select_entities_touching_tiles(entity_ids, entity_bounds, 12, tiles)
+
+    assert result.tolist() == [1, 3]
+
+
+def test_patch_mbtiles_replaces_and_removes_affected_tiles(tmp_path):
+    create_tiles_sql = """
+        CREATE TABLE tiles (
+            zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB
+        )
+    """
+    target = tmp_path / "target.mbtiles"
+    source = tmp_path / "source.mbtiles"
+    with sqlite3.connect(target) as conn:
+        conn.execute(create_tiles_sql)
+        conn.executemany(
+            "INSERT INTO tiles VALUES (?, ?, ?, ?)",
+            [(4, 7, 10, b"old"), (4, 8, 10, b"old"), (4, 9, 10, b"untouched")],
+        )
+    conn.close()
+    with sqlite3.connect(source) as conn:
+        conn.execute(create_tiles_sql)
+        conn.executemany(
+            "INSERT INTO tiles VALUES (?, ?, ?, ?)",
+            [(4, 7, 10, b"new"), (4, 9, 10, b"ignored")],
+        )
+    conn.close()
+
+    patch_mbtiles(target, {4: {(7, 5), (8, 5)}}, source)
+
+    with sqlite3.connect(target) as conn:
+        rows = conn.execute(
+            "SELECT tile_column, tile_data FROM tiles ORDER BY tile_column"
+        ).fetchall()
+    conn.close()
+    assert rows == [(7, b"new"), (9, b"untouched")]
+
+
+def test_patched_metadata_gains_new_fields_and_bounds(tmp_path):
+    def write_metadata(path, metadata):
+        with sqlite3.connect(path) as conn:
+            conn.execute("CREATE TABLE metadata (name TEXT, value TEXT)")
+            conn.executemany("INSERT INTO metadata VALUES (?, ?)", metadata.items())
+        conn.close()
+
+    target = tmp_path / "target.mbtiles"
+    source = tmp_path / "source.mbtiles"
+    write_metadata(
+        target,
+        {
+            "bounds": "0.000000,50.000000,1.000000,51.000000",
+            "center": "0.500000,50.500000,4",
+            "json": json.dumps({"vector_layers": [{"id": "park", "fields": {"name": "String"}}]}),
+        },
+    )
+    write_metadata(
+        source,
+        {"json": json.dumps({"vector_layers": [{"id": "park", "fields": {"name": "Number", "notes": "String"}}]})},
+    )
+
+    merge_vector_layer_fields(target, source)
+    set_mbtiles_bounds(target, (-1.0, 50.0, 1.0, 52.0))
+
+    with sqlite3.connect(target) as conn:
+        metadata = dict(conn.execute("SELECT name, value FROM metadata"))
+    conn.close()
+    assert json.loads(metadata["json"])["vector_layers"] == [
+        {"id": "park", "fields": {"name": "String", "notes": "String"}}
+    ]
+    assert metadata["bounds"] == "-1.000000,50.000000,1.000000,52.000000"
+    assert metadata["center"] == "0.000000,51.000000,4"
+
+
+@pytest.mark.parametrize("read_only", [False, True])
+def test_export_all_dataset_features_matches_per_dataset_export(
+    entity_sqlite_path, tmp_path, read_only
+):
+    test_data = pd.DataFrame.from_dict(
+        {
+            "dataset": ["national-park", "national-park", "central-activities-zone"],
+            "entity": [520001, 520002, 520003],
+            "name": ["test1", "test2", "test3"],
+            "geojson": ["", "", ""],
+            "geometry": ["", "", ""],
+            "point": [
+                "POINT(-3.905559 50.582137)",
+                "POINT(-3.652891 51.142985)",
+                "POINT(1.085891 51.280879)",
+            ],
+            "reference": ["1", "2", "3"],
+        }
+    )
+
+    with sqlite3.connect(entity_sqlite_path) as conn:
+        test_data.to_sql("entity", conn, if_exists="append", index=False)
+        conn.execute("INSERT INTO old_entity (old_entity, entity) VALUES ('520002', 520001)")
+    conn.close()
+    if not read_only:
+        create_geojson_from_wkt(entity_sqlite_path)
+
+    single_pass_path = tmp_path / "single"
+    per_dataset_path = tmp_path / "per-dataset"
+    single_pass_path.mkdir()
+    per_dataset_path.mkdir()
+
+    datasets = ["national-park", "central-activities-zone"]
+    counts = export_all_dataset_features(
+        entity_sqlite_path, single_pass_path, datasets, read_only
+    )
+    for dataset in datasets:
+        write_dataset_features(entity_sqlite_path, per_dataset_path, dataset, read_only)
+
+    assert counts == {"national-park": 1, "central-activities-zone": 1}
+    for dataset in datasets:
+        single_pass = (single_pass_path / f"{dataset}.geojson").read_text()
+        per_dataset = (per_dataset_path / f"{dataset}.geojson").read_text()
+        assert [json.loads(line) for line in single_pass.splitlines()] == [
+            json.loads(line) for line in per_dataset.splitlines()
+        ]
+
+
+def test_wkt_to_geojson_features_compacts_geometries():
+    result = wkt_to_geojson_features(
+        [
+            "POLYGON((0 0, 1 0, 1 1, 1.00000001 1.00000001, 0 1, 0 0))",
+            "POLYGON((0 0, 1 1, 1 0, 0 1, 0 0))",
+            "POLYGON((0 0, 0.00000001 0, 0.00000001 0.00000001, 0 0))",
+        ],
+        compact_precision=7,
+    )
+
+    square = json.loads(result[0])["geometry"]
+    assert square["type"] == "Polygon"
+    assert len(square["coordinates"][0]) == 5
+    # the self-intersecting bowtie is repaired into two triangles
+    assert json.loads(result[1])["geometry"]["type"] == "MultiPolygon"
+    # a polygon smaller than the precision grid collapses away
+    assert result[2] is None
+
+
+def test_wkt_to_geojson_features_measures_compaction():
+    wkts = ["LINESTRING(0.123456789 0.123456789, 0.1234568 0.1234568, 1.987654321 1.987654321)"]
+    compaction_sizes = new_compaction_sizes()
+
+    compacted = wkt_to_geojson_features(wkts, compact_precision=3, compaction_sizes=compaction_sizes)
+
+    uncompacted = wkt_to_geojson_features(wkts)
+    geometry_prefix = len('{"type": "Feature", "geometry": ')
+    assert compaction_sizes == {
+        "uncompacted": len(uncompacted[0]) - geometry_prefix - 1,
+        "compacted": len(compacted[0]) - geometry_prefix - 1,
+    }
+    assert compaction_sizes["compacted"] < compaction_sizes["uncompacted"]
+
+
+def test_wkt_to_geojson_features_only_measures_a_sample_of_compaction(monkeypatch):
+    monkeypatch.setattr(task.build_tiles, "COMPACTION_SAMPLE_SIZE", 1)
+    wkts = ["POINT(0.123456789 0.123456789)", "LINESTRING(0.123456789 0.123456789, 1.987654321 1.987654321)"]
+    compaction_sizes = new_compaction_sizes()
+
+    compacted = wkt_to_geojson_features(wkts, compact_precision=3, compaction_sizes=compaction_sizes)
+
+    uncompacted = wkt_to_geojson_features(wkts[:1])
+    geometry_prefix = len('{"type": "Feature", "geometry": ')
+    assert compaction_sizes == {
+        "uncompacted": len(uncompacted[0]) - geometry_prefix - 1,
+        "compacted": len(compacted[0]) - geometry_prefix - 1,
+    }
+    assert len(compacted) == 2
+
+
+def test_get_dataset_stats(entity_sqlite_path):
+    test_data = pd.DataFrame.from_dict(
+        {
+            "dataset": ["national-park", "national-park", "national-park"],
+            "entity": [520001, 520002, 520003],
+            "geojson": ["", "", ""],
+            "geometry": ["", "", "POLYGON((0 50, 2 50, 2 52, 0 52, 0 50))"],
+            "point": ["POINT(-2 50)", "POINT(-1 51)", ""],
+            "reference": ["1", "2", "3"],
+        }
+    )
+
+    with sqlite3.connect(entity_sqlite_path) as conn:
+        test_data.to_sql("entity", conn, if_exists="append", index=False)
+    conn.close()
+
+    result = get_dataset_stats(entity_sqlite_path, "national-park")
+    assert result["features"] == 3
+    assert result["point_ratio"] == pytest.approx(2 / 3)
+    assert result["extent"] == pytest.approx(8.0)
+    assert get_dataset_stats(entity_sqlite_path, "national-park", extent=False) == {
+        "features": 3,
+        "point_ratio": pytest.approx(2 / 3),
+        "extent": None,
+    }
+
+
+def test_profiles_use_extent():
+    shipped = load_tippecanoe_profiles(task.build_tiles.DEFAULT_TIPPECANOE_PROFILES_PATH)
+    assert not profiles_use_extent(shipped)
+    shipped["rules"].append({"profile": "default", "max_extent": 1.0})
+    assert profiles_use_extent(shipped)
+
+
+def test_select_tippecanoe_profile(tmp_path):
+    profiles_path = tmp_path / "profiles.json"
+    profiles_path.write_text(
+        json.dumps(
+            {
+                "profiles": {"dense": {"args": ["-zg"]}, "custom": {"args": ["-z12"]}},
+                "rules": [{"profile": "dense", "min_point_ratio": 0.9, "min_features": 100}],
+                "datasets": {"tree": "custom"},
+            }
+        )
+    )
+    profiles = load_tippecanoe_profiles(profiles_path)
+
+    dense_stats = {"features": 500, "point_ratio": 1.0, "extent": 1.0}
+    polygon_stats = {"features": 500, "point_ratio": 0.1, "extent": 1.0}
+    assert select_tippecanoe_profile(profiles, "tree-preservation-zone", dense_stats)[0] == "dense"
+    assert select_tippecanoe_profile(profiles, "tree", dense_stats)[0] == "custom"
+    name, profile = select_tippecanoe_profile(profiles, "conservation-area", polygon_stats)
+    assert name == "default"
+    assert profile["patchable"] is True
+
+
+def test_load_tippecanoe_profiles_rejects_unknown_profiles(tmp_path):
+    profiles_path = tmp_path / "profiles.json"
+    profiles_path.write_text(json.dumps({"datasets": {"tree": "missing"}}))
+
+    with pytest.raises(ValueError):
+        load_tippecanoe_profiles(profiles_path)
+
+
+def test_get_tile_counts_groups_tiles_by_zoom(tmp_path):
+    mbtiles_path = tmp_path / "test.mbtiles"
+    with sqlite3.connect(mbtiles_path) as conn:
+        conn.execute(
+            "CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB)"
+        )
+        conn.executemany(
+            "INSERT INTO tiles VALUES (?, ?, ?, ?)",
+            [(4, 7, 10, b""), (5, 14, 20, b""), (5, 15, 20, b"")],
+        )
+    conn.close()
+
+    assert get_tile_counts(mbtiles_path) == {"4": 1, "5": 2}
+    assert get_tile_counts(tmp_path / "missing.mbtiles") is None
+
+
+def test_write_build_metrics(tmp_path):
+    metrics = new_build_metrics("test.sqlite3")
+    with timed_stage(metrics, "build_tiles"):
+        metrics["datasets"] = {"a-ds": {"dataset": "a-ds", "success": True}}
+
+    metrics_path = tmp_path / "test.metrics.json"
+    write_build_metrics(metrics_path, metrics, "built")
+
+    with open(metrics_path) as file:
+        report = json.load(file)
+    assert report["schema_version"] == 1
+    assert report["status"] == "built"
+    assert report["stages"]["build_tiles"]["seconds"] >= 0
+    assert report["datasets"]["a-ds"]["success"]
+    assert report["peak_rss_kb"] > 0
+    assert "_started" not in report
+
+
+def read_varint(data, position):
+    value = shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, position
+        shift += 7
+
+
+def read_pmtiles_directory(data):
+    data = gzip.decompress(data)
+    count, position = read_varint(data, 0)
+    columns = []
+    for _ in range(4):
+        column = []
+        for _ in range(count):
+            value, position = read_varint(data, position)
+            column.append(value)
+        columns.append(column)
+    tile_ids, run_lengths, lengths, offsets = columns
+    entries = []
+    for i in range(count):
+        tile_id = tile_ids[i] + (entries[-1][0] if entries else 0)
+        if offsets[i] == 0:
+            offset = entries[-1][1] + entries[-1][2]
+        else:
+            offset = offsets[i] - 1
+        entries.append((tile_id, offset, lengths[i], run_lengths[i]))
+    return entries
+
+
+def read_pmtiles_tile(path, zoom, x, y):
+    with open(path, "rb") as file:
+        data = file.read()
+    assert data[:7] == b"PMTiles"
+    header = struct.unpack("<BQQQQQQQQQQQBBBBBBiiiiBii", data[7:127])
+    root_offset, root_length, _, _, leaves_offset, _, tile_data_offset = header[1:8]
+    tile_id = zxy_to_tile_id(zoom, x, y)
+    entries = read_pmtiles_directory(data[root_offset:root_offset + root_length])
+    while True:
+        matching = [entry for entry in entries if entry[0] <= tile_id]
+        if not matching:
+            return None
+        entry_id, offset, length, run_length = matching[-1]
+        if run_length == 0:
+            start = leaves_offset + offset
+            entries = read_pmtiles_directory(data[start:start + length])
+        elif tile_id < entry_id + run_length:
+            return data[tile_data_offset + offset:tile_data_offset + offset + length]
+        else:
+            return None
+
+
+def create_mbtiles(path, tiles):
+    with sqlite3.connect(path) as conn:
+        conn.execute("CREATE TABLE metadata (name TEXT, value TEXT)")
+        conn.executemany(
+            "INSERT INTO metadata VALUES (?, ?)",
+            [
+                ("name", "test"),
+                ("format", "pbf"),
+                ("bounds", "-1.0,51.0,1.0,52.0"),
+                ("json", json.dumps({"vector_layers": [{"id": "test"}]})),
+            ],
+        )
+        conn.execute(
+            "CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB)"
+        )
+        conn.executemany("INSERT INTO tiles VALUES (?, ?, ?, ?)", tiles)
+    conn.close()
+
+
+def test_zxy_to_tile_id():
+    assert [zxy_to_tile_id(0, 0, 0), zxy_to_tile_id(1, 0, 0), zxy_to_tile_id(1, 0, 1)] == [0, 1, 2]
+    assert zxy_to_tile_id(2, 0, 0) == 5
+    assert zxy_to_tile_id(12, 3423, 1763) == 19078479
+
+
+def test_convert_mbtiles_to_pmtiles(tmp_path):
+    mbtiles_path = tmp_path / "test.mbtiles"
+    pmtiles_path = tmp_path / "test.pmtiles"
+    # mbtiles rows count from the bottom, so row 1 at zoom 1 is XYZ y 0
+    create_mbtiles(
+        mbtiles_path,
+        [
+            (0, 0, 0, gzip.compress(b"world")),
+            (1, 0, 1, gzip.compress(b"north-west")),
+            (1, 0, 0, gzip.compress(b"same")),
+            (1, 1, 0, gzip.compress(b"same")),
+        ],
+    )
+
+    assert convert_mbtiles_to_pmtiles(mbtiles_path, pmtiles_path) == 4
+
+    with open(pmtiles_path, "rb") as file:
+        data = file.read()
+    header = struct.unpack("<BQQQQQQQQQQQBBBBBBiiiiBii", data[7:127])
+    version, metadata_offset, metadata_length = header[0], header[3], header[4]
+    assert version == 3
+    assert header[9:12] == (4, 3, 3)
+    assert header[12:18] == (1, 2, 2, 1, 0, 1)
+    metadata = json.loads(gzip.decompress(data[metadata_offset:metadata_offset + metadata_length]))
+    assert metadata["vector_layers"] == [{"id": "test"}]
+    assert gzip.decompress(read_pmtiles_tile(pmtiles_path, 0, 0, 0)) == b"world"
+    assert gzip.decompress(read_pmtiles_tile(pmtiles_path, 1, 0, 0)) == b"north-west"
+    assert gzip.decompress(read_pmtiles_tile(pmtiles_path, 1, 0, 1)) == b"same"
+    assert gzip.decompress(read_pmtiles_tile(pmtiles_path, 1, 1, 1)) == b"same"
+    assert read_pmtiles_tile(pmtiles_path, 1, 1, 0) is None
+
+
+def test_convert_mbtiles_to_pmtiles_with_leaf_directories(tmp_path, monkeypatch):
+    monkeypatch.setattr(task.build_tiles, "PMTILES_ROOT_DIRECTORY_SIZE", 64)
+    monkeypatch.setattr(task.build_tiles, "PMTILES_LEAF_DIRECTORY_ENTRIES", 8)
+    mbtiles_path = tmp_path / "test.mbtiles"
+    pmtiles_path = tmp_path / "test.pmtiles"
+    tiles = [(4, x, y, f"{x}/{y}".encode()) for x in range(16) for y in range(16)]
+    create_mbtiles(mbtiles_path, tiles)
+
+    convert_mbtiles_to_pmtiles(mbtiles_path, pmtiles_path)
+
+    for x, row, data in [(0, 0, b"0/0"), (7, 9, b"7/9"), (15, 15, b"15/15")]:
+        assert read_pmtiles_tile(pmtiles_path, 4, x, 15 - row) == data
+
+
+def test_get_stack_sources_prefers_new_tiles_in_priority_order(tmp_path):
+    stack_dir = tmp_path / "tiles"
+    output_dir = tmp_path / "temporary"
+    stack_dir.mkdir()
+    output_dir.mkdir()
+    for name in ["a-ds", "b-ds", "tiles-stack"]:
+        (stack_dir / f"{name}.mbtiles").touch()
+    for name in ["b-ds", "c-ds", "failed-ds"]:
+        (output_dir / f"{name}.mbtiles").touch()
+
+    sources = get_stack_sources(stack_dir, output_dir, ["b-ds", "c-ds"])
+
+    assert sources == [
+        output_dir / "c-ds.mbtiles",
+        output_dir / "b-ds.mbtiles",
+        stack_dir / "a-ds.mbtiles",
+    ]
+
+
+# Writes the names of the mbtiles it joins, in order, as its output
+FAKE_TILE_JOIN = """
+import sys
+from pathlib import Path
+
+output = next(arg[len("--output="):] for arg in sys.argv if arg.startswith("--output="))
+Path(output).write_text(",".join(Path(arg).stem for arg in sys.argv[1:] if not arg.startswith("--")))
+"""
+
+
+def test_main_stack_only_joins_the_served_tiles(entity_sqlite_path, tmp_path, monkeypatch):
+    bin_dir = tmp_path / "bin"
+    stack_dir = tmp_path / "tiles"
+    output_dir = tmp_path / "temporary"
+    for path in [bin_dir, stack_dir, output_dir]:
+        path.mkdir()
+    tile_join_path = bin_dir / "tile-join"
+    tile_join_path.write_text(f"#!{sys.executable}\n{FAKE_TILE_JOIN}")
+    tile_join_path.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    for name in ["a-ds", "b-ds", "tiles-stack"]:
+        (stack_dir / f"{name}.mbtiles").touch()
+
+    result = CliRunner().invoke(
+        main,
+        [
+            "--entity-path",
+            entity_sqlite_path,
+            "--output-dir",
+            str(output_dir),
+            "--stack-dir",
+            str(stack_dir),
+            "--stack-only",
+        ],
+    )
+
+    assert result.exit_code == 0, result.output
+    assert [path.name for path in output_dir.iterdir()] == ["tiles-stack.mbtiles"]
+    assert (output_dir / "tiles-stack.mbtiles").read_text() == "b-ds,a-ds"
+
+
+def test_ensure_dataset_index_creates_one_index(entity_sqlite_path):
+    ensure_dataset_index(entity_sqlite_path)
+    ensure_dataset_index(entity_sqlite_path)
+
+    with sqlite3.connect(entity_sqlite_path) as conn:
+        indexes = [row[1] for row in conn.execute("PRAGMA index_list(entity)")]
+        (journal_mode,) = conn.execute("PRAGMA journal_mode").fetchone()
+    conn.close()
+    assert indexes == ["entity_dataset_index"]
+    assert journal_mode == "delete"
+
+
+def test_get_rowid_ranges_splits_rowids_with_gaps():
+    conn = sqlite3.connect(":memory:")
+    conn.execute("CREATE TABLE entity (entity INTEGER)")
+    conn.executemany("INSERT INTO entity (rowid, entity) VALUES (?, ?)", [(r, r) for r in [1, 2, 5, 6, 9, 20, 21]])
+
+    assert get_rowid_ranges(conn, 3) == [(1, 5), (6, 20), (21, 21)]
+    assert get_rowid_ranges(conn, 7) == [(1, 21)]
+    conn.execute("DELETE FROM entity")
+    assert get_rowid_ranges(conn, 3) == []
+    conn.close()
+
+
+def test_create_geojson_from_wkt_in_parallel_matches_single_process(
+    entity_sqlite_path, tmp_path, monkeypatch
+):
+    monkeypatch.setattr(task.build_tiles, "WKT_BATCH_SIZE", 3)
+    test_data = pd.DataFrame.from_dict(
+        {
+            "dataset": ["test-ds"] * 10 + ["other-ds"],
+            "entity": list(range(1, 12)),
+            "geometry": [""] * 10 + ["POINT (2 52)"],
+            "point": [f"POINT ({i / 10} 51.5)" for i in range(10)] + [""],
+        }
+    )
+    with sqlite3.connect(entity_sqlite_path) as conn:
+        test_data.to_sql("entity", conn, if_exists="append", index=False)
+    conn.close()
+    parallel_path = tmp_path / "parallel.sqlite3"
+    shutil.copyfile(entity_sqlite_path, parallel_path)
+
+    assert create_geojson_from_wkt(entity_sqlite_path, ["test-ds"])
+    assert create_geojson_from_wkt(parallel_path, ["test-ds"], jobs=2)
+
+    sql = "SELECT entity, geojson FROM entity ORDER BY entity"
+    with sqlite3.connect(entity_sqlite_path) as conn:
+        expected = conn.execute(sql).fetchall()
+    conn.close()
+    with sqlite3.connect(parallel_path) as conn:
+        actual = conn.execute(sql).fetchall()
+    conn.close()
+    assert actual == expected
+    assert json.loads(actual[9][1])["geometry"]["coordinates"] == [0.9, 51.5]
+    assert actual[10][1] is None
+
+
+def test_create_geojson_from_wkt_writes_nothing_when_a_range_fails(entity_sqlite_path, monkeypatch):
+    monkeypatch.setattr(task.build_tiles, "WKT_BATCH_SIZE", 3)
+    test_data = pd.DataFrame.from_dict(
+        {
+            "dataset": ["test-ds"] * 10,
+            "entity": list(range(1, 11)),
+            "geometry": [""] * 10,
+            "point": [f"POINT ({i / 10} 51.5)" for i in range(10)],
+        }
+    )
+    with sqlite3.connect(entity_sqlite_path) as conn:
+        test_data.to_sql("entity", conn, if_exists="append", index=False)
+    conn.close()
+    iter_wkt_conversions = task.build_tiles.iter_wkt_conversions
+
+    def failing_iter_wkt_conversions(*args, **kwargs):
+        conversions = iter_wkt_conversions(*args, **kwargs)
+        yield next(conversions)
+        raise sqlite3.OperationalError("disk I/O error")
+
+    monkeypatch.setattr(task.build_tiles, "iter_wkt_conversions", failing_iter_wkt_conversions)
+
+    assert not create_geojson_from_wkt(entity_sqlite_path)
+
+    with sqlite3.connect(entity_sqlite_path) as conn:
+        geojsons = [row[0] for row in conn.execute("SELECT geojson FROM entity")]
+    conn.close()
+    assert geojsons == [None] * 10
+
+
+def test_get_resumable_datasets_needs_matching_fingerprint_and_outputs(tmp_path):
+    checkpoint = new_checkpoint("options")
+    for dataset in ["a-ds", "b-ds", "c-ds"]:
+        checkpoint["datasets"][dataset] = {
+            "fingerprint": "1:abc",
+            "metrics": {"dataset": dataset, "success": True},
+        }
+    (tmp_path / "a-ds.mbtiles").touch()
+    (tmp_path / "b-ds.mbtiles").touch()
+    fingerprints = {"a-ds": "1:abc", "b-ds": "2:def", "c-ds": "1:abc"}
+
+    resumable = get_resumable_datasets(
+        checkpoint, ["a-ds", "b-ds", "c-ds", "d-ds"], fingerprints, tmp_path, False, "mbtiles"
+    )
+
+    assert resumable == {"a-ds": {"dataset": "a-ds", "success": True, "resumed": True}}
+
+
+def test_read_checkpoint_starts_again_for_other_options(tmp_path):
+    checkpoint_path = tmp_path / ".checkpoint.json"
+    checkpoint = new_checkpoint("options")
+    checkpoint["stages"]["create_geojson_from_wkt"] = {"datasets": ["a-ds"]}
+    write_checkpoint(checkpoint_path, checkpoint)
+
+    assert read_checkpoint(checkpoint_path, "options") == checkpoint
+    assert read_checkpoint(checkpoint_path, "other-options") == new_checkpoint("other-options")
+    assert read_checkpoint(tmp_path / "missing.json", "options") == new_checkpoint("options")
+
+
+def test_get_available_memory_uses_cgroup_limit(tmp_path):
+    unlimited = get_available_memory(tmp_path)
+
+    (tmp_path / "memory.max").write_text("max\n")
+    assert get_available_memory(tmp_path) == unlimited
+
+    (tmp_path / "memory.max").write_text("1073741824\n")
+    (tmp_path / "memory.current").write_text("268435456\n")
+    assert get_available_memory(tmp_path) == min(unlimited, 805306368)
+
+    (tmp_path / "memory.max").unlink()
+    (tmp_path / "memory").mkdir()
+    (tmp_path / "memory" / "memory.limit_in_bytes").write_text("536870912\n")
+    assert get_available_memory(tmp_path) == min(unlimited, 536870912)
+
+
+FAKE_TIPPECANOE = """
+import sqlite3
+import sys
+
+output = next(arg[len("--output="):] for arg in sys.argv if arg.startswith("--output="))
+features = sum(1 for _ in sys.stdin) if not sys.argv[-1].endswith(".geojson") else 0
+conn = sqlite3.connect(output)
+conn.execute("CREATE TABLE metadata (name TEXT, value TEXT)")
+conn.execute("CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB)")
+conn.execute("INSERT INTO tiles VALUES (4, 1, 1, ?)", (str(features).encode(),))
+conn.commit()
+"""
+
+
+@pytest.fixture
+def fake_tippecanoe(tmp_path, monkeypatch):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    tippecanoe_path = bin_dir / "tippecanoe"
+    tippecanoe_path.write_text(f"#!{sys.executable}\n{FAKE_TIPPECANOE}")
+    tippecanoe_path.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    return tippecanoe_path
+
+
+def test_main_records_unchanged_datasets_and_leaves_them_out(entity_sqlite_path, tmp_path, fake_tippecanoe):
+    test_data = pd.DataFrame.from_dict(
+        {
+            "dataset": ["national-park", "central-activities-zone"],
+            "entity": [520001, 520002],
+            "geojson": ["", ""],
+            "geometry": ["", ""],
+            "point": ["POINT(-3.905559 50.582137)", "POINT(-3.652891 51.142985)"],
+            "reference": ["1", "2"],
+        }
+    )
+    with sqlite3.connect(entity_sqlite_path) as conn:
+        test_data.to_sql("entity", conn, if_exists="append", index=False)
+    conn.close()
+    hash_dir = tmp_path / "hashes"
+    args = [
+        "--entity-path",
+        entity_sqlite_path,
+        "--hash-dir",
+        str(hash_dir),
+        "--hash-check-enabled",
+        "--hash-generation-enabled",
+    ]
+
+    first_dir = tmp_path / "first"
+    first_dir.mkdir()
+    result = CliRunner().invoke(main, args + ["--output-dir", str(first_dir)])
+    assert result.exit_code == 0, result.output
+    assert sorted(p.name for p in first_dir.glob("*.mbtiles")) == [
+        "central-activities-zone.mbtiles",
+        "national-park.mbtiles",
+    ]
+
+    with sqlite3.connect(entity_sqlite_path) as conn:
+        conn.execute("UPDATE entity SET point = 'POINT(-3.9 50.5)' WHERE entity = 520001")
+    conn.close()
+    second_dir = tmp_path / "second"
+    second_dir.mkdir()
+    result = CliRunner().invoke(main, args + ["--output-dir", str(second_dir)])
+    assert result.exit_code == 0, result.output
+
+    with open(hash_dir / "test.metrics.json") as file:
+        report = json.load(file)
+    assert report["status"] == "built"
+    assert report["unchanged_datasets"] == ["central-activities-zone"]
+    assert list(report["datasets"]) == ["national-park"]
+    assert [p.name for p in second_dir.glob("*.mbtiles")] == ["national-park.mbtiles"]
+
+
+def test_main_rebuilds_unchanged_datasets_built_with_other_options(
+    entity_sqlite_path, tmp_path, fake_tippecanoe
+):
+    test_data = pd.DataFrame.from_dict(
+        {
+            "dataset": ["national-park", "central-activities-zone"],
+            "entity": [520001, 520002],
+            "geojson": ["", ""],
+            "geometry": ["", ""],
+            "point": ["POINT(-3.905559 50.582137)", "POINT(-3.652891 51.142985)"],
+            "reference": ["1", "2"],
+        }
+    )
+    with sqlite3.connect(entity_sqlite_path) as conn:
+        test_data.to_sql("entity", conn, if_exists="append", index=False)
+    conn.close()
+    hash_dir = tmp_path / "hashes"
+    args = [
+        "--entity-path",
+        entity_sqlite_path,
+        "--hash-dir",
+        str(hash_dir),
+        "--hash-check-enabled",
+        "--hash-stat-check-enabled",
+        "--hash-generation-enabled",
+    ]
+
+    for name, options in [("first", []), ("same", []), ("compacted", ["--compact-precision", "3"])]:
+        output_dir = tmp_path / name
+        output_dir.mkdir()
+        result = CliRunner().invoke(main, args + options + ["--output-dir", str(output_dir)])
+        with open(hash_dir / "test.metrics.json") as file:
+            report = json.load(file)
+        if name == "same":
+            assert result.exit_code == 1
+            assert report["status"] == "unchanged"
+        else:
+            assert result.exit_code == 0, result.output
+            assert report["status"] == "built"
+            assert sorted(report["datasets"]) == ["central-activities-zone", "national-park"]
+
+
+def test_incremental_build_needs_a_snapshot_built_with_the_same_options(tmp_path):
+    previous_dir = tmp_path / "previous"
+    previous_dir.mkdir()
+    with sqlite3.connect(previous_dir / "test-ds.mbtiles") as conn:
+        conn.execute("CREATE TABLE metadata (name TEXT, value TEXT)")
+        conn.execute(
+            "CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB)"
+        )
+    conn.close()
+    snapshot = {1: ("abc", 0.0, 0.0, 1.0, 1.0)}
+    write_entity_snapshot(previous_dir / "test-ds.snapshot.sqlite3", snapshot, "old-options")
+    output_dir = tmp_path / "output"
+    output_dir.mkdir()
+
+    results = build_dataset_tiles_incrementally(
+        tmp_path / "missing.sqlite3",
+        output_dir,
+        "test-ds",
+        previous_dir,
+        snapshot,
+        options_key="new-options",
+    )
+
+    assert results is None
+    assert not (output_dir / "test-ds.mbtiles").exists()
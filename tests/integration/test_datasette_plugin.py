@@ -0,0 +1,231 @@
+import asyncio
+import gzip
+import importlib.util
+import os
+import sqlite3
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("datasette_tiles")
+
+from datasette.app import Datasette  # noqa: E402
+from datasette.plugins import pm  # noqa: E402
+
+PLUGIN_PATH = Path(__file__).parents[2] / "application" / "config" / "plugins" / "__init__.py"
+
+
+@pytest.fixture
+def plugin():
+    # A fresh copy of the plugin for each test, so that its caches and watcher start empty
+    spec = importlib.util.spec_from_file_location("tiles_plugin", PLUGIN_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    pm.register(module)
+    yield module
+    pm.unregister(module)
+
+
+def write_mbtiles(path, tiles):
+    """Write {(z, x, y): data} as gzipped tiles, swapped in with a rename like the tiles task does."""
+    temporary_path = path.with_name(f".{path.name}")
+    with sqlite3.connect(temporary_path) as conn:
+        conn.execute("CREATE TABLE metadata (name TEXT, value TEXT)")
+        conn.execute(
+            "CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB)"
+        )
+        conn.executemany(
+            "INSERT INTO tiles VALUES (?, ?, ?, ?)",
+            [(z, x, y, gzip.compress(data)) for (z, x, y), data in tiles.items()],
+        )
+    conn.close()
+    os.replace(temporary_path, path)
+    return path
+
+
+def test_tiles_watcher_runs_on_the_serving_loop(plugin, tmp_path, monkeypatch):
+    monkeypatch.setattr(plugin, "TILES_DIR", tmp_path)
+    monkeypatch.setattr(plugin, "TILES_RELOAD_INTERVAL", 0.05)
+    datasette = Datasette([])
+    # datasette serve runs the startup hooks on a loop of their own before serving
+    asyncio.run(datasette.invoke_startup())
+
+    async def serve():
+        await datasette.client.get("/-/tiles-cache.json")
+        write_mbtiles(tmp_path / "tree.mbtiles", {(0, 0, 0): b"tree"})
+        for _ in range(100):
+            if "tree" in datasette.databases:
+                break
+            await asyncio.sleep(0.05)
+        return await datasette.client.get("/-/tiles/tree/0/0/0.vector.pbf")
+
+    response = asyncio.run(serve())
+
+    assert response.status_code == 200
+    assert response.content == b"tree"
+
+
+def test_reload_tiles_databases_swaps_changed_files(plugin, tmp_path):
+    tree_path = write_mbtiles(tmp_path / "tree.mbtiles", {(0, 0, 0): b"old"})
+    datasette = Datasette([str(tree_path)])
+    loaded = plugin.get_loaded_tiles_files(datasette, tmp_path)
+    assert list(loaded) == ["tree"]
+    old_tree = datasette.databases["tree"]
+
+    async def read_tiles():
+        # Every executor thread has read the database before it is replaced
+        return await asyncio.gather(
+            *[datasette.databases["tree"].execute("SELECT tile_data FROM tiles") for _ in range(20)]
+        )
+
+    async def reload():
+        await read_tiles()
+        changes = [await plugin.reload_tiles_databases(datasette, tmp_path, loaded)]
+        write_mbtiles(tree_path, {(0, 0, 0): b"new"})
+        write_mbtiles(tmp_path / "park.mbtiles", {(0, 0, 0): b"park"})
+        changes.append(await plugin.reload_tiles_databases(datasette, tmp_path, loaded))
+        tiles = {result.rows[0][0] for result in await read_tiles()}
+        (tmp_path / "park.mbtiles").unlink()
+        changes.append(await plugin.reload_tiles_databases(datasette, tmp_path, loaded))
+        return changes, tiles
+
+    changes, tiles = asyncio.run(reload())
+
+    assert changes == [[], ["park", "tree"], ["park"]]
+    assert [gzip.decompress(tile) for tile in tiles] == [b"new"]
+    assert datasette.databases["tree"] is not old_tree
+    assert "park" not in datasette.databases
+    assert list(loaded) == ["tree"]
+
+
+def test_tiles_stack_order_is_kept_across_reloads(plugin, tmp_path):
+    paths = [write_mbtiles(tmp_path / f"{name}.mbtiles", {(0, 0, 0): name.encode()}) for name in ["a", "b", "c"]]
+    datasette = Datasette([str(path) for path in paths])
+    loaded = plugin.get_loaded_tiles_files(datasette, tmp_path)
+
+    async def get_orders():
+        orders = [[db.name for db in await plugin.get_tiles_stack_order(datasette)]]
+        write_mbtiles(paths[1], {(0, 0, 0): b"new"})
+        assert await plugin.reload_tiles_databases(datasette, tmp_path, loaded) == ["b"]
+        orders.append([db.name for db in await plugin.get_tiles_stack_order(datasette)])
+        return orders
+
+    assert asyncio.run(get_orders()) == [["c", "b", "a"], ["c", "b", "a"]]
+
+
+def test_get_mbtiles_databases_is_kept_until_the_databases_change(plugin, tmp_path, monkeypatch):
+    tree_path = write_mbtiles(tmp_path / "tree.mbtiles", {(0, 0, 0): b"tree"})
+    with sqlite3.connect(tmp_path / "other.db") as conn:
+        conn.execute("CREATE TABLE other (id INTEGER)")
+    conn.close()
+    datasette = Datasette([str(tree_path), str(tmp_path / "other.db")])
+    detected = []
+    detect_mtiles_databases = plugin.detect_mtiles_databases
+
+    async def counting_detect_mtiles_databases(datasette):
+        detected.append(datasette)
+        return await detect_mtiles_databases(datasette)
+
+    monkeypatch.setattr(plugin, "detect_mtiles_databases", counting_detect_mtiles_databases)
+
+    async def get_names():
+        names = [list(await plugin.get_mbtiles_databases(datasette)) for _ in range(3)]
+        park_path = write_mbtiles(tmp_path / "park.mbtiles", {(0, 0, 0): b"park"})
+        datasette.add_database(plugin.Database(datasette, path=str(park_path), is_mutable=False), name="park")
+        names.append(sorted(await plugin.get_mbtiles_databases(datasette)))
+        return names
+
+    assert asyncio.run(get_names()) == [["tree"], ["tree"], ["tree"], ["park", "tree"]]
+    assert len(detected) == 2
+
+
+def test_get_tiles_stack_order_follows_config_and_prefers_the_stack(plugin, tmp_path, monkeypatch):
+    paths = [write_mbtiles(tmp_path / f"{name}.mbtiles", {(0, 0, 0): name.encode()}) for name in ["a", "b", "c"]]
+    datasette = Datasette(
+        [str(path) for path in paths],
+        metadata={"plugins": {"datasette-tiles": {"tiles-stack-order": ["c", "a", "missing"]}}},
+    )
+    plugin_lookups = []
+    get_plugins = plugin.get_plugins
+
+    def counting_get_plugins():
+        plugin_lookups.append(1)
+        return get_plugins()
+
+    monkeypatch.setattr(plugin, "get_plugins", counting_get_plugins)
+
+    async def get_orders():
+        orders = [await plugin.get_tiles_stack_order(datasette) for _ in range(2)]
+        stack_path = write_mbtiles(tmp_path / f"{plugin.STACK_DATABASE}.mbtiles", {(0, 0, 0): b"stack"})
+        datasette.add_database(
+            plugin.Database(datasette, path=str(stack_path), is_mutable=False), name=plugin.STACK_DATABASE
+        )
+        orders.append(await plugin.get_tiles_stack_order(datasette))
+        return orders
+
+    first, second, with_stack = asyncio.run(get_orders())
+
+    assert [db.name for db in first] == ["a", "c"]
+    assert second is first
+    assert len(plugin_lookups) == 1
+    assert [db.name for db in with_stack] == [plugin.STACK_DATABASE]
+
+
+def test_tile_cache_evicts_least_recently_used_tiles_within_its_budget(plugin):
+    entry_bytes = plugin.TILE_CACHE_ENTRY_BYTES
+    cache = plugin.TileCache(3 * entry_bytes + 20)
+    db, other_db = object(), object()
+
+    cache.put((db, 0, 0, 0), b"0123456789")
+    cache.put((db, 1, 0, 0), None)
+    cache.put((other_db, 0, 0, 0), b"abcde")
+    assert cache.bytes == 3 * entry_bytes + 15
+    assert cache.get((db, 0, 0, 0)) == (True, b"0123456789")
+    # Over budget, so the least recently used tile goes
+    cache.put((db, 2, 0, 0), b"xyz")
+    assert cache.get((db, 1, 0, 0)) == (False, None)
+    assert cache.get((db, 2, 0, 0)) == (True, b"xyz")
+    # Replacing a tile only counts its new size
+    cache.put((db, 2, 0, 0), b"xy")
+    assert cache.bytes == 3 * entry_bytes + 17
+    # Tiles bigger than the whole budget are not cached
+    cache.put((db, 3, 0, 0), b"x" * (3 * entry_bytes))
+    assert cache.get((db, 3, 0, 0)) == (False, None)
+
+    cache.drop(db)
+
+    assert list(cache.tiles) == [(other_db, 0, 0, 0)]
+    assert cache.stats() == {
+        "hits": 2,
+        "misses": 2,
+        "evictions": 1,
+        "tiles": 1,
+        "bytes": entry_bytes + 5,
+        "max_bytes": 3 * entry_bytes + 20,
+    }
+
+
+def test_tiles_are_served_from_the_cache_until_their_database_is_replaced(plugin, tmp_path):
+    tree_path = write_mbtiles(tmp_path / "tree.mbtiles", {(0, 0, 0): b"old"})
+    datasette = Datasette([str(tree_path)])
+    loaded = plugin.get_loaded_tiles_files(datasette, tmp_path)
+
+    async def serve():
+        contents = []
+        for path in [
+            "/-/tiles/tree/0/0/0.vector.pbf",
+            "/-/tiles-stack/0/0/0.vector.pbf",
+            "/-/tiles/tree/1/0/0.vector.pbf",
+        ]:
+            contents.append((await datasette.client.get(path)).content)
+        stats = (await datasette.client.get("/-/tiles-cache.json")).json()
+        write_mbtiles(tree_path, {(0, 0, 0): b"new"})
+        await plugin.reload_tiles_databases(datasette, tmp_path, loaded)
+        contents.append((await datasette.client.get("/-/tiles/tree/0/0/0.vector.pbf")).content)
+        return contents, stats
+
+    contents, stats = asyncio.run(serve())
+
+    assert contents == [b"old", b"old", b"", b"new"]
+    assert (stats["hits"], stats["misses"], stats["tiles"]) == (1, 2, 2)
+    assert list(plugin.tile_cache.tiles) == [(datasette.databases["tree"], 0, 0, 0)]
@@ -0,0 +1,28 @@
+import sqlite3
+
+from benchmarks.generate_entity_database import generate_entity_database
+from task.build_tiles import get_geography_datasets
+
+
+def test_generate_entity_database(tmp_path):
+    entity_path = generate_entity_database(
+        tmp_path / "entity.sqlite3",
+        datasets=2,
+        rows_per_dataset=100,
+        point_ratio=0.25,
+        old_entity_ratio=0.1,
+        polygon_vertices=8,
+    )
+
+    assert sorted(get_geography_datasets(entity_path)) == [
+        "synthetic-dataset-0",
+        "synthetic-dataset-1",
+    ]
+    with sqlite3.connect(entity_path) as conn:
+        entities = conn.execute("SELECT COUNT(*) FROM entity").fetchone()[0]
+        points = conn.execute("SELECT COUNT(*) FROM entity WHERE geometry = ''").fetchone()[0]
+        old_entities = conn.execute("SELECT COUNT(*) FROM old_entity").fetchone()[0]
+    conn.close()
+    assert entities == 200
+    assert 0 < points < 100
+    assert old_entities == 20
@@ -3,12 +3,15 @@ from unittest.mock import patch, mock_open, MagicMock
 from pathlib import Path
 import json
 import hashlib
+import xxhash
 
 # Import the functions to be tested
 from task.build_tiles import (
     get_current_sqlite_hash,
     get_stored_hash,
     update_current_sqlite_hash,
+    get_stored_dataset_fingerprints,
+    update_dataset_fingerprints,
 )
 
 
@@ -36,6 +39,38 @@ class TestGeoJsonFunctions(unittest.TestCase):
         self.assertEqual(result, expected_hash)
         mock_file.assert_called_once_with(sqlite_path, "rb")
 
+    @patch("builtins.open", new_callable=mock_open, read_data=b"test data")
+    def test_get_current_sqlite_hash_with_blake2b(self, mock_file):
+        sqlite_path = Path("dummy_path.sqlite")
+        expected_hash = hashlib.blake2b(b"test data").hexdigest()
+        result = get_current_sqlite_hash(sqlite_path, "blake2b")
+        self.assertEqual(result, expected_hash)
+
+    @patch("builtins.open", new_callable=mock_open, read_data=b"test data")
+    def test_get_current_sqlite_hash_with_xxh3_128(self, mock_file):
+        sqlite_path = Path("dummy_path.sqlite")
+        expected_hash = xxhash.xxh3_128(b"test data").hexdigest()
+        result = get_current_sqlite_hash(sqlite_path, "xxh3_128")
+        self.assertEqual(result, expected_hash)
+
+    @patch("task.build_tiles.HASH_CHUNK_SIZE", 4)
+    @patch("builtins.open", new_callable=mock_open, read_data=b"test data")
+    def test_get_current_sqlite_hash_reads_in_chunks(self, mock_file):
+        sqlite_path = Path("dummy_path.sqlite")
+        expected_hash = hashlib.md5(b"test data").hexdigest()
+        result = get_current_sqlite_hash(sqlite_path)
+        self.assertEqual(result, expected_hash)
+        mock_file().read.assert_called_with(4)
+
+    @patch("builtins.open", new_callable=mock_open)
+    def test_update_current_sqlite_hash_with_file_stat(self, mock_file):
+        hash_path = Path("dummy_path.json")
+        file_stat = {"size": 10, "mtime": 1234}
+        update_current_sqlite_hash(hash_path, "newhashvalue", file_stat)
+        mock_file().write.assert_called_once_with(
+            json.dumps({"hash": "newhashvalue", "stat": file_stat})
+        )
+
     @patch("builtins.open", new_callable=mock_open)
     def test_update_current_sqlite_hash(self, mock_file):
         hash_path = Path("dummy_path.json")
@@ -44,6 +79,30 @@ class TestGeoJsonFunctions(unittest.TestCase):
         mock_file.assert_called_once_with(hash_path, "w")
         mock_file().write.assert_called_once_with(json.dumps({"hash": new_hash}))
 
+    @patch("pathlib.Path.exists", MagicMock(return_value=False))
+    def test_get_stored_dataset_fingerprints_not_exists(self):
+        result = get_stored_dataset_fingerprints(Path("dummy_path.datasets.json"))
+        self.assertEqual(result, {})
+
+    @patch(
+        "builtins.open",
+        new_callable=mock_open,
+        read_data='{"datasets": {"national-park": "1:abc"}}',
+    )
+    @patch("pathlib.Path.exists", MagicMock(return_value=True))
+    def test_get_stored_dataset_fingerprints_exists(self, mock_file):
+        result = get_stored_dataset_fingerprints(Path("dummy_path.datasets.json"))
+        self.assertEqual(result, {"national-park": "1:abc"})
+
+    @patch("builtins.open", new_callable=mock_open)
+    def test_update_dataset_fingerprints(self, mock_file):
+        fingerprint_path = Path("dummy_path.datasets.json")
+        update_dataset_fingerprints(fingerprint_path, {"national-park": "1:abc"})
+        mock_file.assert_called_once_with(fingerprint_path, "w")
+        mock_file().write.assert_called_once_with(
+            json.dumps({"datasets": {"national-park": "1:abc"}})
+        )
+
 
 if __name__ == "__main__":
     unittest.main()